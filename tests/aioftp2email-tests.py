@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import utils.aioftp2email as aioftp2email
+
+
+class FakeMessage(object):
+
+    def __init__(self, msg_id, src_code, dst_code):
+        self.id = msg_id
+        self.src_code = src_code
+        self.dst_code = dst_code
+
+    def iter_chunks(self):
+        yield b'<xml/>'
+
+    def check_well_formed(self):
+        pass
+
+
+class FakeChannel(aioftp2email.AsyncMessageChannel):
+    """Canal en memoria, los envios a 'lento' demoran"""
+
+    def __init__(self, messages=None):
+        self.messages = messages or {}
+        self.sent = []
+        self.marked = []
+        self.closed = False
+
+    async def load_messages(self):
+        return sorted(self.messages)
+
+    async def get_message(self, msg_id):
+        return self.messages[msg_id]
+
+    async def send_message(self, sinli_msg):
+        if sinli_msg.dst_code == 'lento':
+            await asyncio.sleep(0.01 * (10 - sinli_msg.id % 10))
+        if sinli_msg.id == 13:
+            raise Exception('error de envio')
+        self.sent.append(sinli_msg.id)
+
+    async def mark_message(self, msg_id, error=False):
+        self.marked.append(msg_id)
+
+    async def close(self):
+        self.closed = True
+
+
+class PipeChannelsTestCase(unittest.TestCase):
+    """Test para el envio asincronico de mensajes entre canales"""
+
+    def test_pipe_channels(self):
+        messages = dict((x, FakeMessage(x, 'L0000001', ('lento', 'rapido')[x % 2]))
+                        for x in range(40))
+        src_channel = FakeChannel(messages)
+        dst_channel = FakeChannel()
+
+        stats = asyncio.run(aioftp2email.pipe_channels(src_channel, dst_channel, concurrency=8))
+
+        self.assertEqual(sorted(dst_channel.sent), [x for x in range(40) if x != 13])
+        for parity in (0, 1):
+            partner_sent = [x for x in dst_channel.sent if x % 2 == parity]
+            self.assertEqual(partner_sent, sorted(partner_sent))
+        self.assertEqual(sorted(src_channel.marked), [x for x in range(40) if x != 13])
+        self.assertEqual(stats.counters['sent'], 39)
+        self.assertEqual(stats.counters['failed'], 1)
+        self.assertTrue(src_channel.closed and dst_channel.closed)
+
+
+class SettingsTestCase(unittest.TestCase):
+    """Test para la configuracion que acepta el motor asyncio"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_unsupported_settings(self):
+        """Verifica que se rechace la configuracion que solo implementa ftp2email
+        """
+        settings = {'email_protocol': 'pop', 'pop_settings': {'host': 'pop'},
+                    'compression': {'E0000001': 'gzip'}, 'email_batch': {'max_messages': 1},
+                    'dedup_file': 'duplicados.sqlite'}
+        self.assertEqual(aioftp2email.unsupported_settings(settings), [])
+
+        settings.update({'email_protocol': 'imap', 'journal_file': 'registro.journal',
+                         'retry_file': 'reintentos.sqlite',
+                         'email_batch': {'max_messages': 50}})
+        settings['pop_settings']['spool_dir'] = 'spool'
+        self.assertEqual(aioftp2email.unsupported_settings(settings),
+                         ['email_protocol=imap', 'pop_settings.spool_dir', 'journal_file',
+                          'retry_file', 'email_batch'])
+
+        settings_file = os.path.join(self.tmp_path, 'settings.json')
+        with open(settings_file, 'w') as o:
+            json.dump(settings, o)
+        with self.assertRaises(SystemExit) as cm:
+            aioftp2email.__main__(['-i', 'files', '-o', 'emails', '-s', settings_file])
+        self.assertEqual(cm.exception.code, 2)
+
+
+class AsyncSmtpClientTestCase(unittest.TestCase):
+    """Test para el cliente smtp asincronico"""
+
+    def test_sendmail(self):
+        received = []
+
+        async def handle(reader, writer):
+            writer.write(b'220 test\r\n')
+            while True:
+                line = (await reader.readline()).rstrip(b'\r\n')
+                received.append(line)
+                if line.startswith(b'EHLO'):
+                    writer.write(b'250-test\r\n250 AUTH PLAIN\r\n')
+                elif line.startswith(b'AUTH'):
+                    writer.write(b'235 ok\r\n')
+                elif line == b'DATA':
+                    writer.write(b'354 datos\r\n')
+                    while line != b'.':
+                        line = (await reader.readline()).rstrip(b'\r\n')
+                        received.append(line)
+                    writer.write(b'250 ok\r\n')
+                elif line == b'QUIT':
+                    writer.write(b'221 chau\r\n')
+                    await writer.drain()
+                    writer.close()
+                    return
+                else:
+                    writer.write(b'250 ok\r\n')
+                await writer.drain()
+
+        async def send():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = aioftp2email.AsyncSmtpClient('127.0.0.1', port, user='u', password='p')
+            await client.connect()
+            await client.sendmail('a@example.com', 'b@example.com', 'Subject: x\n\n.linea\nfin')
+            # email con un adjunto que se codifica a medida que se envia
+            await client.sendmail('a@example.com', 'b@example.com',
+                                  aioftp2email.ftp2email.StreamedEmail(
+                                    'Subject: y\n\nADJUNTO\nfin\n',
+                                    [('ADJUNTO', FakeMessage(1, 'a', 'b'), None)]))
+            await client.quit()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(send())
+        self.assertIn(b'MAIL FROM:<a@example.com>', received)
+        self.assertIn(b'RCPT TO:<b@example.com>', received)
+        self.assertIn(b'..linea', received)
+        self.assertIn(b'PHhtbC8+', received)
+        self.assertEqual(received[-1], b'QUIT')
+
+
+def main():
+    unittest.main()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
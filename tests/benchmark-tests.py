@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from lxml import etree
+
+# fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import utils.benchmark as benchmark
+import utils.ftp2email as ftp2email
+
+
+class GenMessageTestCase(unittest.TestCase):
+    """Test para el generador de mensajes sinteticos"""
+
+    def test_gen_message(self):
+        """Verifica que los mensajes generados sean validos segun la gramatica
+        """
+        grammar_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    os.pardir, 'sinliarg.rng')
+        relaxng = etree.RelaxNG(file=grammar_file)
+        for sinli_type in benchmark.SINLI_TYPES:
+            xml = benchmark.gen_message(sinli_type, 'L0002349', 'E0000001', items=3)
+            self.assertTrue(relaxng.validate(etree.fromstring(xml)),
+                            '%s: %s' % (sinli_type, relaxng.error_log))
+            message = ftp2email.SinliargMessage(xml)
+            self.assertEqual((message.sinli_type, message.src_code, message.dst_code),
+                             (sinli_type, 'L0002349', 'E0000001'))
+
+
+class RunDirectionTestCase(unittest.TestCase):
+    """Test de ambos sentidos contra los servidores locales"""
+
+    def setUp(self):
+        self.work_path = tempfile.mkdtemp()
+        self.xml_bytes = benchmark.prepare(self.work_path, 10, 2, 3, benchmark.SINLI_TYPES)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_path)
+
+    def test_run_direction(self):
+        """Verifica que se envien y reciban todos los mensajes
+        """
+        result = benchmark.run_direction('files2emails', self.work_path, workers=2)
+        self.assertEqual((result['messages'], result['failed']), (10, 0))
+        self.assertEqual(len(os.listdir(os.path.join(self.work_path, 'outbox'))), 10)
+
+        result = benchmark.run_direction('emails2files', self.work_path)
+        self.assertEqual((result['messages'], result['failed']), (10, 0))
+        self.assertEqual(os.listdir(os.path.join(self.work_path, 'inbox')), [])
+        received = [x for dirpath, dirnames, filenames
+                    in os.walk(os.path.join(self.work_path, 'received')) for x in filenames]
+        self.assertEqual(len(received), 10)
+
+    def test_run_direction_imap(self):
+        """Verifica que se reciban los emails por imap y se muevan a Procesados
+        """
+        result = benchmark.run_direction('emails2files', self.work_path, protocol='imap')
+        self.assertEqual((result['messages'], result['failed']), (10, 0))
+        self.assertEqual(os.listdir(os.path.join(self.work_path, 'inbox')), ['Procesados'])
+        self.assertEqual(len(os.listdir(os.path.join(self.work_path, 'inbox', 'Procesados'))),
+                         10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+# fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import utils.benchmark as benchmark
+import utils.catalogo as catalogo
+import utils.ftp2email as ftp2email
+
+
+class CatalogTestCase(unittest.TestCase):
+    """Test para la aplicacion de cambios de precio al catalogo"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.catalog_file = os.path.join(self.tmp_path, 'CATALOGO.xml')
+        with open(self.catalog_file, 'wb') as o:
+            o.write(benchmark.gen_message('CATALOGO', 'E0000001', 'L0002349', items=10))
+        # los cambios del mensaje 1 son sobre los mismos 10 libros del catalogo
+        self.books = [benchmark.gen_book(x) for x in range(10, 20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def changes_message(self, items=10, nro=1, replace=None):
+        xml = benchmark.gen_message('CAMBIOPRECIO', 'E0000001', 'L0002349', items=items,
+                                    nro=nro)
+        if replace:
+            xml = xml.replace(*replace)
+        return ftp2email.SinliargMessage(xml)
+
+    def test_read(self):
+        """Verifica la lectura del catalogo y de los cambios
+        """
+        catalog = catalogo.Catalog.read(self.catalog_file)
+        self.assertEqual(len(catalog), 10)
+        self.assertEqual(list(catalog.ean), sorted(int(x['EAN']) for x in self.books))
+        position = catalog.lookup([int(self.books[3]['EAN']), 1])
+        self.assertEqual(catalog.precio[position[0]], float(self.books[3]['PRECIO']))
+        self.assertEqual(position[1], -1)
+
+        # el encabezado y los cambios se leen en una sola pasada
+        message = self.changes_message()
+        with mock.patch.object(ftp2email.cElementTree, 'iterparse',
+                               wraps=ftp2email.cElementTree.iterparse) as iterparse_mock:
+            changes = catalogo.PriceChanges.read(message)
+            self.assertEqual(iterparse_mock.call_count, 1)
+        self.assertEqual(len(changes), 10)
+        self.assertEqual(changes.identifier, 'CAMBIOPRECIOE00000011')
+        self.assertEqual(changes.fecha_vigencia, benchmark.DATE)
+        self.assertEqual(changes.precio_anterior[0], float(self.books[0]['PRECIO']))
+
+    def test_apply(self):
+        """Verifica que se apliquen los cambios y se informen las diferencias
+        """
+        catalog = catalogo.Catalog.read(self.catalog_file)
+        mismatched_price = self.books[2]['PRECIO']
+        message = self.changes_message(
+                    replace=(b'<PRECIO_ANTERIOR><MONEDA>ARS</MONEDA><VALOR>%s</VALOR>'
+                             % mismatched_price.encode('ascii'),
+                             b'<PRECIO_ANTERIOR><MONEDA>ARS</MONEDA><VALOR>1.00</VALOR>'))
+        totals = catalog.apply(catalogo.PriceChanges.read(message))
+        self.assertEqual(totals, {'applied': 10, 'mismatched': 1, 'not_found': 0})
+        self.assertTrue(catalog.changed.all())
+        expected = sorted((int(x['EAN']), round(float(x['PRECIO']) * 1.1, 2))
+                          for x in self.books)
+        self.assertEqual(list(zip(catalog.ean, catalog.precio)), expected)
+        self.assertEqual(len(catalog.mismatches[0]), 1)
+        self.assertEqual(catalog.mismatches[0]['ean'][0], int(self.books[2]['EAN']))
+
+        # omitiendo las diferencias el libro mantiene el precio del catalogo
+        catalog = catalogo.Catalog.read(self.catalog_file)
+        catalog.apply(catalogo.PriceChanges.read(message), skip_mismatches=True)
+        self.assertEqual(catalog.precio[catalog.lookup([int(self.books[2]['EAN'])])[0]],
+                         float(mismatched_price))
+
+    def test_apply_order(self):
+        """Verifica que los mensajes se apliquen por fecha de vigencia y que se
+            busque por ISBN_13 o COD_ARTICULO cuando el EAN no esta en el catalogo
+        """
+        catalog = catalogo.Catalog.read(self.catalog_file)
+        ean = int(self.books[0]['EAN'])
+        later = catalogo.PriceChanges([ean], [300.0], ['ARS'], [200.0], ['ARS'],
+                                      fecha_vigencia='2013-01-01T00:00:00')
+        earlier = catalogo.PriceChanges([-1, 1], [200.0, 1.0], ['ARS', 'ARS'],
+                                        [float(self.books[0]['PRECIO']), 1.0], ['ARS', 'ARS'],
+                                        isbn_13=[self.books[0]['ISBN_13'], ''],
+                                        fecha_vigencia='2012-01-01T00:00:00')
+        totals = catalog.apply([later, earlier])
+        self.assertEqual(totals, {'applied': 2, 'mismatched': 0, 'not_found': 1})
+        self.assertEqual(catalog.precio[catalog.lookup([ean])[0]], 300.0)
+        self.assertEqual(catalog.fecha_vigencia[catalog.lookup([ean])[0]], '2013-01-01T00:00:00')
+
+    def test_main(self):
+        """Verifica la salida del comando
+        """
+        changes_file = os.path.join(self.tmp_path, 'CAMBIOPRECIO.xml')
+        with open(changes_file, 'wb') as o:
+            o.write(self.changes_message(items=5, nro=2).xml)
+        output = os.path.join(self.tmp_path, 'precios.csv')
+        mismatches = os.path.join(self.tmp_path, 'diferencias.csv')
+        self.assertEqual(catalogo.main([self.catalog_file, changes_file, '-o', output,
+                                        '--solo-cambios', '--diferencias', mismatches]), 0)
+        with open(output) as i:
+            rows = list(csv.DictReader(i))
+        self.assertEqual(sorted(x['EAN'] for x in rows),
+                         sorted(x['EAN'] for x in self.books[:5]))
+        self.assertTrue(all(x['FECHA_VIGENCIA'] == benchmark.DATE for x in rows))
+        with open(mismatches) as i:
+            self.assertEqual(len(list(csv.reader(i))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
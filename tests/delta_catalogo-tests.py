@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+from lxml import etree
+
+# fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import utils.benchmark as benchmark
+import utils.delta_catalogo as delta_catalogo
+import utils.ftp2email as ftp2email
+
+
+class CatalogDeltaTestCase(unittest.TestCase):
+    """Test para la generacion de cambios entre dos catalogos"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.previous_file = os.path.join(self.tmp_path, 'CATALOGO_anterior.xml')
+        self.current_file = os.path.join(self.tmp_path, 'CATALOGO_nuevo.xml')
+        self.catalog_file = os.path.join(self.tmp_path, 'CATALOGO_cambios.xml')
+        self.prices_file = os.path.join(self.tmp_path, 'CAMBIOPRECIO.xml')
+        self.removed_file = os.path.join(self.tmp_path, 'bajas.csv')
+        xml = benchmark.gen_message('CATALOGO', 'E0000001', 'L0002349', items=10)
+        with open(self.previous_file, 'wb') as o:
+            o.write(xml)
+        self.books = [benchmark.gen_book(x) for x in range(10, 20)]
+
+        # catalogo nuevo: 2 cambios de precio, 1 cambio de titulo, 1 baja, 1 alta,
+        # y un item con los elementos en otro orden y formato que no cuenta como cambio
+        root = ElementTree.fromstring(xml)
+        content = root.find('CONTENIDO')
+        items = content.findall('ITEM')
+        for item in items[:2]:
+            item.find('PRECIO_VENTA').text = '999.90'
+        items[2].find('TITULO').text = 'Titulo corregido'
+        content.remove(items[3])
+        children = list(items[4])
+        for child in children:
+            items[4].remove(child)
+            child.tail = '\n  '
+        items[4].extend(reversed(children))
+        ElementTree.SubElement(items[5], 'FECHA_ULTIMA_MODIFICACION').text = benchmark.DATE
+        new_book = ElementTree.fromstring(benchmark.gen_message('CATALOGO', 'E0000001',
+                                                                'L0002349', items=1, nro=50))
+        content.append(new_book.find('CONTENIDO/ITEM'))
+        with open(self.current_file, 'wb') as o:
+            o.write(ElementTree.tostring(root, encoding='utf-8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def assertValid(self, filename):
+        grammar_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                    os.pardir, 'sinliarg.rng')
+        relaxng = etree.RelaxNG(file=grammar_file)
+        self.assertTrue(relaxng.validate(etree.parse(filename)),
+                        '%s: %s' % (filename, relaxng.error_log))
+
+    def test_main(self):
+        """Verifica los mensajes generados y que sean validos segun la gramatica
+        """
+        self.assertEqual(delta_catalogo.main([self.previous_file, self.current_file,
+                                              '--catalogo', self.catalog_file,
+                                              '--precios', self.prices_file,
+                                              '--bajas', self.removed_file,
+                                              '--temporal', self.tmp_path]), 0)
+        self.assertEqual(sorted(os.listdir(self.tmp_path)),
+                         ['CAMBIOPRECIO.xml', 'CATALOGO_anterior.xml', 'CATALOGO_cambios.xml',
+                          'CATALOGO_nuevo.xml', 'bajas.csv'])
+        self.assertValid(self.catalog_file)
+        self.assertValid(self.prices_file)
+
+        message = ftp2email.SinliargFile(self.catalog_file)
+        self.assertEqual((message.sinli_type, message.src_code, message.dst_code),
+                         ('CATALOGO', 'E0000001', 'L0002349'))
+        self.assertEqual([x.findtext('TITULO') for x in message.iter_items()],
+                         ['Titulo corregido', benchmark.gen_book(50)['TITULO']])
+
+        message = ftp2email.SinliargFile(self.prices_file)
+        self.assertEqual(message.sinli_type, 'CAMBIOPRECIO')
+        self.assertEqual(message.xmltree.findtext('CONTENIDO/FECHA_VIGENCIA'), benchmark.DATE)
+        changes = [(x.findtext('ID_LIBRO/EAN'), x.findtext('PRECIO/VALOR'),
+                    x.findtext('PRECIO_ANTERIOR/VALOR')) for x in message.iter_items()]
+        self.assertEqual(changes, [(x['EAN'], '999.90', x['PRECIO']) for x in self.books[:2]])
+
+        with open(self.removed_file) as i:
+            rows = list(csv.DictReader(i))
+        self.assertEqual([x['EAN'] for x in rows], [self.books[3]['EAN']])
+
+    def test_compare(self):
+        """Verifica los totales y que no se escriban mensajes sin items
+        """
+        delta = delta_catalogo.CatalogDelta(os.path.join(self.tmp_path, 'indice.sqlite'))
+        self.assertEqual(delta.load_previous(self.previous_file), 10)
+        catalog_writer, prices_writer = delta_catalogo.build_writers(
+                        self.previous_file, self.catalog_file, self.prices_file,
+                        fecha_vigencia='2013-01-01T00:00:00')
+        totals = delta.compare(self.previous_file, catalog_writer, prices_writer)
+        catalog_writer.close()
+        prices_writer.close()
+        self.assertEqual(totals['unchanged'], 10)
+        self.assertEqual(sum(totals[x] for x in ('new', 'changed', 'prices', 'removed')), 0)
+        self.assertFalse(os.path.exists(self.catalog_file))
+        self.assertFalse(os.path.exists(self.prices_file))
+
+        delta = delta_catalogo.CatalogDelta(os.path.join(self.tmp_path, 'indice.sqlite'))
+        delta.load_previous(self.previous_file)
+        totals = delta.compare(self.current_file, delta_catalogo.MessageWriter(None, '', [], '', ''),
+                               delta_catalogo.MessageWriter(None, '', [], '', ''))
+        self.assertEqual(totals, {'items': 10, 'new': 1, 'changed': 1, 'prices': 2,
+                                  'unchanged': 6, 'removed': 1, 'duplicated': 0, 'invalid': 0})
+        delta.close()
+
+    def test_price_change_currency(self):
+        """Verifica que un cambio de moneda no valida en CAMBIOPRECIO vaya en el catalogo
+        """
+        with open(self.current_file, 'rb') as i:
+            xml = i.read()
+        with open(self.current_file, 'wb') as o:
+            o.write(xml.replace(b'<MONEDA_VENTA>ARS</MONEDA_VENTA>',
+                                b'<MONEDA_VENTA>Pesos</MONEDA_VENTA>', 1))
+        delta = delta_catalogo.CatalogDelta(os.path.join(self.tmp_path, 'indice.sqlite'))
+        delta.load_previous(self.previous_file)
+        totals = delta.compare(self.current_file, delta_catalogo.MessageWriter(None, '', [], '', ''),
+                               delta_catalogo.MessageWriter(None, '', [], '', ''))
+        self.assertEqual((totals['changed'], totals['prices']), (2, 1))
+        delta.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
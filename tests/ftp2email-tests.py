@@ -4,9 +4,14 @@
 # export PYTHONPATH=$PYTHONPATH:/home/facundo/repo/sinliarg
 
 from email.parser import Parser as emailParser
+import errno
 import os
 import poplib
+import shutil
+import socket
 import sys
+import tempfile
+import time
 import traceback
 import unittest
 
@@ -15,9 +20,56 @@ import mock
 # fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
 
+import utils.benchmark as benchmark
 import utils.ftp2email as ftp2email
 
 
+class SmtpServerFake(object):
+    """Conexion smtp en memoria, guarda los emails recibidos"""
+
+    def __init__(self):
+        self.emails = []            # (origen, destino, texto del email)
+        self.replies = []
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def mail(self, sender):
+        self.current = [sender, None, b'']
+        return 250, b'OK'
+
+    def rcpt(self, recipient):
+        self.current[1] = recipient
+        return 250, b'OK'
+
+    def putcmd(self, command):
+        self.replies = [(354, b'OK'), (250, b'OK')]
+
+    def getreply(self):
+        code, resp = self.replies.pop(0)
+        if code == 250:
+            sender, recipient, data = self.current
+            # se deshace el formato del comando DATA
+            data = data[:-len(b'.\r\n')].replace(b'\r\n..', b'\r\n.').replace(b'\r\n', b'\n')
+            self.emails.append((sender, recipient, data.decode('ascii')))
+        return code, resp
+
+    def send(self, data):
+        self.current[2] += data
+
+    def rset(self):
+        pass
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
 class LoggingTester(object):
 
     def __init__(self):
@@ -28,8 +80,13 @@ class LoggingTester(object):
 
         # agregar un metodo por cada nivel de log
         # que acumula los mensajes en el diccionario
-        map(lambda l: setattr(self, l, lambda x: self.messages[l].append(x)),
-            self.log_levels)
+        for level in self.log_levels:
+            self.add_level(level)
+
+    def add_level(self, level):
+        def log(msg, *args):
+            self.messages[level].append(msg % args if args else msg)
+        setattr(self, level, log)
 
     def flush(self):
         self.messages = dict((x, []) for x in self.log_levels)
@@ -42,7 +99,7 @@ class SinliargMessageTestCase(unittest.TestCase):
     """Test para los mensajes"""
 
     def setUp(self):
-        xmldata = """<?xml version="1.0" encoding="utf-8"?>
+        xmldata = b"""<?xml version="1.0" encoding="utf-8"?>
                      <REMFAA>
                      <ARCHIVO>
                          <DESCRIPCION>Factura/Remito 0001-00336393</DESCRIPCION>
@@ -92,6 +149,103 @@ class SinliargMessageTestCase(unittest.TestCase):
                             'd.xml')
 
 
+    def test_header_early_exit(self):
+        """Verifica que el encabezado se lea sin parsear el contenido del mensaje
+        """
+        xmldata = (b'<?xml version="1.0" encoding="utf-8"?><CATALOGO>'
+                   b'<ARCHIVO><DESCRIPCION>Catalogo</DESCRIPCION><CODIGO>CATALOGO</CODIGO></ARCHIVO>'
+                   b'<ORIGEN><CODIGO_SINLI>E0000001</CODIGO_SINLI></ORIGEN>'
+                   b'<DESTINO><CODIGO_SINLI>L0002349</CODIGO_SINLI></DESTINO>'
+                   b'<CONTENIDO><ITEM>' + b'<EAN>9789505634606</EAN>' * 20000 + b'</ITEM>'
+                   b'<ITEM></CONTENIDO></CATALOGO>')
+        message = ftp2email.SinliargMessage(xmldata)
+        self.assertEqual(message.sinli_type, 'CATALOGO')
+        self.assertEqual(message.src_code, 'E0000001')
+        self.assertEqual(message.dst_code, 'L0002349')
+        self.assertEqual(message.description, 'Catalogo')
+
+        # el arbol completo se parsea recien cuando se pide
+        self.assertRaises(ftp2email.cElementTree.ParseError, lambda: message.xmltree)
+
+        # el error despues del encabezado se detecta al leer el mensaje, antes de enviarlo
+        self.assertRaises(ftp2email.cElementTree.ParseError, message.check_well_formed)
+        src_channel = mock.Mock()
+        src_channel.get_message.return_value = message
+        stats = ftp2email.PipeStats()
+        self.assertIsNone(ftp2email.read_message(src_channel, 'a.xml', stats))
+        src_channel.mark_message.assert_called_once_with('a.xml', True)
+        self.assertEqual(stats.counters['failed'], 1)
+
+        # sin la verificacion (mensajes validados antes) el documento no se recorre
+        src_channel = ftp2email.build_channel('files', {'base_path': '', 'dir_re': '',
+                                                        'check_well_formed': False})
+        self.assertFalse(src_channel.check_well_formed)
+        src_channel.get_message = mock.Mock(return_value=message)
+        src_channel.mark_message = mock.Mock()
+        with mock.patch.object(message, 'check_well_formed') as check_mock:
+            self.assertIs(ftp2email.read_message(src_channel, 'a.xml', stats), message)
+        self.assertEqual(check_mock.call_count, 0)
+        self.assertEqual(src_channel.mark_message.call_count, 0)
+        self.assertTrue(ftp2email.build_channel('files', {'base_path': '', 'dir_re': ''})
+                            .check_well_formed)
+
+        tmp_path = tempfile.mkdtemp()
+        try:
+            msg_file = os.path.join(tmp_path, 'CATALOGO.xml')
+            with open(msg_file, 'wb') as o:
+                o.write(xmldata)
+            self.assertRaises(ftp2email.cElementTree.ParseError,
+                              ftp2email.SinliargFile(msg_file).check_well_formed)
+            with open(msg_file, 'wb') as o:
+                o.write(xmldata.replace(b'<ITEM></CONTENIDO>', b'</CONTENIDO>'))
+            ftp2email.SinliargFile(msg_file).check_well_formed()
+        finally:
+            shutil.rmtree(tmp_path)
+
+
+class SinliargItemsTestCase(unittest.TestCase):
+    """Test para la lectura incremental de los items de los mensajes"""
+
+    def test_iter_items(self):
+        """Verifica la lectura de los items de cada tipo de mensaje
+        """
+        examples_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                     os.pardir, 'ejemplos')
+        pedido_file = os.path.join(examples_path, 'PEDIDO_LAR00021_EAR00023_45_multi.xml')
+        self.assertEqual([x.findtext('ID_LIBRO/EAN')
+                          for x in ftp2email.SinliargMessage.iter_file_items(pedido_file)],
+                         ['9789505811915', '9789875900042', '9789505811915'])
+        with open(os.path.join(examples_path, 'CAMBIOPRECIO_LAR00021_99999999_44.xml'),
+                  'rb') as i:
+            self.assertEqual([x.findtext('PRECIO_ANTERIOR/VALOR')
+                              for x in ftp2email.SinliargMessage.iter_file_items(i)],
+                             ['100.00'])
+
+        message = ftp2email.SinliargMessage(
+                        benchmark.gen_message('CATALOGO', 'E0000001', 'L0002349', items=3))
+        self.assertEqual([x.findtext('EAN') for x in message.iter_items()],
+                         [benchmark.gen_book(x)['EAN'] for x in range(3, 6)])
+        self.assertEqual([x.tag for x in message.iter_items('ARCHIVO')], ['ARCHIVO'])
+
+        # los campos del encabezado se leen en la misma pasada que los items
+        fields = {'ARCHIVO/IDENTIFICADOR': None, 'CONTENIDO/FECHA_VIGENCIA': 'sin fecha'}
+        self.assertEqual(len(list(message.iter_items(fields=fields))), 3)
+        self.assertEqual(fields, {'ARCHIVO/IDENTIFICADOR': 'CATALOGOE00000011',
+                                  'CONTENIDO/FECHA_VIGENCIA': 'sin fecha'})
+
+    def test_iter_items_cleared(self):
+        """Verifica que los items ya leidos se vacien y se quiten del arbol
+        """
+        message = ftp2email.SinliargMessage(
+                        benchmark.gen_message('REMITO', 'E0000001', 'L0002349', items=50))
+        previous = []
+        for item in message.iter_items():
+            self.assertTrue(len(item) > 0)
+            self.assertTrue(all(len(x) == 0 for x in previous))
+            previous.append(item)
+        self.assertEqual(len(previous), 50)
+
+
 class FilesystemChannelTestCase(unittest.TestCase):
     """Test para el manejo de mensajes por archivos"""
 
@@ -117,7 +271,37 @@ class FilesystemChannelTestCase(unittest.TestCase):
                                       'L0002349_L0002349/vacio.xml',
                                       'L0002349_L0000001/vacio.xml']]
 
-        self.assertListEqual(list(self.ch.load_messages()), espected_files)
+        self.assertListEqual(sorted(self.ch.load_messages()), sorted(espected_files))
+
+    def test_load_messages_state_file(self):
+        """Verifica que no se vuelvan a listar los directorios que no cambiaron
+            ni los directorios de mensajes archivados
+        """
+        base_path = tempfile.mkdtemp()
+        msg_dir = os.path.join(base_path, 'L0002349_E0000001')
+        os.makedirs(os.path.join(msg_dir, 'archived'))
+        for filename in ('a.xml', 'archived/b.xml'):
+            open(os.path.join(msg_dir, filename), 'w').close()
+        old_mtime = int(time.time()) - 60
+        for path in (base_path, msg_dir):
+            os.utime(path, (old_mtime, old_mtime))
+        state_path = tempfile.mkdtemp()
+        ch = ftp2email.FilesystemChannel(base_path, '/L0002349_[A-Z][0-9]{7}$',
+                                         state_file=os.path.join(state_path, 'state.json'))
+        try:
+            self.assertEqual(list(ch.load_messages()), [os.path.join(msg_dir, 'a.xml')])
+            with mock.patch('%s.ftp2email.os.walk' % __name__, wraps=os.walk) as walk_mock:
+                self.assertEqual(list(ch.load_messages()), [os.path.join(msg_dir, 'a.xml')])
+                self.assertTrue(not walk_mock.called)
+
+                # al cambiar el directorio se vuelve a listar
+                open(os.path.join(msg_dir, 'c.xml'), 'w').close()
+                self.assertEqual(sorted(ch.load_messages()),
+                                 [os.path.join(msg_dir, x) for x in ('a.xml', 'c.xml')])
+                walk_mock.assert_called_once_with(msg_dir)
+        finally:
+            shutil.rmtree(base_path)
+            shutil.rmtree(state_path)
 
     @mock.patch('%s.ftp2email.SinliargMessage' % __name__)
     def test_get_message(self, message_mock):
@@ -125,12 +309,12 @@ class FilesystemChannelTestCase(unittest.TestCase):
         """
         msg_id = os.path.join(self.test_path, 'L0002349_E0000001/vacio.xml')
         self.ch.get_message(msg_id)
-        message_mock.assert_called_with('', filename='vacio.xml')
+        message_mock.assert_called_with(b'', filename='vacio.xml')
 
         msg_id = os.path.join(self.test_path,
                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
         self.ch.get_message(msg_id)
-        message_mock.assert_called_with(open(msg_id).read(),
+        message_mock.assert_called_with(open(msg_id, 'rb').read(),
                                         filename='REMFAA_L0002349_E0000001_517.xml')
 
     @mock.patch('%s.ftp2email.shutil.move' % __name__)
@@ -151,10 +335,34 @@ class FilesystemChannelTestCase(unittest.TestCase):
         self.assertEqual(ftp2email.logging.messages['info'],
                             ['Moviendo archivo de mensaje %s' % msg_id])
 
+    def test_mark_message_archive_exists(self):
+        """Verifica que se archive el mensaje si otro thread crea el directorio
+            de archivados al mismo tiempo
+        """
+        base_path = tempfile.mkdtemp()
+        msg_dir = os.path.join(base_path, 'L0002349_E0000001')
+        os.mkdir(msg_dir)
+        msg_id = os.path.join(msg_dir, 'a.xml')
+        open(msg_id, 'w').close()
+        archived_path = os.path.join(msg_dir, 'archived')
+
+        def makedirs(path):
+            os.mkdir(path)
+            raise OSError(errno.EEXIST, 'File exists', path)
+
+        ch = ftp2email.FilesystemChannel(base_path, '/L0002349_[A-Z][0-9]{7}$')
+        try:
+            with mock.patch('%s.ftp2email.os.makedirs' % __name__, side_effect=makedirs):
+                ch.mark_message(msg_id)
+            self.assertEqual(os.listdir(archived_path), ['a.xml'])
+            self.assertFalse(os.path.exists(msg_id))
+        finally:
+            shutil.rmtree(base_path)
+
     def test_send_message(self):
         """Verifica que se guarde el mensaje en el sistema de archivos
         """
-        msg = ftp2email.SinliargMessage("""<?xml version="1.0" encoding="utf-8"?>
+        msg = ftp2email.SinliargMessage(b"""<?xml version="1.0" encoding="utf-8"?>
                                         <REMFAA>
                                             <ARCHIVO>
                                                 <DESCRIPCION>Factura/Remito 0001-00336393</DESCRIPCION>
@@ -176,20 +384,80 @@ class FilesystemChannelTestCase(unittest.TestCase):
                                             </DESTINO>
                                          </REMFAA>""", filename='REMFAA_L0002349_E0000001.xml')
 
-        with mock.patch('%s.ftp2email.open' % __name__, create=True) as open_mock:
-            open_mock.return_value = mock.MagicMock(spec=file)
+        with mock.patch('%s.ftp2email.open' % __name__, create=True) as open_mock, \
+                mock.patch('%s.ftp2email.make_dirs' % __name__) as make_dirs_mock:
+            open_mock.return_value = mock.MagicMock()
             self.ch.send_message(msg)
 
-            dst_path = os.path.join(self.test_path, 'edit1',
+            dst_path = os.path.join(self.test_path,
                                     '_'.join([msg.src_code, msg.dst_code]),
                                     msg.sinli_type, msg.filename)
+            make_dirs_mock.assert_called_once_with(os.path.dirname(os.path.dirname(dst_path)))
 
-            open_mock.assert_called_once_with(dst_path, 'w')
+            open_mock.assert_called_once_with(dst_path, 'bw')
             file_mock = open_mock.return_value
             file_mock.write.assert_called_once_with(msg.xml)
             file_mock.close.assert_called_once_with()
 
 
+    def test_send_message_dst_dirs(self):
+        """Verifica que el directorio de destino se busque en el indice
+            sin recorrer los mensajes archivados
+        """
+        base_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(base_path, 'L0000001_E0000001', 'archived', 'E0000001_L0002349'))
+        os.makedirs(os.path.join(base_path, 'edit1', 'E0000001_L0002349'))
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            msg = ftp2email.SinliargMessage(i.read(), filename='REMFAA.xml')
+        msg.src_code, msg.dst_code = 'E0000001', 'L0002349'
+        ch = ftp2email.FilesystemChannel(base_path, '/L0002349_[A-Z][0-9]{7}$')
+        try:
+            with mock.patch('%s.ftp2email.os.walk' % __name__, wraps=os.walk) as walk_mock:
+                file_path = ch.send_message(msg)
+                self.assertEqual(file_path, os.path.join(base_path, 'edit1', 'E0000001_L0002349',
+                                                         'REMFAA', 'REMFAA.xml'))
+                msg.dst_code = 'L0000002'
+                file_path = ch.send_message(msg)
+                self.assertEqual(file_path, os.path.join(base_path, 'E0000001_L0000002',
+                                                         'REMFAA', 'REMFAA.xml'))
+                ch.send_message(msg)
+                self.assertEqual(walk_mock.call_count, 1)
+        finally:
+            shutil.rmtree(base_path)
+
+class FilesystemWatcherTestCase(unittest.TestCase):
+    """Test para la deteccion de archivos nuevos en modo daemon"""
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.base_path, 'L0002349_E0000001'))
+        self.watcher = ftp2email.FilesystemWatcher(self.base_path, '/L0002349_[A-Z][0-9]{7}$')
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.base_path)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify solo existe en linux')
+    def test_wait(self):
+        """Verifica que se detecten los archivos nuevos en los directorios de mensajes
+        """
+        self.assertFalse(self.watcher.polling)
+        self.assertFalse(self.watcher.wait(0.1))
+
+        # archivos en directorios que no son de mensajes a enviar o archivados
+        os.makedirs(os.path.join(self.base_path, 'E0000001_L0002349'))
+        open(os.path.join(self.base_path, 'E0000001_L0002349', 'a.xml'), 'w').close()
+        os.makedirs(os.path.join(self.base_path, 'L0002349_E0000001', 'archived'))
+        self.assertFalse(self.watcher.wait(0.1))
+
+        # directorio nuevo y un mensaje dentro de el
+        os.makedirs(os.path.join(self.base_path, 'L0002349_E0000002'))
+        self.assertTrue(self.watcher.wait(1))
+        open(os.path.join(self.base_path, 'L0002349_E0000002', 'a.xml'), 'w').close()
+        self.assertTrue(self.watcher.wait(1))
+
 class EmailChannelTestCase(unittest.TestCase):
     """Test para el manejo de mensajes por email"""
 
@@ -222,13 +490,13 @@ class EmailChannelTestCase(unittest.TestCase):
         self.assertEqual(emails['L0001562'], 'sinli@cuspide.com')
         self.assertEqual(emails['L0001563'], 'sinliarg@libreriahernandez.com.ar')
         self.assertTrue('Z0000000' not in emails)
-        self.assertListEqual(emails.values(), self.ch.sinli_emails.values())
+        self.assertListEqual(list(emails.values()), list(self.ch.sinli_emails.values()))
 
     def test_get_destination_address(self):
         """Verifica que se obtenga correctamente la direcciond de email
             a donde se debe enviar el mensaje
         """
-        xmldata = """<?xml version="1.0" encoding="utf-8"?>
+        xmldata = b"""<?xml version="1.0" encoding="utf-8"?>
                      <REMFAA>
                      <ARCHIVO>
                          <DESCRIPCION>Factura/Remito 0001-00336393</DESCRIPCION>
@@ -253,10 +521,18 @@ class EmailChannelTestCase(unittest.TestCase):
         self.assertEqual(self.ch.get_destination_address(ftp2email.SinliargMessage(xmldata)),
                          'fc@fierro-soft.com.ar')
 
+    def test_get_destination_key(self):
+        """Verifica que el corte de envios sea por dominio o por codigo si no tiene email
+        """
+        self.assertEqual(self.ch.get_destination_key(mock.Mock(dst_code='E0000001')),
+                         'fierro-soft.com.ar')
+        self.assertEqual(self.ch.get_destination_key(mock.Mock(dst_code='X0000001')),
+                         'X0000001')
+
     def test_gen_email_subject(self):
         """Verifica la generacion del asunto del email
         """
-        xmldata = """<?xml version="1.0" encoding="utf-8"?>
+        xmldata = b"""<?xml version="1.0" encoding="utf-8"?>
                      <REMFAA>
                      <ARCHIVO>
                          <DESCRIPCION>Factura/Remito 0001-00336393</DESCRIPCION>
@@ -284,7 +560,7 @@ class EmailChannelTestCase(unittest.TestCase):
     def test_gen_email_body(self):
         """Verifica la generacion del cuerpo del email
         """
-        xmldata = """<?xml version="1.0" encoding="utf-8"?>
+        xmldata = b"""<?xml version="1.0" encoding="utf-8"?>
                      <REMFAA>
                      <ARCHIVO>
                          <DESCRIPCION>Factura/Remito 0001-00336393</DESCRIPCION>
@@ -309,26 +585,292 @@ class EmailChannelTestCase(unittest.TestCase):
         self.assertEqual(self.ch.gen_email_body(ftp2email.SinliargMessage(xmldata)),
                             'Factura/Remito 0001-00336393')
 
+    def test_build_email_is_sinliarg(self):
+        """Verifica que los emails generados se reconozcan como sinliarg al leerlos
+            El receptor rechaza los emails con mas de una parte XML, el cuerpo va
+            como texto plano y el mensaje como unico adjunto XML
+        """
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            message = ftp2email.SinliargMessage(i.read())
+
+        email_data = emailParser().parsestr(self.ch.build_email(message)[1])
+
+        self.assertEqual([x.get_content_type() for x in email_data.walk()],
+                         ['multipart/mixed', 'text/plain', 'text/xml'])
+        self.assertTrue(self.ch.is_sinliarg(email_data))
+
+    def test_build_email_compressed(self):
+        """Verifica el envio comprimido por destino y la lectura transparente del adjunto
+        """
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            message = ftp2email.SinliargMessage(i.read(), filename='REMFAA_517.xml')
+
+        for method, content_type, filename in ((None, 'text/xml', 'REMFAA_517.xml'),
+                                               ('gzip', 'application/gzip', 'REMFAA_517.xml.gz'),
+                                               ('zip', 'application/zip', 'REMFAA_517.zip')):
+            self.ch.compression = {'E0000001': method} if method else {}
+            email_data = emailParser().parsestr(self.ch.build_email(message)[1])
+
+            self.assertTrue(self.ch.is_sinliarg(email_data))
+            email_part = self.ch.get_sinliarg_parts(email_data)[0]
+            self.assertEqual(email_part.get_content_type(), content_type)
+            self.assertEqual(email_part.get_filename(), filename)
+            self.assertEqual(self.ch.read_attachment(email_part), (message.xml, 'REMFAA_517.xml'))
+
+    def test_read_attachment_max_size(self):
+        """Verifica que se rechacen los adjuntos que descomprimidos superan el maximo
+            y que el mensaje se marque como erroneo
+        """
+        message = ftp2email.SinliargMessage(
+                    benchmark.gen_message('CATALOGO', 'L0002349', 'E0000001', items=50),
+                    filename='CATALOGO.xml')
+        for method in ('gzip', 'zip'):
+            self.ch.compression = {'E0000001': method}
+            email_part = self.ch.get_sinliarg_parts(
+                            emailParser().parsestr(self.ch.build_email(message)[1]))[0]
+            self.assertTrue(len(email_part.get_payload(decode=True)) < 10000)
+            self.ch.max_attachment_size = len(message.xml)
+            self.assertEqual(self.ch.read_attachment(email_part)[0], message.xml)
+            self.ch.max_attachment_size = 10000
+            self.assertRaises(ftp2email.AttachmentTooLarge, self.ch.read_attachment, email_part)
+
+        src_channel_mock = mock.Mock(create=True)
+        src_channel_mock.get_message.side_effect = ftp2email.AttachmentTooLarge('muy grande')
+        stats = ftp2email.PipeStats()
+        self.assertEqual(ftp2email.read_message(src_channel_mock, 'uid1', stats), None)
+        src_channel_mock.mark_message.assert_called_once_with('uid1', True)
+        self.assertEqual(stats.counters['failed'], 1)
+
     def test_send_message(self):
         """Verifica el envio del mensaje por email
         """
         data_file = os.path.join(self.test_path,
                                  'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
-        with open(data_file) as i:
+        with open(data_file, 'rb') as i:
             msg_data = i.read()
 
         with mock.patch('%s.ftp2email.smtplib.SMTP' % __name__) as smtp_mock:
-            smtpserver_mock = mock.Mock(create=True)
+            smtp_server = SmtpServerFake()
+            smtpserver_mock = mock.Mock(wraps=smtp_server)
             smtp_mock.return_value = smtpserver_mock
             try:
                 self.ch.send_message(ftp2email.SinliargMessage(msg_data))
             except Exception:
                 self.fail('Unexpected exception: %s' % traceback.format_exc())
 
-            smtp_mock.assert_called_once_with('smtpserver', port=None, timeout=5)
+            smtp_mock.assert_called_once_with('smtpserver', port=None, timeout=30)
             smtpserver_mock.login.assert_called_once_with('u', 'p')
-            self.assertEqual(smtpserver_mock.sendmail.call_count, 1)
-            self.assertEqual(smtpserver_mock.close.call_count, 1)
+            self.assertEqual(len(smtp_server.emails), 1)
+            self.assertEqual(smtp_server.emails[0][:2],
+                             ('test@example.com', 'fc@fierro-soft.com.ar'))
+            email_data = emailParser().parsestr(smtp_server.emails[0][2])
+            self.assertEqual([x.get_payload(decode=True) for x in email_data.walk()][-1],
+                             msg_data)
+
+            # la conexion se reusa en los envios siguientes y se cierra con el canal
+            self.ch.send_message(ftp2email.SinliargMessage(msg_data))
+            self.assertEqual(smtp_mock.call_count, 1)
+            self.assertEqual(len(smtp_server.emails), 2)
+            self.assertTrue(not smtpserver_mock.quit.called)
+            self.ch.close()
+            smtpserver_mock.quit.assert_called_once_with()
+            self.assertEqual(self.ch.smtp_connections, 1)
+            self.assertEqual(self.ch.sent_messages, 2)
+
+    def test_send_message_batch(self):
+        """Verifica que los mensajes a una misma direccion se envien en lotes
+        """
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            msg_data = i.read()
+        messages = [ftp2email.SinliargMessage(msg_data, filename='REMFAA_%d.xml' % x)
+                    for x in range(5)]
+        self.ch.batch = {'max_messages': 2}
+
+        with mock.patch('%s.ftp2email.smtplib.SMTP' % __name__) as smtp_mock:
+            smtp_server = SmtpServerFake()
+            smtpserver_mock = mock.Mock(wraps=smtp_server)
+            smtp_mock.return_value = smtpserver_mock
+
+            self.assertEqual(self.ch.send_message(messages[0]), [])
+            self.assertEqual(len(smtp_server.emails), 0)
+            self.assertEqual(self.ch.send_message(messages[1]),
+                             [(messages[0], None), (messages[1], None)])
+            self.assertEqual(len(smtp_server.emails), 1)
+            for message in messages[2:]:
+                self.ch.send_message(message)
+            self.assertEqual(self.ch.flush(), [(messages[4], None)])
+            self.assertEqual(len(smtp_server.emails), 3)
+
+            # el email del lote tiene un adjunto por mensaje
+            batch_email = emailParser().parsestr(smtp_server.emails[0][2])
+            self.assertTrue(self.ch.is_sinliarg(batch_email))
+            self.assertEqual([x.get_filename() for x in self.ch.get_sinliarg_parts(batch_email)],
+                             ['REMFAA_0.xml', 'REMFAA_1.xml'])
+            self.assertIn('Mensajes: 2', batch_email['subject'])
+
+            # un mensaje de otro tipo a la misma direccion va en otro lote
+            # y el lote pendiente se envia antes
+            pedido = ftp2email.SinliargMessage(msg_data.replace(b'REMFAA', b'PEDIDO'),
+                                               filename='PEDIDO_0.xml')
+            self.assertEqual(self.ch.send_message(messages[0]), [])
+            self.assertEqual(self.ch.send_message(pedido), [(messages[0], None)])
+            self.assertEqual(list(self.ch.batches), [('fc@fierro-soft.com.ar', 'PEDIDO')])
+            self.assertEqual([x[0].filename for x in self.ch.flush()], ['PEDIDO_0.xml'])
+            self.assertEqual(len(smtp_server.emails), 5)
+
+            # si falla el envio se devuelve el error de cada mensaje del lote
+            error = ftp2email.smtplib.SMTPException('error')
+            smtpserver_mock.mail.side_effect = error
+            self.ch.send_message(messages[0])
+            self.assertEqual(self.ch.send_message(messages[1]),
+                             [(messages[0], error), (messages[1], error)])
+
+    def test_send_message_batch_order(self):
+        """Verifica que un lote de REMITO no se envie antes que el PEDIDO anterior
+            a la misma direccion
+        """
+        messages = [ftp2email.SinliargMessage(
+                        benchmark.gen_message(sinli_type, 'L0002349', 'E0000001', nro=nro),
+                        filename='%s_%d.xml' % (sinli_type, nro))
+                    for nro, sinli_type in enumerate(['PEDIDO', 'REMITO', 'REMITO'])]
+        self.ch.batch = {'max_messages': 2}
+
+        with mock.patch('%s.ftp2email.smtplib.SMTP' % __name__) as smtp_mock:
+            smtp_server = SmtpServerFake()
+            smtp_mock.return_value = smtp_server
+            results = []
+            for message in messages:
+                results.extend(self.ch.send_message(message))
+            results.extend(self.ch.flush())
+
+        self.assertEqual([x[0].filename for x in results],
+                         ['PEDIDO_0.xml', 'REMITO_1.xml', 'REMITO_2.xml'])
+        sent = [[x.get_filename() for x in self.ch.get_sinliarg_parts(emailParser().parsestr(
+                    y[2]))] for y in smtp_server.emails]
+        self.assertEqual(sent, [['PEDIDO_0.xml'], ['REMITO_1.xml', 'REMITO_2.xml']])
+
+    def test_load_messages_batch(self):
+        """Verifica que cada adjunto de un email sea un mensaje y que el email
+            se elimine cuando se marcaron todos
+        """
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            msg_data = i.read()
+        messages = [ftp2email.SinliargMessage(msg_data, filename='REMFAA_%d.xml' % x)
+                    for x in range(3)]
+        email_data = self.ch.build_batch_email('fc@fierro-soft.com.ar', messages).encode('utf-8')
+
+        with mock.patch('%s.ftp2email.poplib.POP3' % __name__, autospec=True) as pop3_mock:
+            pop3srv = pop3_mock.return_value
+            pop3srv.uidl.return_value = ('+OK', [b'1 uid1'], 0)
+            pop3srv.top.side_effect = poplib.error_proto('-ERR')
+            pop3srv.retr.return_value = ('+OK', email_data.split(b'\n'), len(email_data))
+
+            msg_ids = list(self.ch.load_messages())
+            self.assertEqual(msg_ids, ['uid1 0', 'uid1 1', 'uid1 2'])
+            self.assertEqual([self.ch.get_message(x).filename for x in msg_ids],
+                             ['REMFAA_0.xml', 'REMFAA_1.xml', 'REMFAA_2.xml'])
+            self.assertEqual(self.ch.get_message(msg_ids[1]).xml, msg_data)
+
+            self.ch.mark_message(msg_ids[0])
+            self.ch.mark_message(msg_ids[2])
+            self.assertEqual(self.ch.pending_deletes, [])
+            self.ch.mark_message(msg_ids[1])
+            self.assertEqual(self.ch.pending_deletes, ['uid1'])
+
+    def test_send_message_daemon_cycles(self):
+        """Verifica que los threads de cada ciclo del daemon reusen las conexiones
+            smtp del ciclo anterior en lugar de abrir otras
+        """
+        messages = dict((x, ftp2email.SinliargMessage(
+                                benchmark.gen_message('PEDIDO', 'L%07d' % (2349 + x % 4),
+                                                      'E0000001', items=1, nro=x + 1)))
+                        for x in range(8))
+        with mock.patch('%s.ftp2email.smtplib.SMTP' % __name__) as smtp_mock:
+            smtp_mock.side_effect = lambda *args, **kwargs: mock.Mock(wraps=SmtpServerFake())
+            for cycle in range(4):
+                src_channel_mock = mock.Mock(create=True)
+                src_channel_mock.load_messages.return_value = sorted(messages)
+                src_channel_mock.get_message.side_effect = lambda x: messages[x]
+                stats = ftp2email.pipeChannels(src_channel_mock, self.ch, workers=2,
+                                               close_dst=False)
+                self.assertEqual(stats.counters['sent'], 8)
+                self.assertLessEqual(len(self.ch.smtp_servers), 2)
+            self.assertLessEqual(smtp_mock.call_count, 2)
+            servers = list(self.ch.smtp_servers)
+            self.ch.close()
+        self.assertTrue(all(x.quit.called for x in servers))
+        self.assertEqual((self.ch.smtp_servers, self.ch.smtp_idle), ([], []))
+
+    def test_send_message_reconnect(self):
+        """Verifica que se reconecte si el servidor cerro la conexion
+        """
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            msg_data = i.read()
+
+        with mock.patch('%s.ftp2email.smtplib.SMTP' % __name__) as smtp_mock:
+            dropped_mock = mock.Mock(wraps=SmtpServerFake())
+            dropped_mock.mail.side_effect = ftp2email.smtplib.SMTPServerDisconnected()
+            smtp_server = SmtpServerFake()
+            smtp_mock.side_effect = [dropped_mock, smtp_server]
+
+            self.ch.send_message(ftp2email.SinliargMessage(msg_data))
+            self.assertEqual(smtp_mock.call_count, 2)
+            self.assertEqual(len(smtp_server.emails), 1)
+            self.assertEqual(self.ch.smtp_connections, 2)
+            self.assertEqual(self.ch.sent_messages, 1)
+
+    def test_send_message_reconnect_after_data(self):
+        """Verifica que solo se reintente si la conexion se perdio antes de terminar
+            el comando DATA, despues el servidor pudo haber recibido el email
+        """
+        message = ftp2email.SinliargMessage(
+                    benchmark.gen_message('PEDIDO', 'L0002349', 'E0000001'))
+        disconnected = ftp2email.smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+        def getreply_after_data(server):
+            # 354 al comando DATA y se corta la conexion esperando la respuesta final
+            replies = [(354, b'OK'), disconnected]
+
+            def getreply():
+                reply = replies.pop(0)
+                if isinstance(reply, Exception):
+                    raise reply
+                return reply
+            server.getreply = getreply
+            return server
+
+        def failing_send(server, error):
+            server.send = mock.Mock(side_effect=error)
+            return server
+
+        def reply_421(server):
+            server.mail = mock.Mock(return_value=(421, b'timeout'))
+            return server
+
+        for first_server, resent in ((getreply_after_data(SmtpServerFake()), False),
+                                     (failing_send(SmtpServerFake(), socket.error()), True),
+                                     (reply_421(SmtpServerFake()), True)):
+            with mock.patch('%s.ftp2email.smtplib.SMTP' % __name__) as smtp_mock:
+                smtp_server = SmtpServerFake()
+                smtp_mock.side_effect = [first_server, smtp_server]
+                if resent:
+                    self.ch.send_message(message)
+                else:
+                    self.assertRaises(ftp2email.SMTPDeliveryUnknown, self.ch.send_message,
+                                      message)
+                self.assertEqual(smtp_mock.call_count, 2 if resent else 1)
+                self.assertEqual(len(smtp_server.emails), 1 if resent else 0)
+            self.ch.close()
 
     @mock.patch('%s.ftp2email.poplib.POP3' % __name__, autospec=True)
     def test_get_pop_server(self, pop3_mock):
@@ -356,18 +898,21 @@ class EmailChannelTestCase(unittest.TestCase):
         """Verifica que se lean correctamente los mensajes desde el servidor pop
         """
 
-        # sin emails sinliarg
+        # sin emails sinliarg, servidor sin soporte para TOP
         pop3srv = pop3_mock.return_value
-        pop3srv.uidl.return_value = ('+OK', ['1 00000010506477be', '2 00000011506477be'],
+        pop3srv.top.side_effect = poplib.error_proto('-ERR')
+        pop3srv.uidl.return_value = ('+OK', [b'1 00000010506477be', b'2 00000011506477be'],
                                         40)
         pop3srv.retr = mock.Mock(wraps=lambda uid: {'1': '', '2': ''}[uid])
         self.assertEqual(len(self.ch.load_messages()), 0)
         pop3srv.uidl.assert_called_once_with()
         pop3srv.retr.assert_has_calls([mock.call('1'), mock.call('2')])
+        self.assertTrue(not pop3srv.quit.called)
+        self.ch.close()
         pop3srv.quit.assert_called_once_with()
 
         # con un email sinliarg
-        with open(os.path.join(self.test_path, 'email_sinliarg')) as i:
+        with open(os.path.join(self.test_path, 'email_sinliarg'), 'rb') as i:
             email_sinliarg = i.read().splitlines()
         pop3srv.retr = mock.Mock(wraps=lambda uid: {'1': ('+OK', email_sinliarg, 1),
                                                     '2': ''}[uid])
@@ -379,6 +924,64 @@ class EmailChannelTestCase(unittest.TestCase):
         self.assertEqual(len(self.ch.load_messages()), 0)
         self.assertTrue(not pop3srv.retr.called)
 
+    @mock.patch('%s.ftp2email.poplib.POP3' % __name__, autospec=True)
+    def test_load_messages_seen_uids(self, pop3_mock):
+        """Verifica que los emails no sinliarg se descarten por encabezado y se recuerden
+        """
+        tmp_path = tempfile.mkdtemp()
+        self.ch.pop_settings['seen_file'] = os.path.join(tmp_path, 'seen')
+        with open(os.path.join(self.test_path, 'email_sinliarg'), 'rb') as i:
+            email_sinliarg = i.read().splitlines()
+        headers = {'1': email_sinliarg[:email_sinliarg.index(b'')],
+                   '2': [b'Subject: publicidad']}
+        pop3srv = pop3_mock.return_value
+        pop3srv.uidl.return_value = ('+OK', [b'1 00000010506477be', b'2 00000011506477be'],
+                                        40)
+        pop3srv.top = mock.Mock(wraps=lambda nro, lines: ('+OK', headers[nro], 1))
+        pop3srv.retr.return_value = ('+OK', email_sinliarg, 1)
+        try:
+            self.assertEqual(list(self.ch.load_messages()), ['00000010506477be'])
+            pop3srv.retr.assert_called_once_with('1')
+            with open(self.ch.pop_settings['seen_file']) as i:
+                self.assertEqual(i.read(), '00000011506477be\n')
+
+            # en la siguiente lectura el email ya clasificado no se consulta
+            pop3srv.top.reset_mock()
+            self.assertEqual(list(self.ch.load_messages()), ['00000010506477be'])
+            pop3srv.top.assert_called_once_with('1', 0)
+        finally:
+            shutil.rmtree(tmp_path)
+
+    @mock.patch('%s.ftp2email.poplib.POP3' % __name__, autospec=True)
+    def test_load_messages_spool(self, pop3_mock):
+        """Verifica que los emails se guarden en el spool y se lean desde disco
+        """
+        tmp_path = tempfile.mkdtemp()
+        self.ch.pop_settings['spool_dir'] = os.path.join(tmp_path, 'spool')
+        with open(os.path.join(self.test_path, 'email_sinliarg'), 'rb') as i:
+            email_sinliarg = i.read().splitlines()
+        pop3srv = pop3_mock.return_value
+        pop3srv.uidl.return_value = ('+OK', [b'1 00000010506477be'], 40)
+        pop3srv.top.side_effect = poplib.error_proto('-ERR')
+        pop3srv.retr.return_value = ('+OK', email_sinliarg, 1)
+        try:
+            msg_ids = self.ch.load_messages()
+            self.assertTrue(not pop3srv.retr.called)
+            self.assertEqual(next(msg_ids), '00000010506477be')
+            self.assertEqual(self.ch.messages, {})
+            spool_file = self.ch.get_spool_file('00000010506477be')
+            self.assertTrue(os.path.isfile(spool_file))
+            self.assertTrue(isinstance(self.ch.get_message('00000010506477be'),
+                                       ftp2email.SinliargMessage))
+            self.assertEqual(list(msg_ids), [])
+
+            # al eliminar el email del servidor se borra del spool
+            self.ch.mark_message('00000010506477be')
+            self.ch.close()
+            self.assertTrue(not os.path.isfile(spool_file))
+        finally:
+            shutil.rmtree(tmp_path)
+
     def test_get_message(self):
         """Verifica que devuelva el mensaje cargado
         """
@@ -398,19 +1001,745 @@ class EmailChannelTestCase(unittest.TestCase):
         """Verifica que se marque el mensaje como leido
         """
         pop3srv = pop3_mock.return_value
-        pop3srv.uidl.return_value = ('+OK', ['1 00000010506477be', '2 00000011506477be'],
+        pop3srv.uidl.return_value = ('+OK', [b'1 00000010506477be', b'2 00000011506477be'],
                                         40)
         self.assertTrue(self.ch.mark_message('00000010506477be'))
-        pop3srv.dele.assert_called_once_with('1')
-        pop3srv.quit.assert_called_once_with()
-
-        pop3srv.dele.reset_mock()
         self.assertTrue(self.ch.mark_message('00000011506477be'))
-        pop3srv.dele.assert_called_once_with('2')
-
-        pop3srv.dele.reset_mock()
         self.assertTrue(not self.ch.mark_message('99900011506477be'))
+
+        # una sola conexion y los emails se eliminan al cerrar el canal
         self.assertTrue(not pop3srv.dele.called)
+        self.ch.close()
+        pop3_mock.assert_called_once_with('popserver', port=110)
+        pop3srv.uidl.assert_called_once_with()
+        pop3srv.dele.assert_has_calls([mock.call('1'), mock.call('2')])
+        self.assertEqual(pop3srv.dele.call_count, 2)
+        pop3srv.quit.assert_called_once_with()
+
+    def test_mark_message_reconnect(self):
+        """Verifica que si se pierde la sesion al eliminar se cierre antes de
+            abrir otra y se vuelvan a eliminar todos los emails
+        """
+        lost, retry = [mock.create_autospec(poplib.POP3, instance=True) for x in range(2)]
+        lost.uidl.return_value = ('+OK', [b'1 00000010506477be', b'2 00000011506477be'], 40)
+        lost.dele.side_effect = ['+OK', socket.error('connection reset')]
+        lost.quit.side_effect = socket.error('connection reset')
+        retry.uidl.return_value = ('+OK', [b'3 00000010506477be', b'4 00000011506477be'], 40)
+        with mock.patch('%s.ftp2email.poplib.POP3' % __name__,
+                        side_effect=[lost, retry]) as pop3_mock:
+            self.assertTrue(self.ch.mark_message('00000010506477be'))
+            self.assertTrue(self.ch.mark_message('00000011506477be'))
+            self.ch.close()
+
+        lost.close.assert_called_once_with()
+        self.assertEqual(pop3_mock.call_count, 2)
+        retry.dele.assert_has_calls([mock.call('3'), mock.call('4')])
+        retry.quit.assert_called_once_with()
+        self.assertEqual((self.ch.pop_server, self.ch.pending_deletes), (None, []))
+
+    @mock.patch('%s.ftp2email.poplib.POP3' % __name__, autospec=True)
+    def test_mark_message_error(self, pop3_mock):
+        """Verifica que un email erroneo se guarde sin volver a descargarlo
+        """
+        pop3srv = pop3_mock.return_value
+        pop3srv.uidl.return_value = ('+OK', [b'1 00000010506477be'], 40)
+        with open(os.path.join(self.test_path, 'email_sinliarg'), 'rb') as i:
+            email_lines = i.read().splitlines()
+        pop3srv.top.side_effect = poplib.error_proto('-ERR')
+        pop3srv.retr.return_value = ('+OK', email_lines, 1)
+        self.assertEqual(len(self.ch.load_messages()), 1)
+
+        base_path = tempfile.mkdtemp()
+        try:
+            self.ch.error_path = os.path.join(base_path, 'not_well_formed_emails')
+            self.assertTrue(self.ch.mark_message('00000010506477be', error=True))
+            self.assertEqual(pop3srv.retr.call_count, 1)
+            with open(os.path.join(base_path, 'not_well_formed_emails',
+                                   '00000010506477be.msg'), 'rb') as i:
+                self.assertEqual(i.read(), b'\n'.join(email_lines))
+        finally:
+            shutil.rmtree(base_path)
+
+
+class ImapChannelTestCase(unittest.TestCase):
+    """Test para la lectura de emails por imap contra el servidor local de benchmark"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                        'data')
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.mailbox = benchmark.Mailbox(os.path.join(self.tmp_path, 'inbox'))
+        self.server = benchmark.BenchmarkServer(benchmark.ImapHandler, self.mailbox).start()
+        self.imap_settings = {'host': '127.0.0.1', 'port': self.server.port,
+                              'user': 'u', 'pass': 'p'}
+        self.ch = ftp2email.ImapChannel(smtp_settings={}, imap_settings=self.imap_settings,
+                                        msg_from='test@example.com',
+                                        eaddress_file=os.path.join(self.test_path,
+                                                                   'email_address.csv'))
+        data_file = os.path.join(self.test_path,
+                                 'L0002349_E0000001/REMFAA_L0002349_E0000001_517.xml')
+        with open(data_file, 'rb') as i:
+            self.msg_data = i.read()
+
+    def tearDown(self):
+        self.ch.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp_path)
+
+    def add_emails(self):
+        """Agrega a la casilla un email con un mensaje, uno con tres, uno con asunto
+            sinliarg sin adjuntos y uno que no es sinliarg
+        """
+        message = ftp2email.SinliargMessage(self.msg_data, filename='REMFAA.xml')
+        self.mailbox.add(self.ch.build_email(message)[1].encode('utf-8'))
+        messages = [ftp2email.SinliargMessage(self.msg_data, filename='REMFAA_%d.xml' % x)
+                    for x in range(3)]
+        self.mailbox.add(self.ch.build_batch_email('fc@fierro-soft.com.ar', messages)
+                         .encode('utf-8'))
+        self.mailbox.add(b'Subject: SINLIARG: consulta\r\n\r\nsin adjuntos\r\n')
+        self.mailbox.add(b'Subject: otro\r\n\r\n' + self.msg_data)
+
+    def test_parse_response(self):
+        """Verifica la lectura de listas, strings, literales y NIL
+        """
+        data = [(b'1 (UID 7 BODY[2.MIME] {5}', b'a "b)'), b' BODYSTRUCTURE ("x\\"y" NIL))']
+        self.assertEqual(self.ch.parse_response(data),
+                         [1, [b'UID', 7, b'BODY[2.MIME]', b'a "b)',
+                              b'BODYSTRUCTURE', [b'x"y', None]]])
+
+    def test_load_messages(self):
+        """Verifica que solo se lean los emails sinliarg y sus partes con XML
+        """
+        self.add_emails()
+        msg_ids = self.ch.load_messages()
+        self.assertEqual(msg_ids, ['1', '2 0', '2 1', '2 2'])
+        self.assertEqual(self.ch.imap_parts, {'1': ['2'], '2': ['2', '3', '4']})
+        self.assertEqual([self.ch.get_message(x).filename for x in msg_ids],
+                         ['REMFAA.xml', 'REMFAA_0.xml', 'REMFAA_1.xml', 'REMFAA_2.xml'])
+        self.assertEqual(self.ch.get_message('2 1').xml, self.msg_data)
+        # el email sin adjuntos se marca para no volver a leerlo
+        self.assertEqual(self.mailbox.flags, {'00000003': set(['$SinliargProcesado'])})
+
+    def test_mark_message(self):
+        """Verifica que los emails procesados se marquen y no se vuelvan a leer
+        """
+        self.add_emails()
+        msg_ids = self.ch.load_messages()
+        for msg_id in msg_ids[:3]:
+            self.assertTrue(self.ch.mark_message(msg_id))
+        self.assertFalse(self.ch.mark_message('99'))
+        self.ch.close()
+
+        self.assertEqual(self.ch.load_messages(), ['2 0', '2 1', '2 2'])
+        self.assertEqual(len(self.mailbox.list()), 4)
+
+    def test_mark_message_move(self):
+        """Verifica que los emails se muevan a 'processed_mailbox' o 'error_mailbox'
+        """
+        self.imap_settings.update(processed_mailbox='Procesados', error_mailbox='Errores')
+        self.ch.error_path = os.path.join(self.tmp_path, 'not_well_formed_emails')
+        self.add_emails()
+        self.ch.mark_message(self.ch.load_messages()[0])
+        self.ch.close()
+        # sin MOVE se copia el email y se elimina al cerrar el canal
+        self.server.RequestHandlerClass.capabilities = 'IMAP4rev1'
+        try:
+            msg_ids = self.ch.load_messages()
+            self.assertEqual(msg_ids, ['2 0', '2 1', '2 2'])
+            self.ch.mark_message(msg_ids[0], error=True)
+            self.ch.mark_message(msg_ids[1])
+            self.ch.mark_message(msg_ids[2])
+            self.ch.close()
+        finally:
+            del self.server.RequestHandlerClass.capabilities
+
+        self.assertEqual(os.listdir(os.path.join(self.mailbox.path, 'Procesados')),
+                         ['00000001'])
+        self.assertEqual(os.listdir(os.path.join(self.mailbox.path, 'Errores')),
+                         ['00000002'])
+        self.assertEqual(os.listdir(os.path.join(self.tmp_path, 'not_well_formed_emails')),
+                         ['2.msg'])
+        self.assertEqual([x[0] for x in self.mailbox.list()], ['00000003', '00000004'])
+
+    def test_idle(self):
+        """Verifica que IDLE termine cuando llega un email
+        """
+        self.assertFalse(self.ch.idle(0.2))
+        timer = ftp2email.threading.Timer(0.2, self.add_emails)
+        timer.start()
+        start = time.time()
+        self.assertTrue(self.ch.idle(10))
+        self.assertTrue(time.time() - start < 5)
+        timer.join()
+        # la conexion sigue siendo usable despues de IDLE
+        self.assertEqual(len(self.ch.load_messages()), 4)
+
+
+class StreamedEmailTestCase(unittest.TestCase):
+    """Test para el envio de mensajes grandes leidos del disco a medida que se envian"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                        'data')
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.mailbox = benchmark.Mailbox(os.path.join(self.tmp_path, 'inbox'))
+        self.server = benchmark.BenchmarkServer(benchmark.SmtpHandler, self.mailbox).start()
+        self.ch = ftp2email.EmailChannel(smtp_settings={'host': '127.0.0.1',
+                                                        'port': self.server.port,
+                                                        'user': None},
+                                         pop_settings={},
+                                         msg_from='test@example.com',
+                                         eaddress_file=os.path.join(self.test_path,
+                                                                    'email_address.csv'))
+        self.data_file = os.path.join(self.tmp_path, 'CATALOGO_E0000001.xml')
+        with open(self.data_file, 'wb') as o:
+            o.write(benchmark.gen_message('CATALOGO', 'L0002349', 'E0000001', items=2000))
+
+    def tearDown(self):
+        self.ch.close()
+        self.server.stop()
+        shutil.rmtree(self.tmp_path)
+
+    def received_emails(self):
+        return [emailParser().parsestr(self.mailbox.read(uid).decode('ascii'))
+                for uid, size in self.mailbox.list()]
+
+    def test_sinliarg_file(self):
+        """Verifica que el mensaje leido del disco sea igual al leido en memoria
+        """
+        with open(self.data_file, 'rb') as i:
+            message = ftp2email.SinliargMessage(i.read(), filename='CATALOGO_E0000001.xml')
+        for use_mmap in (False, True):
+            file_message = ftp2email.SinliargFile(self.data_file, use_mmap=use_mmap)
+            for attr in ('src_code', 'dst_code', 'sinli_type', 'filename', 'size'):
+                self.assertEqual(getattr(file_message, attr), getattr(message, attr))
+            chunks = list(file_message.iter_chunks(chunk_size=10000))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(b''.join(chunks), message.xml)
+            self.assertEqual(file_message.content_digest(), message.content_digest())
+            self.assertEqual(len(list(file_message.iter_items())), 2000)
+
+        ch = ftp2email.FilesystemChannel(self.tmp_path, '.', stream_size=message.size)
+        self.assertTrue(isinstance(ch.get_message(self.data_file), ftp2email.SinliargFile))
+        ch.stream_size += 1
+        self.assertFalse(isinstance(ch.get_message(self.data_file), ftp2email.SinliargFile))
+
+    def test_send_message(self):
+        """Verifica que el email enviado por partes se lea igual que el armado en memoria
+        """
+        message = ftp2email.SinliargFile(self.data_file)
+        with open(self.data_file, 'rb') as i:
+            xml = i.read()
+        for method in (None, 'gzip', 'zip'):
+            self.ch.compression = {'E0000001': method} if method else {}
+            email_data = self.ch.build_email(message)[1]
+            self.assertEqual(isinstance(email_data, ftp2email.StreamedEmail), method != 'zip')
+            self.ch.send_message(message)
+        self.ch.compression = {}
+        self.ch.send_email('fc@fierro-soft.com.ar', self.ch.build_batch_email(
+                           'fc@fierro-soft.com.ar',
+                           [message, ftp2email.SinliargMessage(xml, filename='CATALOGO_2.xml')]))
+
+        emails = self.received_emails()
+        self.assertEqual(len(emails), 4)
+        for email_data, filename in zip(emails, ('CATALOGO_E0000001.xml',
+                                                 'CATALOGO_E0000001.xml.gz',
+                                                 'CATALOGO_E0000001.zip')):
+            self.assertTrue(self.ch.is_sinliarg(email_data))
+            email_part = self.ch.get_sinliarg_parts(email_data)[0]
+            self.assertEqual(email_part.get_filename(), filename)
+            self.assertEqual(self.ch.read_attachment(email_part),
+                             (xml, 'CATALOGO_E0000001.xml'))
+        self.assertEqual([self.ch.read_attachment(x) for x in self.ch.get_sinliarg_parts(emails[3])],
+                         [(xml, 'CATALOGO_E0000001.xml'), (xml, 'CATALOGO_2.xml')])
+
+    def test_send_memory(self):
+        """Verifica que la memoria usada al enviar no dependa del tamaño del archivo
+        """
+        try:
+            import tracemalloc
+        except ImportError:  # python2
+            return
+
+        class SmtpServer(object):
+            """Conexion smtp que solo cuenta los bytes enviados"""
+            sent = 0
+
+            def ehlo_or_helo_if_needed(self):
+                pass
+
+            def mail(self, sender):
+                return 250, b'OK'
+
+            def rcpt(self, recipient):
+                return 250, b'OK'
+
+            def putcmd(self, command):
+                self.replies = [(354, b'OK'), (250, b'OK')]
+
+            def getreply(self):
+                return self.replies.pop(0)
+
+            def send(self, data):
+                self.sent += len(data)
+
+        with open(self.data_file, 'ab') as o:
+            o.write(b'<!-- %s -->' % (b'x' * 20000000))
+        message = ftp2email.SinliargFile(self.data_file)
+        for method in (None, 'gzip'):
+            self.ch.compression = {'E0000001': method} if method else {}
+            smtp_server = SmtpServer()
+            tracemalloc.start()
+            try:
+                self.ch.deliver(smtp_server, 'fc@fierro-soft.com.ar',
+                                self.ch.build_email(message)[1])
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            self.assertTrue(peak < 2000000, peak)
+            self.assertTrue(smtp_server.sent > 0)
+
+
+class DuplicateIndexTestCase(unittest.TestCase):
+    """Test para el indice de mensajes duplicados"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.dedup = ftp2email.DuplicateIndex(os.path.join(self.tmp_path, 'dedup.sqlite'))
+
+    def tearDown(self):
+        self.dedup.close()
+        shutil.rmtree(self.tmp_path)
+
+    def message(self, identifier, body=b''):
+        return mock.Mock(src_code='E0000001', identifier=identifier,
+                         content_digest=lambda: ftp2email.hashlib.sha1(body).hexdigest())
+
+    def is_duplicate(self, message):
+        if not self.dedup.reserve(message):
+            return True
+        self.dedup.release(message)
+        return False
+
+    def test_is_duplicate(self):
+        """Verifica que se reconozcan duplicados por identificador y por contenido
+        """
+        self.assertFalse(self.is_duplicate(self.message('PE1', b'a')))
+        self.dedup.add(self.message('PE1', b'a'))
+        self.assertTrue(self.is_duplicate(self.message('PE1', b'b')))
+        self.assertTrue(self.is_duplicate(self.message(None, b'a')))
+        self.assertFalse(self.is_duplicate(self.message('PE2', b'b')))
+
+        # el mismo identificador o el mismo contenido de otro origen no es duplicado
+        for other_src in (self.message('PE1', b'c'), self.message(None, b'a')):
+            other_src.src_code = 'E0000002'
+            self.assertFalse(self.is_duplicate(other_src))
+
+    def test_reserve(self):
+        """Verifica que un mensaje en envio sea duplicado hasta que se libere o registre
+        """
+        sending = self.message('PE1', b'a')
+        self.assertTrue(self.dedup.reserve(sending))
+        self.assertFalse(self.dedup.reserve(self.message('PE1', b'b')))
+        self.assertTrue(self.is_duplicate(self.message(None, b'a')))
+        self.dedup.release(sending)
+        self.assertFalse(self.is_duplicate(self.message('PE1', b'a')))
+
+        self.assertTrue(self.dedup.reserve(sending))
+        self.dedup.add(sending)
+        self.assertEqual(self.dedup.reserved, {})
+        self.assertFalse(self.dedup.reserve(self.message('PE1', b'b')))
+        self.assertTrue(self.is_duplicate(self.message(None, b'a')))
+
+    def test_prune(self):
+        """Verifica que se eliminen las entradas viejas
+        """
+        with mock.patch('%s.ftp2email.time.time' % __name__, return_value=0):
+            self.dedup.add(self.message('PE1', b'a'))
+        self.dedup.add(self.message('PE2', b'b'))
+        self.assertEqual(self.dedup.prune(30), 2)
+        self.assertFalse(self.is_duplicate(self.message('PE1', b'a')))
+        self.assertTrue(self.is_duplicate(self.message('PE2', b'b')))
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Test para las estadisticas y metricas de los envios"""
+
+    def message(self, sinli_type, dst_code):
+        xml = b'<%s/>' % sinli_type.encode('ascii')
+        return mock.Mock(sinli_type=sinli_type, src_code='L0002349', dst_code=dst_code,
+                         xml=xml, size=len(xml))
+
+    def run_stats(self):
+        stats = ftp2email.PipeStats()
+        for message in (self.message('PEDIDO', 'E0000001'), self.message('PEDIDO', 'E0000001'),
+                        self.message('REMITO', 'E0000002')):
+            stats.count('read', message)
+            stats.count('sent', message)
+        stats.count('failed')
+        stats.record('send', 0.003)
+        stats.record('send', 0.2)
+        stats.add_connections({'smtp': 1}, {'smtp': 3, 'pop': 1})
+        stats.finish()
+        return stats
+
+    def test_pipe_stats(self):
+        """Verifica los contadores por tipo y socio, los bytes y los histogramas
+        """
+        summary = self.run_stats().as_dict()
+
+        self.assertEqual(summary['counters']['sent'], 3)
+        self.assertEqual(summary['counters']['bytes_sent'], len(b'<PEDIDO/>') * 2 + len(b'<REMITO/>'))
+        self.assertEqual(summary['connections'], {'smtp': 2, 'pop': 1})
+        self.assertEqual(summary['messages'],
+                         [{'type': '', 'src': '', 'dst': '', 'failed': 1},
+                          {'type': 'PEDIDO', 'src': 'L0002349', 'dst': 'E0000001',
+                           'read': 2, 'sent': 2},
+                          {'type': 'REMITO', 'src': 'L0002349', 'dst': 'E0000002',
+                           'read': 1, 'sent': 1}])
+        buckets = summary['latency']['send']['buckets']
+        self.assertEqual((buckets['0.005'], buckets['0.25'], buckets['+Inf']), (1, 1, 0))
+
+    def test_prometheus(self):
+        """Verifica el formato de las metricas acumuladas
+        """
+        metrics = ftp2email.Metrics()
+        metrics.add('files->emails', self.run_stats())
+        metrics.add('files->emails', self.run_stats())
+
+        lines = metrics.prometheus().splitlines()
+
+        self.assertIn('# TYPE sinliarg_stage_duration_seconds histogram', lines)
+        self.assertIn('sinliarg_messages_total{direction="files->emails",status="sent",'
+                      'type="PEDIDO",src="L0002349",dst="E0000001"} 4', lines)
+        self.assertIn('sinliarg_connections_total{direction="files->emails",'
+                      'protocol="smtp"} 4', lines)
+        self.assertIn('sinliarg_stage_duration_seconds_bucket{direction="files->emails",'
+                      'stage="send",le="0.01"} 2', lines)
+        self.assertIn('sinliarg_stage_duration_seconds_bucket{direction="files->emails",'
+                      'stage="send",le="+Inf"} 4', lines)
+        self.assertIn('sinliarg_stage_duration_seconds_count{direction="files->emails",'
+                      'stage="send"} 4', lines)
+        self.assertIn('sinliarg_runs_total{direction="files->emails"} 2', lines)
+
+    def test_http_server(self):
+        """Verifica que las metricas se sirvan por http
+        """
+        try:
+            from urllib.request import urlopen
+        except ImportError:  # python2
+            from urllib2 import urlopen
+        metrics = ftp2email.Metrics()
+        metrics.add('emails->files', self.run_stats())
+        server = metrics.start_http_server(0)
+        try:
+            response = urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1])
+            self.assertEqual(response.read().decode('utf-8'), metrics.prometheus())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class RunJournalTestCase(unittest.TestCase):
+    """Test para el registro de ejecucion"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_path, 'registro.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_replay(self):
+        """Verifica que al reabrir el registro queden solo los mensajes sin terminar
+        """
+        journal = ftp2email.RunJournal(self.filename)
+        for msg_id in ('a', 'b', 'c'):
+            journal.record('canal', msg_id, 'read')
+        journal.record('canal', 'a', 'sent')
+        journal.record('canal', 'a', 'marked')
+        journal.record('canal', 'b', 'sent')
+        journal.sync()
+        # una interrupcion durante la escritura deja la ultima linea incompleta
+        with open(self.filename, 'ab') as o:
+            o.write(b'["canal", "c", "se')
+
+        journal = ftp2email.RunJournal(self.filename)
+        self.assertEqual([journal.state('canal', x) for x in ('a', 'b', 'c', 'd')],
+                         [None, 'sent', 'read', None])
+        self.assertEqual(journal.state('otro', 'b'), None)
+        # al abrirlo se compacta
+        with open(self.filename) as i:
+            self.assertEqual(len(i.readlines()), 2)
+
+    def test_sync(self):
+        """Verifica que se haga fsync por lotes y que se compacte el archivo
+        """
+        with mock.patch('%s.ftp2email.os.fsync' % __name__) as fsync_mock:
+            journal = ftp2email.RunJournal(self.filename, sync_every=10, sync_interval=60,
+                                           compact_lines=30)
+            fsync_mock.reset_mock()
+            for msg_id in range(25):
+                journal.record('canal', msg_id, 'read')
+            self.assertEqual(fsync_mock.call_count, 2)
+            for msg_id in range(25):
+                journal.record('canal', msg_id, 'marked')
+            self.assertTrue(journal.lines <= 30)
+            journal.close()
+            self.assertEqual(os.path.getsize(self.filename), 0)
+
+    def test_pipeChannels(self):
+        """Verifica que despues de una interrupcion solo se marquen los mensajes ya enviados
+        """
+        messages = dict((x, mock.Mock(src_code='L0002349', dst_code='E0000001', identifier=None))
+                        for x in range(4))
+        src_channel_mock = mock.MagicMock(create=True)
+        src_channel_mock.__str__.return_value = 'canal'
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+        dst_channel_mock = mock.Mock(create=True)
+        journal = ftp2email.RunJournal(self.filename)
+        journal.record('canal', 1, 'read')
+        journal.record('canal', 1, 'sent')
+        journal.record('canal', 2, 'read')
+        journal.close()
+
+        journal = ftp2email.RunJournal(self.filename)
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, journal=journal)
+
+        dst_channel_mock.send_message.assert_has_calls([mock.call(messages[x]) for x in (0, 2, 3)])
+        self.assertEqual(dst_channel_mock.send_message.call_count, 3)
+        src_channel_mock.get_message.assert_has_calls([mock.call(x) for x in (0, 2, 3)])
+        self.assertEqual(sorted(x[0][0] for x in src_channel_mock.mark_message.call_args_list),
+                         list(range(4)))
+        self.assertEqual((stats.counters['sent'], stats.counters['recovered']), (3, 1))
+        self.assertEqual(journal.entries, {})
+
+    def test_commit_marks(self):
+        """Verifica que los mensajes queden 'sent' si el canal no pudo confirmar
+            las marcas al cerrarse, como pop que elimina los emails al cerrar
+        """
+        messages = dict((x, mock.Mock(src_code='L0002349', dst_code='E0000001', identifier=None))
+                        for x in range(3))
+        src_channel_mock = mock.MagicMock(create=True)
+        src_channel_mock.__str__.return_value = 'pop'
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+        src_channel_mock.close.side_effect = [socket.error('conexion perdida'), None]
+        dst_channel_mock = mock.Mock(create=True)
+
+        journal = ftp2email.RunJournal(self.filename)
+        self.assertRaises(socket.error, ftp2email.pipeChannels, src_channel_mock,
+                          dst_channel_mock, journal=journal)
+        self.assertEqual(src_channel_mock.mark_message.call_count, 3)
+        self.assertEqual([journal.state('pop', x) for x in range(3)], ['sent'] * 3)
+        journal.file.close()
+
+        journal = ftp2email.RunJournal(self.filename)
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, journal=journal)
+        self.assertEqual(dst_channel_mock.send_message.call_count, 3)
+        self.assertEqual(stats.counters['recovered'], 3)
+        self.assertEqual(journal.entries, {})
+        journal.close()
+        self.assertEqual(ftp2email.RunJournal(self.filename).entries, {})
+
+
+class RetrySchedulerTestCase(unittest.TestCase):
+    """Test para los reintentos con espera exponencial y el corte por destino"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_path, 'reintentos.sqlite')
+        self.retry = ftp2email.RetryScheduler(self.filename, base_delay=10, max_delay=30,
+                                              breaker_failures=3, breaker_delay=100)
+
+    def tearDown(self):
+        self.retry.close()
+        shutil.rmtree(self.tmp_path)
+
+    def test_backoff(self):
+        """Verifica la espera entre reintentos y que se mantenga al reabrir la base
+        """
+        with mock.patch('%s.ftp2email.time.time' % __name__) as time_mock:
+            time_mock.return_value = 1000
+            self.assertFalse(self.retry.is_deferred('canal', 'a'))
+            delays = []
+            for attempt in range(4):
+                self.retry.failure('canal', 'a', 'destino', Exception('error'))
+                delays.append(self.retry.retries[('canal', 'a')][1] - 1000)
+            self.assertEqual(delays, [10, 20, 30, 30])
+            self.assertTrue(self.retry.is_deferred('canal', 'a'))
+            self.assertFalse(self.retry.is_deferred('otro', 'a'))
+
+            self.retry.close()
+            self.retry = ftp2email.RetryScheduler(self.filename)
+            self.assertTrue(self.retry.is_deferred('canal', 'a'))
+            time_mock.return_value = 1031
+            self.assertFalse(self.retry.is_deferred('canal', 'a'))
+
+            self.retry.success('canal', 'a', 'destino')
+            self.retry.close()
+            self.retry = ftp2email.RetryScheduler(self.filename)
+            self.assertEqual((self.retry.retries, self.retry.breakers), ({}, {}))
+
+    def test_breaker(self):
+        """Verifica el corte de los envios despues de errores seguidos a un destino
+        """
+        with mock.patch('%s.ftp2email.time.time' % __name__) as time_mock:
+            time_mock.return_value = 1000
+            for msg_id in range(2):
+                self.retry.failure('canal', msg_id, 'destino')
+            self.assertFalse(self.retry.is_open('destino'))
+            self.retry.success('canal', 5, 'destino')
+            for msg_id in range(3):
+                self.retry.failure('canal', msg_id, 'destino')
+            self.assertTrue(self.retry.is_open('destino'))
+            self.assertFalse(self.retry.is_open('otro'))
+
+            # pasado el corte se prueba con un mensaje, si falla se vuelve a cortar
+            time_mock.return_value = 1101
+            self.assertFalse(self.retry.is_open('destino'))
+            self.retry.failure('canal', 4, 'destino')
+            self.assertTrue(self.retry.is_open('destino'))
+            time_mock.return_value = 1202
+            self.retry.success('canal', 5, 'destino')
+            self.assertFalse(self.retry.is_open('destino'))
+
+    def test_pipeChannels(self):
+        """Verifica que un destino caido no demore el envio al resto
+        """
+        messages = dict((x, mock.Mock(src_code='L0002349', dst_code='E000000%d' % (x % 2),
+                                      identifier=None))
+                        for x in range(10))
+        src_channel_mock = mock.Mock(create=True)
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+
+        def send_message(message):
+            if message.dst_code == 'E0000001':
+                raise socket.timeout('timed out')
+        dst_channel_mock = mock.Mock(create=True)
+        dst_channel_mock.send_message.side_effect = send_message
+        dst_channel_mock.get_destination_key.side_effect = lambda x: x.dst_code
+
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, retry=self.retry)
+        self.assertEqual(dst_channel_mock.send_message.call_count, 5 + 3)
+        self.assertEqual((stats.counters['sent'], stats.counters['failed'],
+                          stats.counters['deferred']), (5, 3, 2))
+        self.assertEqual(sorted(x[0][0] for x in src_channel_mock.mark_message.call_args_list),
+                         [0, 2, 4, 6, 8])
+
+        # en la siguiente ejecucion los mensajes que fallaron no se vuelven a leer
+        src_channel_mock.reset_mock()
+        dst_channel_mock.send_message.reset_mock()
+        src_channel_mock.load_messages.return_value = [1, 3, 5, 7, 9]
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, retry=self.retry)
+        src_channel_mock.get_message.assert_has_calls([mock.call(7), mock.call(9)])
+        self.assertEqual(src_channel_mock.get_message.call_count, 2)
+        self.assertEqual(dst_channel_mock.send_message.call_count, 0)
+        self.assertEqual(stats.counters['deferred'], 5)
+
+
+class TenantRunnerTestCase(unittest.TestCase):
+    """Test para el envio de varias identidades sinli en un proceso"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.test_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                        'data')
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.outbox = benchmark.Mailbox(os.path.join(self.tmp_path, 'outbox'))
+        self.servers = [benchmark.BenchmarkServer(benchmark.SmtpHandler, self.outbox).start()]
+        self.settings = {'dir_re': '/L00023[0-9]{2}_E[0-9]{7}$',
+                         'eaddress_file': os.path.join(self.test_path, 'email_address.csv'),
+                         'smtp_settings': {'host': '127.0.0.1', 'port': self.servers[0].port,
+                                           'user': None},
+                         'tenants': []}
+        for sinli_code, outbound in (('L0002349', 2), ('L0002350', 1)):
+            base_path = os.path.join(self.tmp_path, sinli_code)
+            outbound_path = os.path.join(base_path, '%s_E0000001' % sinli_code)
+            os.makedirs(outbound_path)
+            for nro in range(outbound):
+                with open(os.path.join(outbound_path, 'PEDIDO_%d.xml' % nro), 'wb') as o:
+                    o.write(benchmark.gen_message('PEDIDO', sinli_code, 'E0000001', nro=nro))
+            inbox = benchmark.Mailbox(os.path.join(self.tmp_path, 'inbox_%s' % sinli_code))
+            message = ftp2email.SinliargMessage(
+                benchmark.gen_message('REMITO', 'E0000001', sinli_code), filename='REMITO.xml')
+            channel = ftp2email.EmailChannel({}, {}, msg_from='fc@fierro-soft.com.ar')
+            inbox.add(channel.build_batch_email(sinli_code, [message]).encode('utf-8'))
+            self.servers.append(benchmark.BenchmarkServer(benchmark.Pop3Handler, inbox).start())
+            self.settings['tenants'].append({
+                'sinli_code': sinli_code, 'sinli_email': '%s@example.com' % sinli_code,
+                'base_path': base_path,
+                'pop_settings': {'host': '127.0.0.1', 'port': self.servers[-1].port,
+                                 'user': 'u', 'pass': 'p'}})
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmp_path)
+
+    def test_tenant_settings(self):
+        """Verifica que cada identidad herede la configuracion general
+        """
+        tenants = ftp2email.tenant_settings(self.settings)
+        self.assertEqual([x['sinli_code'] for x in tenants], ['L0002349', 'L0002350'])
+        self.assertEqual(tenants[1]['smtp_settings'], self.settings['smtp_settings'])
+        self.assertTrue('tenants' not in tenants[0])
+
+        self.settings['tenants'][1]['sinli_code'] = 'L0002349'
+        self.assertRaises(ValueError, ftp2email.TenantRunner, self.settings)
+
+    def test_run_once(self):
+        """Verifica el envio y la recepcion de todas las identidades y sus estadisticas
+        """
+        runner = ftp2email.TenantRunner(self.settings, workers=2)
+        summary = runner.summary(runner.run_once())
+        runner.close()
+
+        self.assertEqual(sorted(summary), ['L0002349', 'L0002350'])
+        for sinli_code, outbound in (('L0002349', 2), ('L0002350', 1)):
+            tenant = summary[sinli_code]
+            self.assertEqual(tenant['files->emails']['counters']['sent'], outbound)
+            self.assertEqual(tenant['emails->files']['counters']['sent'], 1)
+            self.assertEqual(tenant['total']['sent'], outbound + 1)
+            received = os.path.join(self.tmp_path, sinli_code, 'E0000001_%s' % sinli_code,
+                                    'REMITO')
+            self.assertEqual(os.listdir(received), ['REMITO.xml'])
+        senders = sorted(emailParser().parsestr(self.outbox.read(uid).decode('ascii'))['From']
+                         for uid, size in self.outbox.list())
+        self.assertEqual(senders, ['L0002349@example.com'] * 2 + ['L0002350@example.com'])
+
+    def test_run_once_daemon(self):
+        """Verifica que los ciclos del daemon reusen la conexion smtp de cada identidad
+            aunque cada ciclo envie desde otros threads
+        """
+        runner = ftp2email.TenantRunner(self.settings, workers=2)
+        for cycle in range(3):
+            for sinli_code in ('L0002349', 'L0002350'):
+                with open(os.path.join(self.tmp_path, sinli_code, '%s_E0000001' % sinli_code,
+                                       'PEDIDO_ciclo%d.xml' % cycle), 'wb') as o:
+                    o.write(benchmark.gen_message('PEDIDO', sinli_code, 'E0000001',
+                                                  nro=10 + cycle))
+            summary = runner.summary(runner.run_once(close_dst=False))
+            for sinli_code in ('L0002349', 'L0002350'):
+                self.assertEqual(summary[sinli_code]['files->emails']['counters']['sent'],
+                                 1 if cycle else (3 if sinli_code == 'L0002349' else 2))
+        for tenant in runner.tenants:
+            dst_channel = tenant.channels[('files', 'emails')][1]
+            self.assertEqual(dst_channel.smtp_connections, 1)
+            self.assertEqual(len(dst_channel.smtp_servers), 1)
+        runner.close()
+        for tenant in runner.tenants:
+            self.assertEqual(tenant.channels[('files', 'emails')][1].smtp_servers, [])
 
 
 class PipeChannelsTestCase(unittest.TestCase):
@@ -436,11 +1765,126 @@ class PipeChannelsTestCase(unittest.TestCase):
 
         ftp2email.pipeChannels(src_channel_mock, dst_channel_mock)
         self.assertEqual(src_channel_mock.load_messages.call_count, 1)
-        self.assertEqual(src_channel_mock.get_message.call_count, 3)
-        src_channel_mock.get_message.assert_has_calls([mock.call(x) for x in (1, 2, 3)])
+        self.assertEqual(src_channel_mock.get_message.call_args_list,
+                         [mock.call(x) for x in (1, 2, 3)])
         self.assertEqual(dst_channel_mock.send_message.call_count, 3)
         src_channel_mock.mark_message.assert_has_calls([mock.call(x) for x in (1, 2, 3)])
 
+    def test_pipeChannels_workers(self):
+        """Verifica el envio concurrente respetando el orden por origen y destino
+        """
+        messages = dict((x, mock.Mock(src_code='L000000%d' % (x % 3), dst_code='E0000001', id=x))
+                        for x in range(30))
+        src_channel_mock = mock.Mock(create=True)
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+
+        def send_message(message):
+            if message.id == 4:     # un destino lento no debe alterar el orden
+                time.sleep(0.05)
+            if message.id == 7:
+                raise Exception('error de envio')
+        dst_channel_mock = mock.Mock(create=True)
+        dst_channel_mock.send_message.side_effect = send_message
+
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, workers=4)
+
+        sent = [x[0][0].id for x in dst_channel_mock.send_message.call_args_list]
+        self.assertEqual(sorted(sent), list(range(30)))
+        for src in range(3):
+            partner_sent = [x for x in sent if x % 3 == src]
+            self.assertEqual(partner_sent, sorted(partner_sent))
+        marked = [x[0][0] for x in src_channel_mock.mark_message.call_args_list]
+        self.assertEqual(sorted(marked), [x for x in range(30) if x != 7])
+        self.assertEqual(stats.counters['sent'], 29)
+        self.assertEqual(stats.counters['failed'], 1)
+        src_channel_mock.close.assert_called_once_with()
+        dst_channel_mock.close.assert_called_once_with()
+
+    def test_pipeChannels_batch(self):
+        """Verifica que los mensajes agrupados en lotes se marquen cuando se envia el lote
+        """
+        messages = dict((x, mock.Mock(src_code='L0002349', dst_code='E0000001', identifier=None))
+                        for x in range(5))
+        src_channel_mock = mock.Mock(create=True)
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+        batch = []
+        marked_when_sent = []
+
+        def send_message(message):
+            batch.append(message)
+            if len(batch) < 2:
+                return []
+            marked_when_sent.append(src_channel_mock.mark_message.call_count)
+            results = [(x, Exception('error') if x is messages[3] else None) for x in batch]
+            del batch[:]
+            return results
+        dst_channel_mock = mock.Mock(create=True)
+        dst_channel_mock.send_message.side_effect = send_message
+        dst_channel_mock.flush.side_effect = lambda: [(x, None) for x in batch]
+
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock)
+
+        self.assertEqual(marked_when_sent, [0, 2])
+        src_channel_mock.mark_message.assert_has_calls([mock.call(x) for x in (0, 1, 2, 4)])
+        self.assertEqual(src_channel_mock.mark_message.call_count, 4)
+        self.assertEqual((stats.counters['sent'], stats.counters['failed']), (4, 1))
+
+    def test_pipeChannels_dedup(self):
+        """Verifica que los mensajes duplicados se marquen sin enviarlos
+        """
+        messages = dict((x, mock.Mock(src_code='E0000001', dst_code='L0002349', identifier=None))
+                        for x in range(4))
+        src_channel_mock = mock.Mock(create=True)
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+        dst_channel_mock = mock.Mock(create=True)
+        dedup_mock = mock.Mock(create=True)
+        dedup_mock.reserve.side_effect = lambda x: x is not messages[2]
+
+        stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, dedup=dedup_mock)
+
+        dst_channel_mock.send_message.assert_has_calls([mock.call(messages[x]) for x in (0, 1, 3)])
+        self.assertEqual(dst_channel_mock.send_message.call_count, 3)
+        dedup_mock.add.assert_has_calls([mock.call(messages[x]) for x in (0, 1, 3)])
+        src_channel_mock.mark_message.assert_has_calls([mock.call(x) for x in range(4)])
+        self.assertEqual(stats.counters['duplicated'], 1)
+
+    def test_pipeChannels_dedup_batch(self):
+        """Verifica que un duplicado en el mismo lote no se envie y que los mensajes
+            de un lote con error se puedan volver a enviar
+        """
+        def message(body):
+            return mock.Mock(src_code='L0002349', dst_code='E0000001', identifier=None,
+                             content_digest=lambda: ftp2email.hashlib.sha1(body).hexdigest())
+        messages = {0: message(b'a'), 1: message(b'a'), 2: message(b'b')}
+        src_channel_mock = mock.Mock(create=True)
+        src_channel_mock.load_messages.return_value = sorted(messages)
+        src_channel_mock.get_message.side_effect = lambda x: messages[x]
+        batch = []
+        dst_channel_mock = mock.Mock(create=True)
+        dst_channel_mock.send_message.side_effect = lambda x: batch.append(x) or []
+        dst_channel_mock.flush.side_effect = lambda: [(x, Exception('error') if x is messages[2]
+                                                       else None) for x in batch]
+        tmp_path = tempfile.mkdtemp()
+        dedup = ftp2email.DuplicateIndex(os.path.join(tmp_path, 'dedup.sqlite'))
+        try:
+            stats = ftp2email.pipeChannels(src_channel_mock, dst_channel_mock, dedup=dedup)
+            self.assertEqual(batch, [messages[0], messages[2]])
+            self.assertEqual((stats.counters['sent'], stats.counters['duplicated'],
+                              stats.counters['failed']), (1, 1, 1))
+            self.assertEqual(src_channel_mock.mark_message.call_args_list,
+                             [mock.call(1), mock.call(0)])
+            self.assertFalse(dedup.reserve(message(b'a')))
+            retry_message = message(b'b')
+            self.assertTrue(dedup.reserve(retry_message))
+            dedup.release(retry_message)
+            self.assertEqual((dedup.reserved, dedup.reserved_keys), ({}, set()))
+        finally:
+            dedup.close()
+            shutil.rmtree(tmp_path)
+
 
 def main():
     unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+# fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import utils.benchmark as benchmark
+import utils.indice as indice
+
+
+class MessageIndexTestCase(unittest.TestCase):
+    """Test para el indice de mensajes archivados y recibidos"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.tmp_path, 'data')
+        self.dir_re = '/L0002349_[A-Z][0-9]{7}$'
+        self.examples_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                          os.pardir, 'ejemplos')
+        # enviados y archivados, pendientes, fallidos y recibidos
+        self.add_file('L0002349_E0000001/archived/PEDIDO_1.xml',
+                      benchmark.gen_message('PEDIDO', 'L0002349', 'E0000001', items=3))
+        self.add_file('L0002349_E0000001/PEDIDO_2.xml',
+                      benchmark.gen_message('PEDIDO', 'L0002349', 'E0000001', items=3, nro=2))
+        self.add_file('L0002349_E0000001/failed/PEDIDO_3.xml',
+                      benchmark.gen_message('PEDIDO', 'L0002349', 'E0000001', items=3, nro=3))
+        with open(os.path.join(self.examples_path, 'FACTURA_EAR00023_LAR00021_35.xml'),
+                  'rb') as i:
+            self.add_file('EAR00023_LAR00021/FACTURA/FACTURA_35.xml', i.read())
+        self.add_file('E0000001_L0002349/REMITO/REMITO_1.xml',
+                      benchmark.gen_message('REMITO', 'E0000001', 'L0002349', items=3))
+        self.index = indice.MessageIndex(os.path.join(self.tmp_path, 'indice.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp_path)
+
+    def add_file(self, path, data):
+        path = os.path.join(self.base_path, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as o:
+            o.write(data)
+        return path
+
+    def test_update(self):
+        """Verifica que solo se indexen los archivos nuevos o modificados
+        """
+        self.assertEqual(self.index.update(self.base_path, self.dir_re),
+                         {'indexed': 3, 'unchanged': 0, 'errors': 0, 'removed': 0})
+        self.assertEqual(self.index.update(self.base_path, self.dir_re),
+                         {'indexed': 0, 'unchanged': 3, 'errors': 0, 'removed': 0})
+
+        # el mensaje pendiente se envia y se archiva, uno recibido se borra
+        os.rename(os.path.join(self.base_path, 'L0002349_E0000001/PEDIDO_2.xml'),
+                  os.path.join(self.base_path, 'L0002349_E0000001/archived/PEDIDO_2.xml'))
+        os.remove(os.path.join(self.base_path, 'E0000001_L0002349/REMITO/REMITO_1.xml'))
+        self.add_file('E0000001_L0002349/REMITO/roto.xml', b'<REMITO>')
+        self.assertEqual(self.index.update(self.base_path, self.dir_re),
+                         {'indexed': 1, 'unchanged': 2, 'errors': 1, 'removed': 1})
+        self.assertEqual([x['identifier'] for x in self.index.search(sinli_type='PEDIDO')],
+                         ['PEDIDOL00023491', 'PEDIDOL00023492'])
+
+    def test_search(self):
+        """Verifica las busquedas por encabezado, fecha y codigos de los items
+        """
+        self.index.update(self.base_path, self.dir_re)
+        facturas = self.index.search(sinli_type='FACTURA', src_code='EAR00023',
+                                     date_from='2012-02-01', date_to='2012-03-01')
+        self.assertEqual([x['document_number'] for x in facturas], ['0001-00332585'])
+        self.assertEqual(self.index.search(sinli_type='FACTURA', date_to='2012-02-01'), [])
+        self.assertEqual([x['sinli_type'] for x in self.index.search(ean='9789505634606')],
+                         ['FACTURA'])
+
+        ean = benchmark.gen_book(3)['EAN']
+        remitos = self.index.search(sinli_type='REMITO', ean=ean)
+        self.assertEqual(len(remitos), 1)
+        items = self.index.items(remitos[0]['path'])
+        self.assertEqual([(x['ean'], x['quantity']) for x in items],
+                         [(benchmark.gen_book(x)['EAN'], x - 2) for x in range(3, 6)])
+
+        start = time.time()
+        for x in range(100):
+            self.index.search(src_code='E0000001', ean=ean)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_main(self):
+        """Verifica los comandos actualizar y buscar
+        """
+        db_file = os.path.join(self.tmp_path, 'indice.sqlite')
+        settings_file = os.path.join(self.tmp_path, 'settings.json')
+        with open(settings_file, 'w') as o:
+            o.write('{"base_path": "%s", "dir_re": "%s"}'
+                    % (self.base_path, self.dir_re))
+        self.assertEqual(indice.main(['-s', settings_file, '--db', db_file, 'actualizar']), 0)
+        self.assertEqual(len(self.index.search()), 3)
+
+        # sin configuracion se puede buscar pero no actualizar
+        missing_file = os.path.join(self.tmp_path, 'no_existe.json')
+        self.assertEqual(indice.main(['-s', missing_file, '--db', db_file, 'buscar']), 0)
+        with self.assertRaises(SystemExit) as cm:
+            indice.main(['-s', missing_file, '--db', db_file, 'actualizar'])
+        self.assertEqual(cm.exception.code, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# fixme: hay una forma menos fea de incluir en el path el directorio donde esta utils?
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+
+import utils.benchmark as benchmark
+import validar
+
+
+class ValidateTestCase(unittest.TestCase):
+    """Test para la validacion de arboles de mensajes con cache y reporte"""
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.grammar_file = os.path.join(self.tmp_path, 'sinliarg.rng')
+        shutil.copy(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir,
+                                 'sinliarg.rng'), self.grammar_file)
+        self.msg_path = os.path.join(self.tmp_path, 'mensajes')
+        os.makedirs(os.path.join(self.msg_path, 'E0000001'))
+        for nro, sinli_type in enumerate(['PEDIDO', 'REMITO', 'CATALOGO']):
+            with open(os.path.join(self.msg_path, 'E0000001', '%s.xml' % sinli_type), 'wb') as o:
+                o.write(benchmark.gen_message(sinli_type, 'L0002349', 'E0000001', items=2,
+                                              nro=nro + 1))
+        with open(os.path.join(self.msg_path, 'invalido.xml'), 'wb') as o:
+            o.write(b'<PEDIDO><ARCHIVO/></PEDIDO>')
+        with open(os.path.join(self.msg_path, 'leeme.txt'), 'w') as o:
+            o.write('no es un mensaje')
+        self.cache_file = os.path.join(self.tmp_path, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def run_validate(self, jobs=1):
+        return dict((os.path.basename(x['path']), x)
+                    for x in validar.validate(self.grammar_file, [self.msg_path], jobs,
+                                              self.cache_file))
+
+    def test_cache(self):
+        """Verifica que se salteen los mensajes validos ya validados y que el cache
+            se descarte al cambiar la gramatica
+        """
+        results = self.run_validate()
+        self.assertEqual(sorted(results), ['CATALOGO.xml', 'PEDIDO.xml', 'REMITO.xml',
+                                           'invalido.xml'])
+        self.assertFalse(any(x['cached'] for x in results.values()))
+        self.assertFalse(results['invalido.xml']['valid'])
+
+        # los validos salen del cache, el invalido se vuelve a validar
+        results = self.run_validate()
+        self.assertEqual(dict((x, y['cached']) for x, y in results.items()),
+                         {'CATALOGO.xml': True, 'PEDIDO.xml': True, 'REMITO.xml': True,
+                          'invalido.xml': False})
+        self.assertEqual(results['PEDIDO.xml']['root'], 'PEDIDO')
+        self.assertFalse(os.path.exists(self.cache_file + '.tmp'))
+
+        # con otra gramatica se valida todo de nuevo
+        with open(self.grammar_file, 'a') as o:
+            o.write('\n')
+        results = self.run_validate()
+        self.assertFalse(any(x['cached'] for x in results.values()))
+        self.assertEqual(sorted(x for x, y in results.items() if y['valid']),
+                         ['CATALOGO.xml', 'PEDIDO.xml', 'REMITO.xml'])
+
+    def test_report(self):
+        """Verifica el contenido del reporte y el resultado del comando
+        """
+        report_file = os.path.join(self.tmp_path, 'reporte.jsonl')
+        argv = ['-j', '2', '--cache', self.cache_file, '--report', report_file,
+                self.grammar_file, self.msg_path]
+        self.assertEqual(validar.main(argv), 1)
+        self.assertEqual(validar.main(argv), 1)
+        with open(report_file) as i:
+            rows = [json.loads(x) for x in i]
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all(sorted(x) == ['cached', 'digest', 'errors', 'path', 'root',
+                                          'time', 'valid'] for x in rows))
+        rows = dict((os.path.basename(x['path']), x) for x in rows)
+        self.assertEqual(rows['REMITO.xml']['errors'], [])
+        self.assertTrue(rows['REMITO.xml']['cached'])
+        self.assertFalse(rows['invalido.xml']['valid'])
+        self.assertFalse(rows['invalido.xml']['cached'])
+        self.assertTrue(rows['invalido.xml']['errors'])
+
+        os.remove(os.path.join(self.msg_path, 'invalido.xml'))
+        self.assertEqual(validar.main(argv), 0)
+
+    def test_stop_early(self):
+        """Verifica que al dejar de iterar no queden procesos corriendo
+        """
+        results = validar.validate(self.grammar_file, [self.msg_path], 2)
+        next(results)
+        self.assertTrue(multiprocessing.active_children())
+        results.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""Variante asyncio de los canales de ftp2email
+
+Los canales de email hablan SMTP y POP3 directamente sobre streams de asyncio,
+de modo que miles de envios y lecturas pueden estar en curso en un solo proceso
+sin un thread por conexion. Los canales sincronicos de ftp2email se pueden usar
+con SyncChannelAdapter.
+
+Usa el mismo archivo de configuracion que ftp2email pero solo una parte: los
+canales de archivos, los emails por pop sin 'spool_dir', la compresion por destino,
+'max_attachment_size', 'check_well_formed' y el indice de duplicados
+('dedup_file'). El resto
+(imap, spool, 'journal_file', 'retry_file', 'email_batch', 'tenants') solo lo
+implementa ftp2email.py, con esa configuracion el comando termina con error en
+lugar de ignorarla (ver unsupported_settings). El modo daemon, las metricas y el
+resumen de la ejecucion tampoco estan disponibles.
+
+Requiere python 3.7 o superior (STARTTLS requiere python 3.11).
+"""
+
+import argparse
+import asyncio
+import base64
+import functools
+import logging
+import os
+import socket
+import ssl
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from utils import ftp2email
+except ImportError:  # ejecutado como script desde utils
+    import ftp2email
+
+
+class AsyncMessageChannel(object):
+    """Canal asincronico que permite enviar y recibir mensajes"""
+    # ver ftp2email.MessageChannel
+    check_well_formed = True
+
+    async def load_messages(self):
+        """Devuelve una lista con los ids de los mensajes encontrados
+        """
+        raise NotImplementedError
+
+    async def get_message(self, msg_id):
+        """Devuelve el mensaje con id msg_id
+        """
+        raise NotImplementedError
+
+    async def send_message(self, sinli_msg):
+        """:sinli_msg: mensaje sinliarg a enviar
+        """
+        raise NotImplementedError
+
+    async def mark_message(self, msg_id, error=False):
+        """Marca un mensaje como procesado/leido
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Libera los recursos usados por el canal
+        """
+        pass
+
+
+class SyncChannelAdapter(AsyncMessageChannel):
+    """Adapta un canal sincronico de ftp2email a la interfaz asincronica
+        Los metodos del canal se ejecutan en un executor, por defecto de un solo
+        thread para no usar el canal desde varios threads a la vez
+    """
+
+    def __init__(self, channel, executor=None):
+        """
+            :channel: canal sincronico (FilesystemChannel, EmailChannel, ...)
+            :executor: executor donde se ejecutan los metodos del canal
+        """
+        self.channel = channel
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+
+    def __str__(self):
+        return str(self.channel)
+
+    async def call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args, **kwargs))
+
+    async def load_messages(self):
+        return await self.call(lambda: list(self.channel.load_messages()))
+
+    async def get_message(self, msg_id):
+        return await self.call(self.channel.get_message, msg_id)
+
+    async def send_message(self, sinli_msg):
+        return await self.call(self.channel.send_message, sinli_msg)
+
+    async def mark_message(self, msg_id, error=False):
+        return await self.call(self.channel.mark_message, msg_id, error)
+
+    async def close(self):
+        await self.call(self.channel.close)
+
+
+class SmtpError(Exception):
+    """Respuesta de error del servidor smtp"""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, '%s %s' % (code, message))
+        self.code = code
+
+
+class AsyncSmtpClient(object):
+    """Cliente smtp minimo sobre streams de asyncio"""
+
+    def __init__(self, host, port=None, timeout=30, tls=False, user=None, password=None):
+        self.host = host
+        self.port = port or 25
+        self.timeout = timeout
+        self.tls = tls
+        self.user = user
+        self.password = password
+        self.reader = self.writer = None
+        self.extensions = ''
+
+    async def connect(self):
+        """Abre la conexion, inicia TLS si corresponde y se autentica
+        """
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        await self.expect((220,))
+        await self.ehlo()
+        if self.tls:
+            await self.command('STARTTLS', (220,))
+            await self.writer.start_tls(ssl.create_default_context())
+            await self.ehlo()
+        if self.user is not None:
+            await self.login()
+
+    async def read_reply(self):
+        """Lee una respuesta del servidor, devuelve (codigo, texto)
+        """
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise ConnectionError('El servidor smtp cerro la conexion')
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            lines.append(line[4:])
+            if line[3:4] != '-':
+                return int(line[:3]), '\n'.join(lines)
+
+    async def expect(self, codes):
+        code, message = await self.read_reply()
+        if code not in codes:
+            raise SmtpError(code, message)
+        return code, message
+
+    async def command(self, cmd, codes=(250,)):
+        self.writer.write(cmd.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self.expect(codes)
+
+    async def ehlo(self):
+        code, extensions = await self.command('EHLO %s' % socket.getfqdn())
+        self.extensions = extensions.upper()
+
+    async def login(self):
+        if 'PLAIN' in self.extensions or 'LOGIN' not in self.extensions:
+            token = base64.b64encode(('\0%s\0%s' % (self.user, self.password)).encode('utf-8'))
+            await self.command('AUTH PLAIN %s' % token.decode('ascii'), (235,))
+        else:
+            await self.command('AUTH LOGIN', (334,))
+            await self.command(base64.b64encode(self.user.encode('utf-8')).decode('ascii'), (334,))
+            await self.command(base64.b64encode(self.password.encode('utf-8')).decode('ascii'), (235,))
+
+    async def sendmail(self, from_addr, to_addr, email_data):
+        """Envia el email, email_data es el texto completo del email o un
+            ftp2email.StreamedEmail que se escribe por partes
+        """
+        await self.command('MAIL FROM:<%s>' % from_addr)
+        await self.command('RCPT TO:<%s>' % to_addr, (250, 251))
+        await self.command('DATA', (354,))
+        if isinstance(email_data, ftp2email.StreamedEmail):
+            for chunk in email_data:
+                self.writer.write(chunk)
+                await self.writer.drain()
+            self.writer.write(b'.\r\n')
+            await self.writer.drain()
+            await self.expect((250,))
+            return
+        if isinstance(email_data, str):
+            email_data = email_data.encode('utf-8')
+        for line in email_data.splitlines():
+            if line.startswith(b'.'):
+                line = b'.' + line
+            self.writer.write(line + b'\r\n')
+        self.writer.write(b'.\r\n')
+        await self.writer.drain()
+        await self.expect((250,))
+
+    async def quit(self):
+        try:
+            await self.command('QUIT', (221,))
+        finally:
+            self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class Pop3Error(Exception):
+    """Respuesta de error del servidor pop"""
+
+
+class AsyncPop3Client(object):
+    """Cliente pop3 minimo sobre streams de asyncio"""
+
+    def __init__(self, host, port=None, timeout=30, tls=False):
+        self.host = host
+        self.port = port or 110
+        self.timeout = timeout
+        self.tls = tls
+        self.reader = self.writer = None
+
+    async def connect(self, user, password):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        await self.read_status()
+        if self.tls:
+            await self.command('STLS')
+            await self.writer.start_tls(ssl.create_default_context())
+        await self.command('USER %s' % user)
+        await self.command('PASS %s' % password)
+
+    async def read_line(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise ConnectionError('El servidor pop cerro la conexion')
+        return line.rstrip(b'\r\n')
+
+    async def read_status(self):
+        line = await self.read_line()
+        if not line.startswith(b'+OK'):
+            raise Pop3Error(line.decode('utf-8', 'replace'))
+        return line
+
+    async def command(self, cmd):
+        self.writer.write(cmd.encode('utf-8') + b'\r\n')
+        await self.writer.drain()
+        return await self.read_status()
+
+    async def multiline(self, cmd):
+        """Ejecuta un comando con respuesta de varias lineas, devuelve la lista de lineas
+        """
+        await self.command(cmd)
+        lines = []
+        while True:
+            line = await self.read_line()
+            if line == b'.':
+                return lines
+            if line.startswith(b'..'):
+                line = line[1:]
+            lines.append(line)
+
+    async def uidl(self):
+        return await self.multiline('UIDL')
+
+    async def top(self, email_nro, lines):
+        return await self.multiline('TOP %s %s' % (email_nro, lines))
+
+    async def retr(self, email_nro):
+        return await self.multiline('RETR %s' % email_nro)
+
+    async def dele(self, email_nro):
+        return await self.command('DELE %s' % email_nro)
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        finally:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncEmailChannel(AsyncMessageChannel):
+    """Canal asincronico de intercambio de mensajes por email
+        Usa un EmailChannel para armar los emails, la libreta de direcciones
+        y el reconocimiento de emails sinliarg
+    """
+
+    def __init__(self, smtp_settings, pop_settings, msg_from='', eaddress_file=None,
+                 max_connections=10, compression=None, error_path=None,
+                 max_attachment_size=None):
+        """
+            :smtp_settings: dict de configuracion del servidor smtp
+            :pop_settings: dict de configuracion del servidor pop
+            :msg_from: valor que identifica el origen de los emails enviados
+            :eaddress_file: nombre del archivo con codigo sinli, direccion de email (csv)
+            :max_connections: cantidad maxima de conexiones smtp simultaneas
+            :compression: dict codigo sinli -> 'gzip' o 'zip' (ver EmailChannel)
+            :error_path: directorio donde se guardan los emails con mensajes erroneos
+            :max_attachment_size: tamaño maximo de un adjunto descomprimido (ver EmailChannel)
+        """
+        self.channel = ftp2email.EmailChannel(smtp_settings, pop_settings,
+                                              msg_from=msg_from, eaddress_file=eaddress_file,
+                                              compression=compression, error_path=error_path,
+                                              max_attachment_size=max_attachment_size)
+        self.smtp_settings = smtp_settings
+        self.pop_settings = pop_settings
+        self.max_connections = max_connections
+        self.smtp_semaphore = None
+        self.smtp_idle = []
+        self.smtp_connections = 0
+        self.sent_messages = 0
+        self.pop_client = None
+
+    def __str__(self):
+        return 'AsyncEmailChannel(%s)' % self.channel.msg_from
+
+    async def get_smtp_client(self):
+        """Toma una conexion smtp libre o abre una nueva
+        """
+        if self.smtp_idle:
+            return self.smtp_idle.pop()
+        client = AsyncSmtpClient(self.smtp_settings['host'],
+                                 port=self.smtp_settings.get('port', None),
+                                 timeout=self.smtp_settings.get('timeout', 30),
+                                 tls=self.smtp_settings.get('tls', False),
+                                 user=self.smtp_settings['user'],
+                                 password=self.smtp_settings.get('pass', None))
+        await client.connect()
+        self.smtp_connections += 1
+        return client
+
+    async def send_message(self, sinli_message):
+        """Envia el mensaje por email usando el pool de conexiones smtp
+        """
+        if self.smtp_semaphore is None:
+            self.smtp_semaphore = asyncio.Semaphore(self.max_connections)
+        dest_addr, email_data = self.channel.build_email(sinli_message)
+        async with self.smtp_semaphore:
+            client = await self.get_smtp_client()
+            try:
+                await client.sendmail(self.channel.msg_from, dest_addr, email_data)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, SmtpError) as e:
+                client.close()
+                if isinstance(e, SmtpError) and e.code != 421:
+                    raise
+                logging.info('Conexion con el servidor smtp perdida, reconectando')
+                client = await self.get_smtp_client()
+                try:
+                    await client.sendmail(self.channel.msg_from, dest_addr, email_data)
+                except Exception:
+                    client.close()
+                    raise
+            self.smtp_idle.append(client)
+        self.sent_messages += 1
+
+    async def get_pop_client(self):
+        if self.pop_client is None:
+            self.pop_client = AsyncPop3Client(self.pop_settings['host'],
+                                              port=self.pop_settings.get('port', None),
+                                              timeout=self.pop_settings.get('timeout', 30),
+                                              tls=self.pop_settings.get('tls', False))
+            await self.pop_client.connect(self.pop_settings['user'], self.pop_settings['pass'])
+        return self.pop_client
+
+    async def load_messages(self):
+        """Busca los mensajes en el servidor pop
+        """
+        channel = self.channel
+        pop_client = await self.get_pop_client()
+        email_parser = ftp2email.emailParser()
+        channel.messages = {}
+        channel.messages_data = {}
+        channel.email_parts = {}
+        channel.marked_parts = {}
+        msg_ids = []
+        seen_uids = channel.load_seen_uids()
+        mailbox_uids = set()
+
+        emails = [x.decode('utf-8').split(' ') for x in await pop_client.uidl()]
+        channel.pop_uids = dict((uid, nro) for nro, uid in emails)
+        for email_nro, email_uid in emails:
+            mailbox_uids.add(email_uid)
+            if email_uid in seen_uids:
+                continue
+            try:
+                headers = email_parser.parse(ftp2email.BytesIO(
+                    b'\n'.join(await pop_client.top(email_nro, 0))), headersonly=True)
+            except Pop3Error:
+                headers = None
+            if headers is not None and not channel.is_sinliarg_headers(headers):
+                seen_uids.add(email_uid)
+                continue
+            try:
+                email_data = b'\n'.join(await pop_client.retr(email_nro))
+            except Pop3Error:
+                logging.error('Error leyendo email uid: %s\n%s' % (email_uid, traceback.format_exc()))
+                continue
+            email = email_parser.parse(ftp2email.BytesIO(email_data))
+            logging.info('Leyendo email asunto: %s' % email.get('subject', None))
+            if channel.is_sinliarg(email):
+                channel.messages[email_uid] = email
+                channel.messages_data[email_uid] = email_data
+                msg_ids.extend(channel.message_ids(email_uid, email))
+            else:
+                seen_uids.add(email_uid)
+
+        channel.save_seen_uids(seen_uids & mailbox_uids)
+        return msg_ids
+
+    async def get_message(self, msg_id):
+        return self.channel.get_message(msg_id)
+
+    async def mark_message(self, msg_id, error=False):
+        """Marca el email para eliminarlo del servidor pop al cerrar el canal
+        """
+        return self.channel.mark_message(msg_id, error)
+
+    async def close(self):
+        """Elimina los emails marcados y cierra las conexiones
+        """
+        channel = self.channel
+        if self.pop_client is not None:
+            for msg_id in channel.pending_deletes:
+                logging.info('Eliminando email uid: %s del servidor POP' % msg_id)
+                await self.pop_client.dele(channel.pop_uids[msg_id])
+            await self.pop_client.quit()
+            self.pop_client = None
+            channel.pending_deletes = []
+        if self.smtp_connections:
+            logging.info('Conexiones smtp abiertas: %d, mensajes enviados: %d'
+                            % (self.smtp_connections, self.sent_messages))
+        while self.smtp_idle:
+            client = self.smtp_idle.pop()
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+
+
+async def read_message(src_channel, msg_id, stats):
+    """Lee un mensaje del canal de origen, devuelve None si no se pudo leer
+    """
+    logging.info('Procesando mensaje id: %s' % msg_id)
+    start = stats_time()
+    try:
+        sinli_message = await src_channel.get_message(msg_id)
+        if src_channel.check_well_formed:
+            await asyncio.get_event_loop().run_in_executor(None, sinli_message.check_well_formed)
+    except (ftp2email.cElementTree.ParseError, ftp2email.AttachmentTooLarge):
+        logging.error('Error error de parseo leyendo el mensaje %s.\n%s', msg_id, traceback.format_exc())
+        stats.count('failed')
+        await src_channel.mark_message(msg_id, True)
+        return None
+    except Exception:
+        logging.error('Error obteniendo datos del mensaje\n%s' % traceback.format_exc())
+        stats.count('failed')
+        return None
+    finally:
+        stats.record('read', stats_time() - start)
+    stats.count('read', sinli_message)
+    return sinli_message
+
+
+async def pipe_message(src_channel, dst_channel, msg_id, sinli_message, stats, previous=None,
+                       dedup=None):
+    """Envia un mensaje y lo marca como leido
+        :previous: tarea del mensaje anterior entre los mismos origen y destino,
+                   se espera a que termine para mantener el orden
+        :dedup: ftp2email.DuplicateIndex, los duplicados se marcan sin enviarlos
+    """
+    if previous is not None:
+        await asyncio.wait([previous])
+    if dedup is not None and not dedup.reserve(sinli_message):
+        logging.info('Mensaje id: %s duplicado, no se envia' % msg_id)
+        stats.count('duplicated', sinli_message)
+        await src_channel.mark_message(msg_id)
+        return
+    start = stats_time()
+    try:
+        logging.info('Enviando mensaje id: %s' % msg_id)
+        await dst_channel.send_message(sinli_message)
+    except Exception:
+        logging.error('Error enviando mensaje\n%s' % traceback.format_exc())
+        stats.count('failed', sinli_message)
+        if dedup is not None:
+            dedup.release(sinli_message)
+        return
+    finally:
+        stats.record('send', stats_time() - start)
+    stats.count('sent', sinli_message)
+    if dedup is not None:
+        dedup.add(sinli_message)
+    start = stats_time()
+    try:
+        await src_channel.mark_message(msg_id)
+    finally:
+        stats.record('mark', stats_time() - start)
+
+
+def stats_time():
+    return asyncio.get_event_loop().time()
+
+
+async def pipe_channels(src_channel, dst_channel, concurrency=100, dedup=None):
+    """Enviar los mensajes de un canal asincronico a otro
+        :concurrency: cantidad maxima de mensajes en curso
+                      Los mensajes entre el mismo origen y destino se envian en orden
+        :dedup: ftp2email.DuplicateIndex para no reenviar mensajes duplicados
+    """
+    logging.info('Envio de mensajes %s->%s iniciado' % (src_channel, dst_channel))
+    stats = ftp2email.PipeStats()
+    semaphore = asyncio.Semaphore(concurrency)
+    last_task = {}
+    tasks = set()
+
+    for msg_id in await src_channel.load_messages():
+        await semaphore.acquire()
+        sinli_message = await read_message(src_channel, msg_id, stats)
+        if sinli_message is None:
+            semaphore.release()
+            continue
+        partner = (sinli_message.src_code, sinli_message.dst_code)
+        task = asyncio.ensure_future(pipe_message(src_channel, dst_channel, msg_id,
+                                                  sinli_message, stats, last_task.get(partner),
+                                                  dedup))
+        task.add_done_callback(lambda t: semaphore.release())
+        task.add_done_callback(tasks.discard)
+        last_task[partner] = task
+        tasks.add(task)
+
+    if tasks:
+        await asyncio.wait(list(tasks))
+    await src_channel.close()
+    await dst_channel.close()
+    stats.finish()
+    logging.info('Envio de mensajes %s->%s finalizado. %s'
+                    % (src_channel, dst_channel, stats.summary()))
+    return stats
+
+
+def unsupported_settings(settings):
+    """Devuelve la configuracion de ftp2email que el motor asyncio no implementa
+    """
+    unsupported = []
+    if settings.get('email_protocol', 'pop') != 'pop':
+        unsupported.append('email_protocol=%s' % settings['email_protocol'])
+    if (settings.get('pop_settings', None) or {}).get('spool_dir', None):
+        unsupported.append('pop_settings.spool_dir')
+    for name in ('journal_file', 'retry_file', 'tenants'):
+        if settings.get(name, None):
+            unsupported.append(name)
+    if (settings.get('email_batch', None) or {}).get('max_messages', 1) > 1:
+        unsupported.append('email_batch')
+    return unsupported
+
+
+def __main__(argv=None):
+    """Intercambia mensajes entre canales usando asyncio
+    """
+    arg_parser = argparse.ArgumentParser(description='Enviar mensajes sinliarg entre distintos canales (asyncio)')
+    arg_parser.add_argument('-i', '--input', required=True,
+                            choices=('files', 'emails'),
+                            help='Canal de entrada (files|email)')
+    arg_parser.add_argument('-o', '--output', required=True,
+                            choices=('files', 'emails'),
+                            help='Canal de salida (files|email)')
+    arg_parser.add_argument('-s', '--settings', default='settings.json',
+                            help='Archivo de configuración')
+    arg_parser.add_argument('-c', '--concurrency', type=int, default=100,
+                            help='Cantidad maxima de mensajes en curso')
+    args = arg_parser.parse_args(argv)
+
+    settings = ftp2email.load_settings(args.settings)
+    unsupported = unsupported_settings(settings)
+    if unsupported:
+        arg_parser.error('Configuracion no soportada por el motor asyncio, usar ftp2email.py: %s'
+                         % ', '.join(unsupported))
+    ftp2email.configure_logging(settings)
+
+    channels_map = {'files': lambda:
+                        SyncChannelAdapter(ftp2email.build_channel('files', settings)),
+                    'emails': lambda:
+                        AsyncEmailChannel(smtp_settings=settings['smtp_settings'],
+                                          pop_settings=settings['pop_settings'],
+                                          msg_from=settings['sinli_email'],
+                                          eaddress_file=settings['eaddress_file'],
+                                          max_connections=settings.get('smtp_connections', 10),
+                                          compression=settings.get('compression', None),
+                                          error_path=os.path.join(settings['base_path'],
+                                                                  'not_well_formed_emails'),
+                                          max_attachment_size=settings.get(
+                                                'max_attachment_size', None))}
+
+    input_channel = channels_map[args.input]()
+    input_channel.check_well_formed = settings.get('check_well_formed', True)
+    output_channel = channels_map[args.output]()
+    dedup = ftp2email.build_dedup_index(settings)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(pipe_channels(input_channel, output_channel, args.concurrency,
+                                              dedup))
+    finally:
+        loop.close()
+        if dedup is not None:
+            dedup.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(__main__())
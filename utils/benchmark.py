@@ -0,0 +1,817 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""Benchmark de ftp2email
+
+    benchmark.py -n 1000 --items 20 -w 4 --latency 0.005 --results benchmark.jsonl
+
+Genera mensajes sinteticos de los tipos PEDIDO, REMITO, FACTURA, CATALOGO y
+CAMBIOPRECIO, levanta servidores SMTP y POP3 (o IMAP con --imap) en localhost dentro del mismo
+proceso y mide mensajes/s, bytes/s y memoria maxima (RSS) de los envios
+files->emails y emails->files.
+
+Cada sentido se ejecuta en un proceso nuevo para que la memoria maxima medida
+corresponda solo a ese envio. Los servidores guardan los emails en disco, de
+modo que su consumo de memoria no se suma al de los canales.
+
+Con --results los resultados se agregan a un archivo (una linea json por
+ejecucion) y se comparan con la ejecucion anterior.
+"""
+
+import argparse
+import csv
+import email.parser as email_parser
+import json
+import logging
+import multiprocessing
+import os
+import re
+import select
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+try:
+    import socketserver
+except ImportError:  # python2
+    import SocketServer as socketserver
+
+try:
+    from utils import ftp2email
+except ImportError:  # ejecutado como script desde utils
+    import ftp2email
+
+
+SINLI_TYPES = ('PEDIDO', 'REMITO', 'FACTURA', 'CATALOGO', 'CAMBIOPRECIO')
+OWN_CODE = 'L0002349'
+DATE = '2012-01-26T09:15:12.0'
+
+
+def ean_check_digit(digits):
+    """Digito verificador EAN-13 de los primeros 12 digitos
+    """
+    total = sum(int(x) * (3 if pos % 2 else 1) for pos, x in enumerate(digits))
+    return str((10 - total % 10) % 10)
+
+
+def isbn10_check_digit(digits):
+    """Digito verificador ISBN-10 de los primeros 9 digitos
+    """
+    check = (11 - sum(int(x) * (10 - pos) for pos, x in enumerate(digits)) % 11) % 11
+    return 'X' if check == 10 else str(check)
+
+
+def gen_book(nro):
+    """Devuelve los datos de un libro sintetico, distinto para cada nro
+    """
+    isbn = '950%06d' % (nro % 1000000)
+    ean = '978' + isbn
+    return {'EAN': ean + ean_check_digit(ean),
+            'ISBN_13': ean + ean_check_digit(ean),
+            'ISBN_10': isbn + isbn10_check_digit(isbn),
+            'COD_ARTICULO': '%06d-%d' % (nro, nro % 10),
+            'TITULO': 'Libro de prueba número %d' % nro,
+            'PRECIO': '%d.%02d' % (100 + nro % 900, nro % 100)}
+
+
+def add_elements(parent, fields):
+    """Agrega a parent un elemento por cada (tag, texto)
+    """
+    for tag, text in fields:
+        ElementTree.SubElement(parent, tag).text = text
+    return parent
+
+
+def add_id_libro(parent, book):
+    return add_elements(ElementTree.SubElement(parent, 'ID_LIBRO'),
+                        [(x, book[x]) for x in ('EAN', 'ISBN_13', 'ISBN_10',
+                                                'COD_ARTICULO', 'TITULO')])
+
+
+def add_precio(parent, value, tag='PRECIO'):
+    return add_elements(ElementTree.SubElement(parent, tag),
+                        [('MONEDA', 'ARS'), ('VALOR', value), ('TIPO', 'PVP')])
+
+
+def add_pedido_content(content, nro, books):
+    add_elements(content, [('NUMERO_DOCUMENTO', str(nro)), ('FECHA', DATE),
+                           ('TIPO_OPERACION', 'CONSIGNACION'), ('TIPO_ENTREGA', 'ENVIO')])
+    detalle = ElementTree.SubElement(content, 'DETALLE')
+    for pos, book in enumerate(books):
+        item = ElementTree.SubElement(detalle, 'ITEM')
+        add_elements(item, [('CANTIDAD', str(pos % 5 + 1))])
+        add_id_libro(item, book)
+
+
+def add_remito_content(content, nro, books):
+    add_elements(content, [('NUMERO_DOCUMENTO', '0001-%08d' % nro), ('FECHA', DATE),
+                           ('TIPO_OPERACION', 'CONSIGNACION'), ('TIPO_ENTREGA', 'ENVIO')])
+    detalle = ElementTree.SubElement(content, 'DETALLE')
+    for pos, book in enumerate(books):
+        item = ElementTree.SubElement(detalle, 'ITEM')
+        add_elements(item, [('CANTIDAD', str(pos % 5 + 1))])
+        add_id_libro(item, book)
+        add_precio(item, book['PRECIO'])
+
+
+def add_factura_content(content, nro, books):
+    add_elements(content, [('LETRA', 'A'), ('NUMERO_DOCUMENTO', '0001-%08d' % nro),
+                           ('FECHA', DATE), ('FECHA_VTO', DATE),
+                           ('TIPO_OPERACION', 'FIRME')])
+    total = ElementTree.SubElement(content, 'TOTAL')
+    detalle = ElementTree.SubElement(content, 'DETALLE')
+    total_value = 0.0
+    for pos, book in enumerate(books):
+        quantity = pos % 5 + 1
+        item_total = quantity * float(book['PRECIO'])
+        total_value += item_total
+        item = ElementTree.SubElement(detalle, 'ITEM')
+        add_elements(item, [('CANTIDAD', str(quantity))])
+        add_id_libro(item, book)
+        add_precio(item, book['PRECIO'])
+        add_elements(item, [('DESCUENTO', '0.00'), ('TOTAL', '%.2f' % item_total)])
+    add_elements(total, [('MONEDA', 'ARS'), ('VALOR', '%.2f' % total_value)])
+
+
+def add_catalogo_content(content, nro, books):
+    for book in books:
+        item = ElementTree.SubElement(content, 'ITEM')
+        add_elements(item, [(x, book[x]) for x in ('ISBN_13', 'ISBN_10', 'EAN',
+                                                   'COD_ARTICULO', 'TITULO')])
+        add_elements(item, [('CONTRATAPA', 'Texto de contratapa de %s' % book['TITULO']),
+                            ('METADATA', 'prueba,benchmark'),
+                            ('EDITORIAL', 'Editorial de prueba'),
+                            ('COLECCION', 'Coleccion de prueba'),
+                            ('CODIGO_BARRACOLECCION', ''),
+                            ('PRECIO_COMPRA', book['PRECIO']), ('MONEDA_COMPRA', 'ARS'),
+                            ('PRECIO_VENTA', book['PRECIO']), ('MONEDA_VENTA', 'ARS'),
+                            ('ESTADO', 'DISPONIBLE'), ('NOVEDAD', 'N'), ('ES_TEXTO', 'S'),
+                            ('PAGINAS', '240'), ('ALTURA', '230'), ('LARGO', '150'),
+                            ('ANCHO', '15'), ('UM', 'mm'), ('PESO', '350'), ('UM_PESO', 'g'),
+                            ('NRO_EDICION', '1'), ('FORMATO', 'BC'),
+                            ('PAIS_IMPRESION', 'AR'), ('ACTIVO', 'S'), ('AGOTADO', 'N'),
+                            ('CATEGORIAS', None), ('AUTORES', None)])
+
+
+def add_cambioprecio_content(content, nro, books):
+    add_elements(content, [('FECHA_VIGENCIA', DATE)])
+    cambios = ElementTree.SubElement(content, 'CAMBIOS')
+    for book in books:
+        cambio = ElementTree.SubElement(cambios, 'CAMBIO_DE_PRECIO')
+        add_id_libro(cambio, book)
+        add_precio(cambio, '%.2f' % (float(book['PRECIO']) * 1.1))
+        add_precio(cambio, book['PRECIO'], tag='PRECIO_ANTERIOR')
+
+
+content_builders = {'PEDIDO': add_pedido_content,
+                    'REMITO': add_remito_content,
+                    'FACTURA': add_factura_content,
+                    'CATALOGO': add_catalogo_content,
+                    'CAMBIOPRECIO': add_cambioprecio_content}
+
+
+def gen_message(sinli_type, src_code, dst_code, items=10, nro=1):
+    """Genera un mensaje sinliarg sintetico valido segun sinliarg.rnc
+        :sinli_type: tipo de mensaje (uno de SINLI_TYPES)
+        :items: cantidad de items del detalle
+        :nro: numero del documento, tambien define los libros incluidos
+        Devuelve el XML del mensaje
+    """
+    root = ElementTree.Element(sinli_type)
+    add_elements(ElementTree.SubElement(root, 'ARCHIVO'),
+                 [('DESCRIPCION', '%s %d de prueba' % (sinli_type, nro)),
+                  ('FECHA', DATE), ('VERSION', '1.0'), ('CODIGO', sinli_type),
+                  ('IDENTIFICADOR', '%s%s%d' % (sinli_type, src_code, nro))])
+    add_elements(ElementTree.SubElement(root, 'ORIGEN'),
+                 [('NOMBRE', 'Origen %s' % src_code), ('CODIGO_SINLI', src_code)])
+    add_elements(ElementTree.SubElement(root, 'DESTINO'),
+                 [('NOMBRE', 'Destino %s' % dst_code), ('CODIGO_SINLI', dst_code)])
+    content_builders[sinli_type](ElementTree.SubElement(root, 'CONTENIDO'), nro,
+                                 [gen_book(nro * items + x) for x in range(items)])
+    return b'<?xml version="1.0" encoding="utf-8"?>\n' \
+                + ElementTree.tostring(root, encoding='utf-8').split(b'?>', 1)[-1].lstrip()
+
+
+def gen_partner_codes(partners):
+    return ['E%07d' % (x + 1) for x in range(partners)]
+
+
+def gen_messages(count, items=10, partners=4, sinli_types=SINLI_TYPES, inbound=False):
+    """Genera count mensajes repartidos entre los tipos y los socios
+        Devuelve tuplas (nombre de archivo, codigo origen, codigo destino, xml)
+        :inbound: mensajes de los socios hacia OWN_CODE, por defecto al reves
+    """
+    partner_codes = gen_partner_codes(partners)
+    for nro in range(count):
+        sinli_type = sinli_types[nro % len(sinli_types)]
+        partner = partner_codes[nro % len(partner_codes)]
+        src_code, dst_code = (partner, OWN_CODE) if inbound else (OWN_CODE, partner)
+        filename = '%s_%s_%s_%d.xml' % (sinli_type, src_code, dst_code, nro)
+        yield filename, src_code, dst_code, gen_message(sinli_type, src_code, dst_code,
+                                                        items, nro + 1)
+
+
+class Mailbox(object):
+    """Casilla de emails guardados en un directorio, compartida por los servidores"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.flags = {}         # uid -> flags imap
+        ftp2email.make_dirs(path)
+
+    def add(self, email_data):
+        with self.lock:
+            self.next_id += 1
+            uid = '%08d' % self.next_id
+        ftp2email.write_file_atomic(os.path.join(self.path, uid), email_data)
+        return uid
+
+    def list(self):
+        """Devuelve los uid y tamaños de los emails de la casilla
+        """
+        return [(x, os.path.getsize(os.path.join(self.path, x)))
+                for x in sorted(os.listdir(self.path))
+                if not x.endswith('.tmp') and os.path.isfile(os.path.join(self.path, x))]
+
+    def read(self, uid):
+        with open(os.path.join(self.path, uid), 'rb') as i:
+            return i.read()
+
+    def delete(self, uid):
+        os.remove(os.path.join(self.path, uid))
+        self.flags.pop(uid, None)
+
+    def move(self, uid, folder, copy=False):
+        """Mueve o copia el email al subdirectorio folder
+        """
+        folder_path = os.path.join(self.path, folder)
+        ftp2email.make_dirs(folder_path)
+        if copy:
+            shutil.copy(os.path.join(self.path, uid), folder_path)
+        else:
+            os.rename(os.path.join(self.path, uid), os.path.join(folder_path, uid))
+            self.flags.pop(uid, None)
+
+
+class BenchmarkServer(socketserver.ThreadingTCPServer):
+    """Servidor TCP en localhost con una casilla y una demora por respuesta"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, mailbox, latency=0.0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        # las respuestas multilinea se escriben en dos partes, sin esto
+        # el ack retardado del cliente agrega ~40ms a cada comando
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections += 1
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def commands(self):
+        """Devuelve (comando, argumentos) por cada linea recibida
+        """
+        for line in iter(self.rfile.readline, b''):
+            parts = line.strip().decode('ascii', 'replace').split(' ', 1)
+            yield parts[0].upper(), parts[1] if len(parts) > 1 else ''
+
+
+class SmtpHandler(LineHandler):
+    """Servidor SMTP minimo, los emails recibidos se guardan en la casilla"""
+
+    def handle(self):
+        self.reply('220 localhost ftp2email benchmark')
+        for command, args in self.commands():
+            if command in ('EHLO', 'HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.mailbox.add(self.read_data())
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def read_data(self):
+        lines = []
+        for line in iter(self.rfile.readline, b''):
+            if line in (b'.\r\n', b'.\n'):
+                break
+            lines.append(line[1:] if line.startswith(b'.') else line)
+        return b''.join(lines)
+
+
+class Pop3Handler(LineHandler):
+    """Servidor POP3 minimo sobre la casilla, los DELE se aplican al hacer QUIT"""
+
+    def handle(self):
+        self.reply('+OK ftp2email benchmark')
+        emails = []
+        deleted = set()
+        for command, args in self.commands():
+            if command == 'USER':
+                self.reply('+OK')
+            elif command == 'PASS':
+                emails = self.server.mailbox.list()
+                self.reply('+OK')
+            elif command == 'STAT':
+                self.reply('+OK %d %d' % (len(emails), sum(x[1] for x in emails)))
+            elif command in ('LIST', 'UIDL'):
+                field = 1 if command == 'LIST' else 0
+                self.reply('+OK')
+                self.send_lines([('%d %s' % (nro + 1, email[field])).encode('ascii')
+                                 for nro, email in enumerate(emails)])
+            elif command in ('RETR', 'TOP'):
+                args = args.split()
+                email_data = self.server.mailbox.read(emails[int(args[0]) - 1][0])
+                lines = email_data.splitlines()
+                if command == 'TOP':
+                    header_end = lines.index(b'') if b'' in lines else len(lines)
+                    lines = lines[:header_end + 1 + int(args[1])]
+                self.reply('+OK')
+                self.send_lines(lines)
+            elif command == 'DELE':
+                deleted.add(emails[int(args) - 1][0])
+                self.reply('+OK')
+            elif command == 'RSET':
+                deleted.clear()
+                self.reply('+OK')
+            elif command == 'NOOP':
+                self.reply('+OK')
+            elif command == 'QUIT':
+                for uid in deleted:
+                    self.server.mailbox.delete(uid)
+                self.reply('+OK')
+                return
+            else:
+                self.reply('-ERR Command not implemented')
+
+    def send_lines(self, lines):
+        self.wfile.write(b''.join((b'.' + x if x.startswith(b'.') else x) + b'\r\n'
+                                  for x in lines) + b'.\r\n')
+
+
+class ImapHandler(LineHandler):
+    """Servidor IMAP minimo sobre la casilla
+        Soporta UID SEARCH, FETCH (BODYSTRUCTURE y secciones), STORE, COPY, MOVE,
+        EXPUNGE e IDLE. Los uid son los nombres de los archivos de la casilla y los
+        flags se guardan en memoria
+    """
+    capabilities = 'IMAP4rev1 IDLE MOVE UIDPLUS'
+
+    def handle(self):
+        self.reply('* OK ftp2email benchmark')
+        for line in iter(self.rfile.readline, b''):
+            parts = line.strip().decode('ascii', 'replace').split(' ', 2)
+            if len(parts) < 2:
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2] if len(parts) > 2 else ''
+            if command == 'UID':
+                command, args = (args.split(' ', 1) + [''])[:2]
+                command = command.upper()
+            if command == 'CAPABILITY':
+                self.reply('* CAPABILITY %s' % self.capabilities)
+            elif command in ('SELECT', 'EXAMINE'):
+                self.reply('* %d EXISTS' % len(self.server.mailbox.list()))
+                self.reply('* OK [UIDVALIDITY 1] UIDs valid')
+            elif command == 'SEARCH':
+                self.reply('* SEARCH %s' % ' '.join(str(int(x)) for x in self.search(args)))
+            elif command == 'FETCH':
+                self.fetch(*args.split(' ', 1))
+            elif command == 'STORE':
+                uid_set, action, flags = args.split(' ', 2)
+                for uid in self.uids(uid_set):
+                    self.server.mailbox.flags.setdefault(uid, set()) \
+                        .update(flags.strip('()').split())
+            elif command in ('COPY', 'MOVE'):
+                uid_set, folder = args.split(' ', 1)
+                uids = self.uids(uid_set)
+                seqs = self.sequence_numbers()
+                for uid in uids:
+                    self.server.mailbox.move(uid, folder.strip('"'), copy=command == 'COPY')
+                if command == 'MOVE':
+                    for uid in sorted(uids, key=seqs.get, reverse=True):
+                        self.reply('* %d EXPUNGE' % seqs[uid])
+            elif command == 'EXPUNGE':
+                seqs = self.sequence_numbers()
+                deleted = [x for x in seqs if '\\Deleted' in self.server.mailbox.flags.get(x, ())]
+                for uid in sorted(deleted, key=seqs.get, reverse=True):
+                    self.server.mailbox.delete(uid)
+                    self.reply('* %d EXPUNGE' % seqs[uid])
+            elif command == 'IDLE':
+                self.idle()
+            elif command == 'LOGOUT':
+                self.reply('* BYE')
+                self.reply('%s OK LOGOUT completed' % tag)
+                return
+            elif command not in ('LOGIN', 'NOOP', 'CLOSE'):
+                self.reply('%s BAD Command not implemented' % tag)
+                continue
+            self.reply('%s OK %s completed' % (tag, command))
+
+    def sequence_numbers(self):
+        return dict((uid, nro + 1) for nro, (uid, size) in enumerate(self.server.mailbox.list()))
+
+    def uids(self, uid_set):
+        """Devuelve los uid de la casilla incluidos en un conjunto como 1,3:5 o 2:*
+        """
+        existing = [x[0] for x in self.server.mailbox.list()]
+        uids = []
+        for item in uid_set.split(','):
+            start, end = (item.split(':') + [item])[:2]
+            end = int(existing[-1]) if end == '*' and existing else int(end or 0)
+            uids.extend(x for x in existing if int(start) <= int(x) <= end)
+        return uids
+
+    def search(self, args):
+        tokens = shlex.split(args)
+        uids = []
+        for uid, size in self.server.mailbox.list():
+            flags = self.server.mailbox.flags.get(uid, set())
+            email = email_parser.BytesParser().parsebytes(self.server.mailbox.read(uid),
+                                                          headersonly=True)
+            matches = True
+            pos = 0
+            while pos < len(tokens):
+                token = tokens[pos].upper()
+                if token == 'UNDELETED':
+                    matches = matches and '\\Deleted' not in flags
+                elif token == 'UNSEEN':
+                    matches = matches and '\\Seen' not in flags
+                elif token in ('KEYWORD', 'UNKEYWORD', 'SUBJECT'):
+                    pos += 1
+                    if token == 'SUBJECT':
+                        matches = matches and tokens[pos].lower() in email.get('subject', '').lower()
+                    else:
+                        matches = matches and (tokens[pos] in flags) == (token == 'KEYWORD')
+                pos += 1
+            if matches:
+                uids.append(uid)
+        return uids
+
+    def fetch(self, uid_set, items):
+        seqs = self.sequence_numbers()
+        items = re.findall(r'[A-Z0-9.]+(?:\[[^\]]*\])?', items.upper())
+        for uid in self.uids(uid_set):
+            email_data = self.server.mailbox.read(uid)
+            email = email_parser.BytesParser().parsebytes(email_data)
+            response = [('* %d FETCH (UID %d' % (seqs[uid], int(uid))).encode('ascii')]
+            for item in items:
+                if item == 'BODYSTRUCTURE':
+                    response.append(b' BODYSTRUCTURE ' + self.bodystructure(email).encode('utf-8'))
+                elif item.startswith('BODY'):
+                    name = item.replace('.PEEK', '')
+                    data = self.section(email_data, email, name[5:-1])
+                    response.append((' %s {%d}\r\n' % (name, len(data))).encode('ascii') + data)
+            self.wfile.write(b''.join(response) + b')\r\n')
+
+    @staticmethod
+    def section(email_data, email, section):
+        """Devuelve el contenido de una seccion (BODY[section]) del email
+        """
+        header_end = email_data.find(b'\r\n\r\n')
+        header_end = header_end + 4 if header_end >= 0 else len(email_data)
+        if section == '':
+            return email_data
+        if section == 'HEADER':
+            return email_data[:header_end]
+        if section == 'TEXT':
+            return email_data[header_end:]
+        path = section.split('.')
+        mime = path[-1] == 'MIME'
+        part = email
+        for nro in path[:-1] if mime else path:
+            if part.is_multipart():
+                part = part.get_payload()[int(nro) - 1]
+        if mime:
+            return (''.join('%s: %s\r\n' % x for x in part.items()) + '\r\n').encode('utf-8')
+        return part.get_payload().encode('ascii', 'surrogateescape')
+
+    @classmethod
+    def bodystructure(cls, part):
+        def quote(value):
+            return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+        def param_list(params):
+            return '(%s)' % ' '.join('%s %s' % (quote(k), quote(v)) for k, v in params) \
+                    if params else 'NIL'
+
+        if part.is_multipart():
+            return '(%s %s %s NIL NIL NIL)' % (
+                        ''.join(cls.bodystructure(x) for x in part.get_payload()),
+                        quote(part.get_content_subtype()),
+                        param_list([('boundary', part.get_boundary())]))
+        payload = part.get_payload()
+        fields = '%s %s %s NIL NIL %s %d' % (
+                    quote(part.get_content_maintype()), quote(part.get_content_subtype()),
+                    param_list(part.get_params()[1:] if part.get_params() else []),
+                    quote(part.get('content-transfer-encoding', '7bit')), len(payload))
+        if part.get_content_maintype() == 'text':
+            fields += ' %d' % len(payload.splitlines())
+        disposition = 'NIL'
+        if part.get_content_disposition():
+            disposition = '(%s %s)' % (quote(part.get_content_disposition()),
+                                       param_list([('filename', part.get_filename())]
+                                                  if part.get_filename() else []))
+        return '(%s NIL %s NIL NIL)' % (fields, disposition)
+
+    def idle(self):
+        """Avisa con EXISTS la llegada de emails hasta recibir DONE
+        """
+        self.reply('+ idling')
+        count = len(self.server.mailbox.list())
+        while True:
+            if select.select([self.request], [], [], 0.05)[0]:
+                self.rfile.readline()       # DONE
+                return
+            current = len(self.server.mailbox.list())
+            if current > count:
+                self.reply('* %d EXISTS' % current)
+            count = current
+
+
+def prepare(work_path, count, items, partners, sinli_types, compression=None, batch=None):
+    """Genera los mensajes de entrada de ambos sentidos en work_path
+        files->emails: directorios OWN_CODE_socio con los archivos a enviar
+        emails->files: casilla con los emails que enviaria cada socio
+        :compression: 'gzip' o 'zip' para comprimir los adjuntos de los emails
+        :batch: cantidad de mensajes de cada socio agrupados en un email
+        Devuelve la cantidad de bytes de XML de cada sentido
+    """
+    outbound_path = os.path.join(work_path, 'outbound')
+    outbound_bytes = 0
+    for filename, src_code, dst_code, xml in gen_messages(count, items, partners,
+                                                          sinli_types):
+        dir_path = os.path.join(outbound_path, '%s_%s' % (src_code, dst_code))
+        ftp2email.make_dirs(dir_path)
+        with open(os.path.join(dir_path, filename), 'wb') as o:
+            o.write(xml)
+        outbound_bytes += len(xml)
+
+    eaddress_file = os.path.join(work_path, 'email_address.csv')
+    with open(eaddress_file, 'w') as o:
+        writer = csv.writer(o)
+        for code in gen_partner_codes(partners) + [OWN_CODE]:
+            writer.writerow([code, '%s@localhost' % code.lower()])
+
+    mailbox = Mailbox(os.path.join(work_path, 'inbox'))
+    email_channel = ftp2email.EmailChannel({}, {}, 'benchmark@localhost', eaddress_file,
+                                           compression={OWN_CODE: compression})
+    inbound_bytes = 0
+    batches = {}
+    for filename, src_code, dst_code, xml in gen_messages(count, items, partners,
+                                                          sinli_types, inbound=True):
+        batches.setdefault(src_code, []).append(ftp2email.SinliargMessage(xml, filename=filename))
+        inbound_bytes += len(xml)
+        if len(batches[src_code]) >= (batch or 1):
+            add_email(mailbox, email_channel, batches.pop(src_code))
+    for messages in batches.values():
+        add_email(mailbox, email_channel, messages)
+    return {'files2emails': outbound_bytes, 'emails2files': inbound_bytes}
+
+
+def add_email(mailbox, email_channel, messages):
+    """Agrega a la casilla un email con los mensajes
+    """
+    if len(messages) == 1:
+        email_data = email_channel.build_email(messages[0])[1]
+    else:
+        email_data = email_channel.build_batch_email('benchmark@localhost', messages)
+    mailbox.add(email_data.encode('utf-8'))
+
+
+def run_direction(direction, work_path, workers=1, latency=0.0, compression=None, batch=None,
+                  protocol='pop'):
+    """Ejecuta un sentido del envio contra los servidores locales
+        :direction: 'files2emails' o 'emails2files'
+        :compression: 'gzip' o 'zip' para comprimir los adjuntos enviados
+        :batch: cantidad maxima de mensajes por email enviado
+        :protocol: 'pop' o 'imap' para leer los emails, con imap los emails
+                   procesados se mueven a la carpeta Procesados
+        Devuelve un dict con las mediciones
+    """
+    smtp_server = BenchmarkServer(SmtpHandler, Mailbox(os.path.join(work_path, 'outbox')),
+                                  latency).start()
+    pop_server = BenchmarkServer(ImapHandler if protocol == 'imap' else Pop3Handler,
+                                 Mailbox(os.path.join(work_path, 'inbox')), latency).start()
+    smtp_settings = {'host': '127.0.0.1', 'port': smtp_server.port, 'user': None, 'pass': None}
+    inbound_settings = {'host': '127.0.0.1', 'port': pop_server.port,
+                        'user': 'benchmark', 'pass': 'benchmark'}
+    channel_args = {'msg_from': 'benchmark@localhost',
+                    'eaddress_file': os.path.join(work_path, 'email_address.csv'),
+                    'compression': dict((x, compression) for x in email_channel_codes(work_path))
+                                   if compression else None,
+                    'batch': {'max_messages': batch} if batch else None,
+                    'error_path': os.path.join(work_path, 'errors', 'not_well_formed_emails')}
+    if protocol == 'imap':
+        email_channel = ftp2email.ImapChannel(smtp_settings,
+                                              dict(inbound_settings,
+                                                   processed_mailbox='Procesados'),
+                                              **channel_args)
+    else:
+        email_channel = ftp2email.EmailChannel(smtp_settings, inbound_settings, **channel_args)
+    if direction == 'files2emails':
+        src_channel = ftp2email.FilesystemChannel(os.path.join(work_path, 'outbound'), '_')
+        dst_channel = email_channel
+    else:
+        src_channel = email_channel
+        dst_channel = ftp2email.FilesystemChannel(os.path.join(work_path, 'received'), '_')
+
+    email_bytes = sum(x[1] for x in pop_server.mailbox.list())
+    rss_start = peak_rss()
+    try:
+        stats = ftp2email.pipeChannels(src_channel, dst_channel, workers)
+    finally:
+        smtp_server.stop()
+        pop_server.stop()
+    if direction == 'files2emails':
+        email_bytes = sum(x[1] for x in smtp_server.mailbox.list())
+    return {'email_bytes': email_bytes,
+            'messages': stats.counters['sent'],
+            'failed': stats.counters['failed'],
+            'elapsed': round(stats.elapsed(), 4),
+            'messages_per_sec': round(stats.throughput(), 2),
+            'rss_start_kb': rss_start,
+            'peak_rss_kb': peak_rss(),
+            'connections': smtp_server.connections + pop_server.connections}
+
+
+def email_channel_codes(work_path):
+    """Codigos sinli de la libreta de direcciones generada por prepare
+    """
+    with open(os.path.join(work_path, 'email_address.csv')) as i:
+        return [x[0] for x in csv.reader(i)]
+
+
+def peak_rss():
+    """Memoria maxima usada por el proceso en KB, None si no se puede medir
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_direction_process(args):
+    logging.basicConfig(level=logging.WARNING)
+    return run_direction(*args)
+
+
+def run_benchmark(count=500, items=10, partners=4, workers=1, latency=0.0,
+                  sinli_types=SINLI_TYPES, work_path=None, compression=None, batch=None,
+                  protocol='pop'):
+    """Prepara los mensajes y ejecuta ambos sentidos, cada uno en un proceso nuevo
+        Devuelve un dict con las mediciones de cada sentido
+    """
+    tmp_path = work_path or tempfile.mkdtemp(prefix='ftp2email-benchmark-')
+    try:
+        xml_bytes = prepare(tmp_path, count, items, partners, sinli_types, compression, batch)
+        results = {}
+        context = multiprocessing.get_context('spawn')
+        for direction in ('files2emails', 'emails2files'):
+            pool = context.Pool(1)
+            try:
+                result = pool.apply(run_direction_process,
+                                    ((direction, tmp_path, workers, latency, compression,
+                                      batch, protocol),))
+            finally:
+                pool.terminate()
+            result['bytes'] = xml_bytes[direction]
+            result['bytes_per_sec'] = round(result['bytes'] / result['elapsed'], 2) \
+                                        if result['elapsed'] else 0.0
+            results[direction] = result
+        return results
+    finally:
+        if work_path is None:
+            shutil.rmtree(tmp_path)
+
+
+def get_version():
+    """Version del codigo medido (git describe), None fuera de un repositorio
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(results_file):
+    """Lee las ejecuciones guardadas en results_file
+    """
+    if not os.path.isfile(results_file):
+        return []
+    with open(results_file) as i:
+        return [json.loads(line) for line in i if line.strip()]
+
+
+def compare(previous, current):
+    """Devuelve lineas de texto con la diferencia entre dos ejecuciones
+    """
+    lines = ['Comparacion con %s (%s)' % (previous.get('version'), previous.get('date'))]
+    for direction, result in sorted(current['results'].items()):
+        old = previous['results'].get(direction, {})
+        for key in ('messages_per_sec', 'bytes_per_sec', 'email_bytes', 'peak_rss_kb'):
+            if old.get(key) and result.get(key) is not None:
+                lines.append('  %s %s: %s -> %s (%+.1f%%)'
+                             % (direction, key, old[key], result[key],
+                                (result[key] - old[key]) * 100.0 / old[key]))
+    return lines
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Benchmark de ftp2email')
+    arg_parser.add_argument('-n', '--count', type=int, default=500,
+                            help='Cantidad de mensajes por sentido')
+    arg_parser.add_argument('--items', type=int, default=10,
+                            help='Cantidad de items por mensaje')
+    arg_parser.add_argument('--partners', type=int, default=4,
+                            help='Cantidad de socios entre los que se reparten los mensajes')
+    arg_parser.add_argument('--types', default=','.join(SINLI_TYPES),
+                            help='Tipos de mensaje separados por coma')
+    arg_parser.add_argument('-w', '--workers', type=int, default=1,
+                            help='Cantidad de threads de envio')
+    arg_parser.add_argument('--latency', type=float, default=0.0,
+                            help='Demora en segundos de cada respuesta de los servidores')
+    arg_parser.add_argument('--compression', choices=('gzip', 'zip'), default=None,
+                            help='Comprimir los adjuntos de los emails')
+    arg_parser.add_argument('--batch', type=int, default=None,
+                            help='Cantidad maxima de mensajes por email')
+    arg_parser.add_argument('--imap', action='store_true',
+                            help='Leer los emails por IMAP en lugar de POP3')
+    arg_parser.add_argument('--results', default=None,
+                            help='Archivo donde se agregan los resultados (una linea json por ejecucion)')
+    args = arg_parser.parse_args(argv)
+
+    sinli_types = tuple(x.strip().upper() for x in args.types.split(','))
+    unknown = [x for x in sinli_types if x not in content_builders]
+    if unknown:
+        arg_parser.error('Tipos de mensaje desconocidos: %s' % ', '.join(unknown))
+
+    params = {'count': args.count, 'items': args.items, 'partners': args.partners,
+              'types': list(sinli_types), 'workers': args.workers, 'latency': args.latency}
+    if args.compression:
+        params['compression'] = args.compression
+    if args.batch:
+        params['batch'] = args.batch
+    if args.imap:
+        params['protocol'] = 'imap'
+    run = {'version': get_version(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': sys.version.split()[0], 'params': params,
+           'results': run_benchmark(args.count, args.items, args.partners, args.workers,
+                                    args.latency, sinli_types,
+                                    compression=args.compression, batch=args.batch,
+                                    protocol='imap' if args.imap else 'pop')}
+    print(json.dumps(run, indent=2, sort_keys=True))
+
+    if args.results:
+        comparable = [x for x in load_results(args.results) if x.get('params') == params]
+        if comparable:
+            print('\n'.join(compare(comparable[-1], run)))
+        with open(args.results, 'a') as o:
+            o.write(json.dumps(run, sort_keys=True) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""Aplica mensajes CAMBIOPRECIO a un catalogo
+
+    catalogo.py CATALOGO.xml CAMBIOPRECIO_1.xml CAMBIOPRECIO_2.xml -o precios.csv --diferencias dif.csv
+
+El catalogo se carga en columnas (arrays de numpy) ordenadas por EAN. Cada
+mensaje CAMBIOPRECIO se aplica de una vez sobre todas sus filas, en el orden de
+su FECHA_VIGENCIA. Los libros se buscan por EAN y, si el cambio no tiene EAN o
+no esta en el catalogo, por ISBN_13 o COD_ARTICULO.
+
+Un cambio cuyo PRECIO_ANTERIOR (valor o moneda) no coincide con el precio del
+catalogo se informa como diferencia. Por defecto igual se aplica, con
+--omitir-diferencias se deja el precio del catalogo.
+
+Requiere numpy.
+"""
+
+import argparse
+import csv
+import logging
+import sys
+
+import numpy
+
+try:
+    from utils import ftp2email
+except ImportError:  # ejecutado como script desde utils
+    import ftp2email
+
+
+def ean_key(value):
+    """Convierte un EAN (o ISBN_13 con guiones) en el entero usado como indice, -1 si no es valido
+    """
+    digits = (value or '').strip().replace('-', '')
+    return int(digits) if digits.isdigit() and len(digits) <= 18 else -1
+
+
+def iter_items(source, item_path=None, fields=None):
+    """Items de un mensaje, source es un SinliargMessage, un nombre de archivo o un archivo
+        :fields: dict path -> texto que se completa en la misma lectura (ver
+                 SinliargMessage.iter_file_items)
+    """
+    if isinstance(source, ftp2email.SinliargMessage):
+        return source.iter_items(item_path, fields)
+    return ftp2email.SinliargMessage.iter_file_items(source, item_path, fields)
+
+
+def parse_decimal(value, default=numpy.nan):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class PriceChanges(object):
+    """Cambios de precio de un mensaje CAMBIOPRECIO, en columnas"""
+
+    def __init__(self, ean, precio, moneda, precio_anterior, moneda_anterior,
+                 descuento=None, isbn_13=None, cod_articulo=None, fecha_vigencia='',
+                 identifier=None):
+        """
+            :ean: EAN de cada cambio (ver ean_key), -1 si no tiene
+            :precio, moneda: precio nuevo
+            :precio_anterior, moneda_anterior: precio que el emisor espera reemplazar
+            :descuento: descuento de cada cambio, NaN si no tiene
+            :isbn_13, cod_articulo: codigos para buscar los cambios sin EAN
+            :fecha_vigencia: FECHA_VIGENCIA del mensaje
+            :identifier: identificador del mensaje, para informar las diferencias
+        """
+        self.ean = numpy.asarray(ean, dtype=numpy.int64)
+        size = len(self.ean)
+        self.precio = numpy.asarray(precio, dtype=numpy.float64)
+        self.moneda = numpy.asarray(moneda, dtype='U3')
+        self.precio_anterior = numpy.asarray(precio_anterior, dtype=numpy.float64)
+        self.moneda_anterior = numpy.asarray(moneda_anterior, dtype='U3')
+        self.descuento = numpy.full(size, numpy.nan) if descuento is None \
+                            else numpy.asarray(descuento, dtype=numpy.float64)
+        self.isbn_13 = numpy.asarray(isbn_13 if isbn_13 is not None else [''] * size,
+                                     dtype=object)
+        self.cod_articulo = numpy.asarray(cod_articulo if cod_articulo is not None
+                                          else [''] * size, dtype=object)
+        self.fecha_vigencia = fecha_vigencia or ''
+        self.identifier = identifier
+
+    def __len__(self):
+        return len(self.ean)
+
+    @classmethod
+    def read(cls, source):
+        """Lee un mensaje CAMBIOPRECIO de un SinliargMessage, nombre de archivo o archivo
+        """
+        fields = {'CONTENIDO/FECHA_VIGENCIA': None, 'ARCHIVO/IDENTIFICADOR': None}
+        columns = dict((x, []) for x in ('ean', 'isbn_13', 'cod_articulo', 'precio', 'moneda',
+                                        'descuento', 'precio_anterior', 'moneda_anterior'))
+        for item in iter_items(source, 'CONTENIDO/CAMBIOS/CAMBIO_DE_PRECIO', fields):
+            columns['ean'].append(ean_key(item.findtext('ID_LIBRO/EAN')))
+            columns['isbn_13'].append(item.findtext('ID_LIBRO/ISBN_13') or '')
+            columns['cod_articulo'].append(item.findtext('ID_LIBRO/COD_ARTICULO') or '')
+            columns['precio'].append(parse_decimal(item.findtext('PRECIO/VALOR')))
+            columns['moneda'].append(item.findtext('PRECIO/MONEDA') or '')
+            columns['descuento'].append(parse_decimal(item.findtext('DESCUENTO')))
+            columns['precio_anterior'].append(parse_decimal(item.findtext('PRECIO_ANTERIOR/VALOR')))
+            columns['moneda_anterior'].append(item.findtext('PRECIO_ANTERIOR/MONEDA') or '')
+        return cls(fecha_vigencia=fields['CONTENIDO/FECHA_VIGENCIA'],
+                   identifier=fields['ARCHIVO/IDENTIFICADOR'], **columns)
+
+
+class Catalog(object):
+    """Catalogo en columnas ordenadas por EAN"""
+
+    def __init__(self, ean, precio, moneda, isbn_13=None, cod_articulo=None, titulo=None):
+        """
+            :ean: EAN de cada libro (ver ean_key), los libros sin EAN valido se descartan
+                  y si un EAN se repite se usa el primero
+            :precio, moneda: PRECIO_VENTA y MONEDA_VENTA de cada libro
+        """
+        ean = numpy.asarray(ean, dtype=numpy.int64)
+        size = len(ean)
+        columns = {'precio': numpy.asarray(precio, dtype=numpy.float64),
+                   'moneda': numpy.asarray(moneda, dtype='U3'),
+                   'isbn_13': numpy.asarray(isbn_13 if isbn_13 is not None else [''] * size,
+                                            dtype=object),
+                   'cod_articulo': numpy.asarray(cod_articulo if cod_articulo is not None
+                                                 else [''] * size, dtype=object),
+                   'titulo': numpy.asarray(titulo if titulo is not None else [''] * size,
+                                           dtype=object)}
+        order = numpy.argsort(ean, kind='stable')
+        ean = ean[order]
+        keep = (ean >= 0) & numpy.concatenate(([True], ean[1:] != ean[:-1]))
+        self.discarded = size - int(keep.sum())
+        if self.discarded:
+            logging.warning('%d libros del catalogo sin EAN o con EAN repetido'
+                            % self.discarded)
+        self.ean = ean[keep]
+        for name, values in columns.items():
+            setattr(self, name, values[order][keep])
+        size = len(self.ean)
+        self.precio_original = self.precio.copy()
+        self.moneda_original = self.moneda.copy()
+        self.descuento = numpy.full(size, numpy.nan)
+        self.fecha_vigencia = numpy.full(size, '', dtype='U32')
+        self.changed = numpy.zeros(size, dtype=bool)
+        self.mismatches = []        # un array estructurado por mensaje aplicado
+        self._code_index = None
+
+    def __len__(self):
+        return len(self.ean)
+
+    @classmethod
+    def read(cls, source):
+        """Lee un mensaje CATALOGO de un SinliargMessage, nombre de archivo o archivo
+        """
+        columns = dict((x, []) for x in ('ean', 'isbn_13', 'cod_articulo', 'titulo',
+                                        'precio', 'moneda'))
+        for item in iter_items(source, 'CONTENIDO/ITEM'):
+            isbn_13 = item.findtext('ISBN_13') or ''
+            ean = ean_key(item.findtext('EAN'))
+            columns['ean'].append(ean if ean >= 0 else ean_key(isbn_13))
+            columns['isbn_13'].append(isbn_13)
+            columns['cod_articulo'].append(item.findtext('COD_ARTICULO') or '')
+            columns['titulo'].append(item.findtext('TITULO') or '')
+            columns['precio'].append(parse_decimal(item.findtext('PRECIO_VENTA')))
+            columns['moneda'].append(item.findtext('MONEDA_VENTA') or '')
+        return cls(**columns)
+
+    def lookup(self, ean):
+        """Devuelve la posicion en el catalogo de cada EAN, -1 si no esta
+        """
+        ean = numpy.asarray(ean, dtype=numpy.int64)
+        if not len(self.ean):
+            return numpy.full(len(ean), -1, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(self.ean, ean), len(self.ean) - 1)
+        return numpy.where(self.ean[positions] == ean, positions, -1)
+
+    def lookup_codes(self, changes, positions):
+        """Busca por ISBN_13 o COD_ARTICULO los cambios que no se encontraron por EAN
+        """
+        missing = numpy.flatnonzero(positions < 0)
+        if not len(missing):
+            return positions
+        if self._code_index is None:
+            self._code_index = {}
+            for column in ('cod_articulo', 'isbn_13'):
+                for position, code in enumerate(getattr(self, column)):
+                    if code:
+                        self._code_index.setdefault((column, code), position)
+        for row in missing:
+            for column in ('isbn_13', 'cod_articulo'):
+                code = getattr(changes, column)[row]
+                if code and (column, code) in self._code_index:
+                    positions[row] = self._code_index[(column, code)]
+                    break
+        return positions
+
+    def apply(self, messages, tolerance=0.005, skip_mismatches=False):
+        """Aplica los cambios de precio de uno o varios mensajes
+            Los mensajes se aplican en orden de FECHA_VIGENCIA
+            :messages: PriceChanges o lista de PriceChanges
+            :tolerance: diferencia maxima aceptada entre PRECIO_ANTERIOR y el precio actual
+            :skip_mismatches: no aplicar los cambios con diferencias
+            Devuelve un dict con la cantidad de cambios aplicados, con diferencias
+            y no encontrados
+        """
+        if isinstance(messages, PriceChanges):
+            messages = [messages]
+        totals = {'applied': 0, 'mismatched': 0, 'not_found': 0}
+        for changes in sorted(messages, key=lambda x: x.fecha_vigencia):
+            for name, count in self.apply_changes(changes, tolerance, skip_mismatches).items():
+                totals[name] += count
+        return totals
+
+    def apply_changes(self, changes, tolerance=0.005, skip_mismatches=False):
+        """Aplica los cambios de un mensaje sobre todas las filas a la vez
+        """
+        positions = self.lookup_codes(changes, self.lookup(changes.ean))
+        rows = numpy.flatnonzero(positions >= 0)
+        # si un libro se repite en el mensaje vale el ultimo cambio
+        last = numpy.unique(positions[rows][::-1], return_index=True)[1]
+        rows = rows[::-1][last]
+        targets = positions[rows]
+
+        mismatch = (numpy.abs(self.precio[targets] - changes.precio_anterior[rows]) > tolerance) \
+                    | (self.moneda[targets] != changes.moneda_anterior[rows])
+        if mismatch.any():
+            self.add_mismatches(changes, rows[mismatch], targets[mismatch])
+        if skip_mismatches:
+            rows = rows[~mismatch]
+            targets = targets[~mismatch]
+
+        self.precio[targets] = changes.precio[rows]
+        self.moneda[targets] = changes.moneda[rows]
+        self.descuento[targets] = changes.descuento[rows]
+        self.fecha_vigencia[targets] = changes.fecha_vigencia
+        self.changed[targets] = True
+        return {'applied': len(targets), 'mismatched': int(mismatch.sum()),
+                'not_found': int((positions < 0).sum())}
+
+    mismatch_dtype = [('identifier', object), ('ean', numpy.int64),
+                      ('precio', numpy.float64), ('moneda', 'U3'),
+                      ('precio_anterior', numpy.float64), ('moneda_anterior', 'U3'),
+                      ('precio_nuevo', numpy.float64)]
+
+    def add_mismatches(self, changes, rows, targets):
+        mismatches = numpy.zeros(len(rows), dtype=self.mismatch_dtype)
+        mismatches['identifier'] = changes.identifier
+        mismatches['ean'] = self.ean[targets]
+        mismatches['precio'] = self.precio[targets]
+        mismatches['moneda'] = self.moneda[targets]
+        mismatches['precio_anterior'] = changes.precio_anterior[rows]
+        mismatches['moneda_anterior'] = changes.moneda_anterior[rows]
+        mismatches['precio_nuevo'] = changes.precio[rows]
+        self.mismatches.append(mismatches)
+
+    @staticmethod
+    def format_decimal(value):
+        return '' if numpy.isnan(value) else '%.2f' % value
+
+    def write_csv(self, filename, changed_only=False):
+        """Escribe el catalogo con los precios actualizados
+            :changed_only: solo los libros con cambios de precio
+        """
+        rows = numpy.flatnonzero(self.changed) if changed_only else range(len(self))
+        with open(filename, 'w', newline='') as o:
+            writer = csv.writer(o)
+            writer.writerow(['EAN', 'ISBN_13', 'COD_ARTICULO', 'TITULO', 'PRECIO', 'MONEDA',
+                             'DESCUENTO', 'FECHA_VIGENCIA', 'PRECIO_ORIGINAL',
+                             'MONEDA_ORIGINAL'])
+            for row in rows:
+                writer.writerow(['%013d' % self.ean[row], self.isbn_13[row],
+                                 self.cod_articulo[row], self.titulo[row],
+                                 self.format_decimal(self.precio[row]), self.moneda[row],
+                                 self.format_decimal(self.descuento[row]),
+                                 self.fecha_vigencia[row],
+                                 self.format_decimal(self.precio_original[row]),
+                                 self.moneda_original[row]])
+
+    def write_mismatches(self, filename):
+        """Escribe los cambios cuyo PRECIO_ANTERIOR no coincidia con el catalogo
+        """
+        with open(filename, 'w', newline='') as o:
+            writer = csv.writer(o)
+            writer.writerow(['IDENTIFICADOR', 'EAN', 'PRECIO', 'MONEDA', 'PRECIO_ANTERIOR',
+                             'MONEDA_ANTERIOR', 'PRECIO_NUEVO'])
+            for mismatches in self.mismatches:
+                for row in mismatches:
+                    writer.writerow([row['identifier'] or '', '%013d' % row['ean'],
+                                     self.format_decimal(row['precio']), row['moneda'],
+                                     self.format_decimal(row['precio_anterior']),
+                                     row['moneda_anterior'],
+                                     self.format_decimal(row['precio_nuevo'])])
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Aplicar mensajes CAMBIOPRECIO a un catalogo')
+    arg_parser.add_argument('catalog', help='Mensaje CATALOGO')
+    arg_parser.add_argument('changes', nargs='+', help='Mensajes CAMBIOPRECIO')
+    arg_parser.add_argument('-o', '--output', required=True,
+                            help='Archivo csv con el catalogo actualizado')
+    arg_parser.add_argument('--solo-cambios', action='store_true',
+                            help='Escribir solo los libros con cambios de precio')
+    arg_parser.add_argument('--diferencias', default=None,
+                            help='Archivo csv con los cambios cuyo precio anterior no coincide')
+    arg_parser.add_argument('--omitir-diferencias', action='store_true',
+                            help='No aplicar los cambios cuyo precio anterior no coincide')
+    arg_parser.add_argument('--tolerancia', type=float, default=0.005,
+                            help='Diferencia maxima aceptada con el precio anterior')
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s|%(message)s')
+
+    catalog = Catalog.read(args.catalog)
+    totals = catalog.apply([PriceChanges.read(x) for x in args.changes],
+                           args.tolerancia, args.omitir_diferencias)
+    catalog.write_csv(args.output, changed_only=args.solo_cambios)
+    if args.diferencias:
+        catalog.write_mismatches(args.diferencias)
+    print('%d libros, %d cambios aplicados, %d con diferencias, %d no encontrados'
+          % (len(catalog), totals['applied'], totals['mismatched'], totals['not_found']),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""Genera los cambios entre dos versiones de un catalogo
+
+    delta_catalogo.py CATALOGO_anterior.xml CATALOGO_nuevo.xml --catalogo CATALOGO_cambios.xml --precios CAMBIOPRECIO.xml --bajas bajas.csv
+
+Compara los items de los dos mensajes CATALOGO por EAN (o COD_ARTICULO si no
+tiene EAN) y escribe solo lo necesario para pasar del anterior al nuevo:
+
+ * los titulos nuevos y los que cambiaron en algo mas que el precio de venta
+   van completos en un CATALOGO reducido (--catalogo)
+ * los que solo cambiaron PRECIO_VENTA o MONEDA_VENTA van en un CAMBIOPRECIO
+   (--precios) con el precio anterior, vigente desde --vigencia o si no se
+   indica desde la FECHA del catalogo nuevo
+ * los que ya no estan en el catalogo nuevo se listan en --bajas
+
+Los catalogos se leen item por item y de cada item del anterior solo se
+guarda un hash del contenido en una base sqlite temporal (en --temporal), por
+lo que la memoria usada no depende del tamaño de los catalogos. El orden de
+los elementos del item, los espacios alrededor de los textos y
+FECHA_ULTIMA_MODIFICACION no cuentan como cambios.
+
+Si no hay titulos para un mensaje no se escribe, la gramatica no admite
+mensajes sin items.
+"""
+
+import argparse
+import csv
+import decimal
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+try:
+    from utils import ftp2email
+except ImportError:  # ejecutado como script desde utils
+    import ftp2email
+
+
+PRICE_FIELDS = ('PRECIO_VENTA', 'MONEDA_VENTA')
+IGNORED_FIELDS = ('FECHA_ULTIMA_MODIFICACION',)
+DECIMAL_FIELDS = ('PRECIO_COMPRA', 'PRECIO_VENTA')
+CURRENCIES = ('ARS', 'USD', 'EUR')
+ID_LIBRO_FIELDS = ('EAN', 'ISBN_13', 'ISBN_10', 'COD_ARTICULO', 'TITULO')
+
+
+def item_key(item):
+    """Clave del item: el EAN o si no tiene el COD_ARTICULO, None si no tiene ninguno
+    """
+    ean = (item.findtext('EAN') or '').strip()
+    if ean:
+        return 'EAN:' + ean
+    cod_articulo = (item.findtext('COD_ARTICULO') or '').strip()
+    return 'COD:' + cod_articulo if cod_articulo else None
+
+
+def canonical_text(elem):
+    """Texto de elem y sus subelementos sin los espacios de formato
+        Cada elemento se escribe con su cantidad de hijos para que dos
+        estructuras distintas no den el mismo texto
+    """
+    parts = []
+    for node in elem.iter():
+        text = (node.text or '').strip()
+        if node.tag in DECIMAL_FIELDS:
+            try:
+                text = str(decimal.Decimal(text).normalize())
+            except decimal.InvalidOperation:
+                pass
+        parts.extend([node.tag, repr(sorted(node.attrib.items())), str(len(node)), text,
+                      (node.tail or '').strip() if node is not elem else ''])
+    return ('\0'.join(parts) + '\0').encode('utf-8')
+
+
+def item_digests(item):
+    """Devuelve (hash del contenido, hash del contenido sin el precio de venta)
+        Los subelementos se ordenan por tag, en el CATALOGO pueden ir en
+        cualquier orden
+    """
+    full = hashlib.sha1()
+    base = hashlib.sha1()
+    for child in sorted(item, key=lambda x: x.tag):
+        if child.tag in IGNORED_FIELDS:
+            continue
+        data = canonical_text(child)
+        full.update(data)
+        if child.tag not in PRICE_FIELDS:
+            base.update(data)
+    return full.digest(), base.digest()
+
+
+def read_header(source):
+    """Lee el tipo y los elementos ARCHIVO, ORIGEN y DESTINO de un mensaje
+        Deja de leer al llegar al CONTENIDO
+        Devuelve (tipo de mensaje, {tag: Element})
+    """
+    root_tag = None
+    header = {}
+    depth = 0
+    with open(source, 'rb') as i:
+        for event, elem in ElementTree.iterparse(i, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root_tag = elem.tag
+                elif depth == 2 and elem.tag == 'CONTENIDO':
+                    break
+                continue
+            depth -= 1
+            if depth == 1:
+                elem.tail = None
+                header[elem.tag] = elem
+    return root_tag, header
+
+
+def build_element(tag, fields):
+    """Arma un elemento con un subelemento por cada (tag, texto)
+    """
+    elem = ElementTree.Element(tag)
+    for child_tag, text in fields:
+        ElementTree.SubElement(elem, child_tag).text = text
+    return elem
+
+
+class MessageWriter(object):
+    """Escribe un mensaje sinliarg item por item, sin armarlo en memoria
+        El archivo se abre con el primer item y se arma en path + '.tmp', al
+        cerrar se renombra. Si no se escribio ningun item no se crea.
+    """
+
+    def __init__(self, path, root_tag, header, content_start, content_end):
+        """
+            :path: archivo a escribir, None para descartar los items
+            :root_tag: tipo de mensaje
+            :header: elementos ARCHIVO, ORIGEN y DESTINO
+            :content_start: XML desde <CONTENIDO> hasta el primer item
+            :content_end: XML desde el ultimo item hasta </CONTENIDO>
+        """
+        self.path = path
+        self.root_tag = root_tag
+        self.header = header
+        self.content_start = content_start
+        self.content_end = content_end
+        self.output = None
+        self.items = 0
+
+    def write(self, elem):
+        self.items += 1
+        if self.path is None:
+            return
+        if self.output is None:
+            self.output = open(self.path + '.tmp', 'wb')
+            self.output.write(('<?xml version="1.0" encoding="utf-8"?>\n<%s>' % self.root_tag)
+                              .encode('utf-8'))
+            for header_elem in self.header:
+                self.output.write(ElementTree.tostring(header_elem, encoding='utf-8')
+                                  .split(b'?>', 1)[-1].lstrip())
+            self.output.write(self.content_start.encode('utf-8'))
+        elem.tail = None
+        self.output.write(ElementTree.tostring(elem, encoding='utf-8').split(b'?>', 1)[-1].lstrip())
+
+    def close(self):
+        if self.output is None:
+            return
+        self.output.write(('%s</%s>\n' % (self.content_end, self.root_tag)).encode('utf-8'))
+        self.output.close()
+        self.output = None
+        os.replace(self.path + '.tmp', self.path)
+
+
+class CatalogDelta(object):
+    """Diferencias entre dos catalogos usando un indice sqlite en disco"""
+    batch_size = 10000      # items por transaccion
+
+    def __init__(self, filename):
+        """
+            :filename: archivo de la base sqlite, se crea si no existe
+        """
+        self.db = sqlite3.connect(filename)
+        # es un indice de trabajo: si se corta se vuelve a armar
+        self.db.execute('PRAGMA journal_mode=OFF')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('DROP TABLE IF EXISTS items')
+        self.db.execute('CREATE TABLE items ('
+                        ' key TEXT PRIMARY KEY,'
+                        ' digest BLOB,'
+                        ' base_digest BLOB,'
+                        ' precio TEXT,'
+                        ' moneda TEXT,'
+                        ' ean TEXT,'
+                        ' cod_articulo TEXT,'
+                        ' titulo TEXT,'
+                        ' seen INTEGER NOT NULL DEFAULT 0)')
+        self.totals = dict.fromkeys(['items', 'new', 'changed', 'prices', 'unchanged',
+                                     'removed', 'duplicated', 'invalid'], 0)
+
+    def close(self):
+        self.db.close()
+
+    def load_previous(self, source):
+        """Carga en el indice los items del catalogo anterior
+            :source: nombre del archivo del catalogo
+            Devuelve la cantidad de items cargados
+        """
+        loaded = 0
+        for pos, item in enumerate(ftp2email.SinliargMessage.iter_file_items(source,
+                                                                               'CONTENIDO/ITEM')):
+            key = item_key(item)
+            if key is None:
+                continue
+            digest, base_digest = item_digests(item)
+            cursor = self.db.execute(
+                'INSERT OR IGNORE INTO items'
+                ' (key, digest, base_digest, precio, moneda, ean, cod_articulo, titulo)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, digest, base_digest,
+                 (item.findtext('PRECIO_VENTA') or '').strip(),
+                 (item.findtext('MONEDA_VENTA') or '').strip(),
+                 (item.findtext('EAN') or '').strip(),
+                 (item.findtext('COD_ARTICULO') or '').strip(),
+                 (item.findtext('TITULO') or '').strip()))
+            if cursor.rowcount:
+                loaded += 1
+            else:
+                logging.warning(u'Titulo repetido en el catalogo anterior: %s', key)
+            if pos % self.batch_size == self.batch_size - 1:
+                self.db.commit()
+        self.db.commit()
+        return loaded
+
+    @staticmethod
+    def is_price_change(item, previous):
+        """Si la diferencia se puede enviar como CAMBIOPRECIO: las dos monedas
+            tienen que ser validas segun la gramatica y los precios decimales
+        """
+        precio = (item.findtext('PRECIO_VENTA') or '').strip()
+        moneda = (item.findtext('MONEDA_VENTA') or '').strip()
+        if moneda not in CURRENCIES or previous[1] not in CURRENCIES:
+            return False
+        try:
+            decimal.Decimal(precio)
+            decimal.Decimal(previous[0])
+        except decimal.InvalidOperation:
+            return False
+        return bool(precio and previous[0])
+
+    @staticmethod
+    def build_price_change(item, previous):
+        """Arma el CAMBIO_DE_PRECIO de un item con el precio anterior
+            :previous: (precio, moneda) del catalogo anterior
+        """
+        change = ElementTree.Element('CAMBIO_DE_PRECIO')
+        id_libro = ElementTree.SubElement(change, 'ID_LIBRO')
+        for tag in ID_LIBRO_FIELDS:
+            text = (item.findtext(tag) or '').strip()
+            if text or tag == 'EAN':
+                ElementTree.SubElement(id_libro, tag).text = text
+        change.append(build_element('PRECIO', [
+                        ('MONEDA', item.findtext('MONEDA_VENTA').strip()),
+                        ('VALOR', item.findtext('PRECIO_VENTA').strip()), ('TIPO', 'PVP')]))
+        change.append(build_element('PRECIO_ANTERIOR', [
+                        ('MONEDA', previous[1]), ('VALOR', previous[0]), ('TIPO', 'PVP')]))
+        return change
+
+    def compare(self, source, catalog_writer, prices_writer):
+        """Recorre el catalogo nuevo y escribe cada diferencia con el anterior
+            :source: nombre del archivo del catalogo nuevo
+            :catalog_writer: MessageWriter de los items nuevos o modificados
+            :prices_writer: MessageWriter de los cambios de precio
+            Devuelve los totales
+        """
+        for pos, item in enumerate(ftp2email.SinliargMessage.iter_file_items(source,
+                                                                               'CONTENIDO/ITEM')):
+            self.totals['items'] += 1
+            key = item_key(item)
+            if key is None:
+                logging.warning(u'Titulo sin EAN ni COD_ARTICULO en la posicion %d', pos)
+                self.totals['invalid'] += 1
+                continue
+            row = self.db.execute('SELECT digest, base_digest, precio, moneda, seen'
+                                  ' FROM items WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[4]:
+                logging.warning(u'Titulo repetido en el catalogo nuevo: %s', key)
+                self.totals['duplicated'] += 1
+                continue
+            digest, base_digest = item_digests(item)
+            if row is None:
+                self.db.execute('INSERT INTO items (key, seen) VALUES (?, 1)', (key,))
+                self.totals['new'] += 1
+                catalog_writer.write(item)
+            else:
+                self.db.execute('UPDATE items SET seen = 1 WHERE key = ?', (key,))
+                if row[0] == digest:
+                    self.totals['unchanged'] += 1
+                elif row[1] == base_digest and self.is_price_change(item, row[2:4]):
+                    self.totals['prices'] += 1
+                    prices_writer.write(self.build_price_change(item, row[2:4]))
+                else:
+                    self.totals['changed'] += 1
+                    catalog_writer.write(item)
+            if pos % self.batch_size == self.batch_size - 1:
+                self.db.commit()
+        self.db.commit()
+        self.totals['removed'] = self.db.execute('SELECT COUNT(*) FROM items WHERE seen = 0') \
+                                     .fetchone()[0]
+        return self.totals
+
+    def removed(self):
+        """Devuelve (EAN, COD_ARTICULO, TITULO) de los titulos que ya no estan en el catalogo
+        """
+        return self.db.execute('SELECT ean, cod_articulo, titulo FROM items'
+                               ' WHERE seen = 0 ORDER BY key')
+
+
+def build_writers(source, catalog_file, prices_file, fecha_vigencia=None):
+    """Arma los MessageWriter del CATALOGO y el CAMBIOPRECIO de cambios
+        El encabezado se copia del catalogo nuevo
+        :source: catalogo nuevo
+        :fecha_vigencia: de los cambios de precio, por defecto ARCHIVO/FECHA del catalogo
+    """
+    root_tag, header = read_header(source)
+    if root_tag != 'CATALOGO':
+        raise ValueError('%s no es un mensaje CATALOGO (%s)' % (source, root_tag))
+    archivo = header['ARCHIVO']
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    identifier = archivo.findtext('IDENTIFICADOR')
+    writers = []
+    for filename, sinli_type, description, suffix, content_start, content_end in [
+            (catalog_file, 'CATALOGO', 'Titulos nuevos y modificados', '_CAMBIOS',
+             '<CONTENIDO>', '</CONTENIDO>'),
+            (prices_file, 'CAMBIOPRECIO', 'Cambios de precio', '_PRECIOS',
+             '<CONTENIDO><FECHA_VIGENCIA>%s</FECHA_VIGENCIA><CAMBIOS>'
+             % (fecha_vigencia or archivo.findtext('FECHA')).strip(),
+             '</CAMBIOS></CONTENIDO>')]:
+        fields = [('DESCRIPCION', description), ('FECHA', now),
+                  ('VERSION', archivo.findtext('VERSION')), ('CODIGO', sinli_type)]
+        if identifier:
+            fields.append(('IDENTIFICADOR', identifier.strip() + suffix))
+        writers.append(MessageWriter(filename, sinli_type,
+                                     [build_element('ARCHIVO', fields),
+                                      header['ORIGEN'], header['DESTINO']],
+                                     content_start, content_end))
+    return writers
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Generar los cambios entre dos catalogos')
+    arg_parser.add_argument('previous', help='Mensaje CATALOGO anterior')
+    arg_parser.add_argument('current', help='Mensaje CATALOGO nuevo')
+    arg_parser.add_argument('--catalogo', default=None,
+                            help='Mensaje CATALOGO con los titulos nuevos y modificados')
+    arg_parser.add_argument('--precios', default=None,
+                            help='Mensaje CAMBIOPRECIO con los titulos que solo cambiaron de precio')
+    arg_parser.add_argument('--bajas', default=None,
+                            help='Archivo csv con los titulos que no estan en el catalogo nuevo')
+    arg_parser.add_argument('--vigencia', default=None,
+                            help='FECHA_VIGENCIA de los cambios de precio (AAAA-MM-DDTHH:MM:SS)')
+    arg_parser.add_argument('--temporal', default=None,
+                            help='Directorio para el indice temporal')
+    args = arg_parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s|%(message)s')
+
+    catalog_writer, prices_writer = build_writers(args.current, args.catalogo, args.precios,
+                                                  args.vigencia)
+    fd, db_file = tempfile.mkstemp(suffix='.sqlite', dir=args.temporal)
+    os.close(fd)
+    delta = CatalogDelta(db_file)
+    try:
+        logging.info(u'%d titulos en el catalogo anterior', delta.load_previous(args.previous))
+        totals = delta.compare(args.current, catalog_writer, prices_writer)
+        catalog_writer.close()
+        prices_writer.close()
+        if args.bajas:
+            with open(args.bajas, 'w') as o:
+                writer = csv.writer(o)
+                writer.writerow(['EAN', 'COD_ARTICULO', 'TITULO'])
+                writer.writerows(delta.removed())
+    finally:
+        delta.close()
+        os.remove(db_file)
+    print('%d titulos, %d nuevos, %d modificados, %d cambios de precio, %d sin cambios, '
+          '%d bajas' % (totals['items'], totals['new'], totals['changed'], totals['prices'],
+                        totals['unchanged'], totals['removed']), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,11 +2,17 @@
 # vim: set fileencoding=utf-8 :
 
 import argparse
+import binascii
+import bisect
 try:
     from io import BytesIO
 except ImportError:  # python2
     from cStringIO import StringIO as BytesIO
 import csv
+import ctypes
+import ctypes.util
+from email.mime.application import MIMEApplication
+from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 try:
@@ -14,22 +20,110 @@ try:
 except ImportError:  # python2
     from email.parser import Parser as emailParser
 import errno
+import gzip
+import hashlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import imaplib
+import itertools
 import json
 import logging
+import mmap
+import numbers
 import os
 import poplib
+try:
+    import queue
+except ImportError:  # python2
+    import Queue as queue
 import re
+import select
 import shutil
+import signal
 import smtplib
+import socket
+import sqlite3
+import struct
 import sys
+import threading
+import time
 import traceback
 import xml.etree.cElementTree as cElementTree
+import xml.parsers.expat
+import zipfile
+import zlib
 
 
 settings = None
+text_types = (bytes, type(u''))
+
+
+def write_file_atomic(path, data):
+    """Escribe el archivo reemplazandolo de forma atomica
+        :path: archivo a escribir
+        :data: contenido del archivo (texto o bytes)
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as o:
+        o.write(data)
+        o.flush()
+        os.fsync(o.fileno())
+    try:
+        os.replace(tmp_path, path)
+    except AttributeError:  # python2
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def make_dirs(path):
+    """Crea el directorio path y los intermedios, no falla si ya existe
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:      # puede haberlo creado otro thread
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class SMTPDeliveryUnknown(smtplib.SMTPException):
+    """Se perdio la conexion despues de enviar el email completo, el servidor pudo
+        haberlo recibido"""
+
+
+class AttachmentTooLarge(ValueError):
+    """Adjunto comprimido que descomprimido supera el tamaño maximo"""
+
+
+def read_limited(fileobj, max_size, chunk_size=65536):
+    """Lee fileobj de a bloques, levanta AttachmentTooLarge si tiene mas de max_size bytes
+    """
+    chunks = []
+    size = 0
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return b''.join(chunks)
+        size += len(chunk)
+        if size > max_size:
+            raise AttachmentTooLarge('El adjunto descomprimido supera %d bytes' % max_size)
+        chunks.append(chunk)
+
 
 class SinliargMessage(object):
     """Mensaje de sinliarg"""
+    # campos del encabezado: path dentro del XML -> atributo del mensaje
+    header_fields = {'DESTINO/CODIGO_SINLI': 'dst_code',
+                     'ORIGEN/CODIGO_SINLI': 'src_code',
+                     'ARCHIVO/DESCRIPCION': 'description',
+                     'ARCHIVO/CODIGO': 'sinli_type',
+                     'ARCHIVO/IDENTIFICADOR': 'identifier'}
+    # path de los items dentro del elemento raiz segun el tipo de mensaje
+    item_paths = {'CATALOGO': 'CONTENIDO/ITEM',
+                  'CAMBIOPRECIO': 'CONTENIDO/CAMBIOS/CAMBIO_DE_PRECIO'}
+    default_item_path = 'CONTENIDO/DETALLE/ITEM'
 
     def __init__(self, msg_data, filename=None):
         """
@@ -37,22 +131,175 @@ class SinliargMessage(object):
             :filename: nombre del archivo que contiene el XML del mensaje
         """
         self.xml = msg_data
-        xmltree = cElementTree.parse(BytesIO(self.xml))
-        self.dst_code = xmltree.findtext('DESTINO/CODIGO_SINLI')
-        self.src_code = xmltree.findtext('ORIGEN/CODIGO_SINLI')
-        self.description = xmltree.findtext('ARCHIVO/DESCRIPCION')
-        self.sinli_type = xmltree.findtext('ARCHIVO/CODIGO')
+        self._xmltree = None
+        self.read_header()
         self.filename = filename or self.gen_file_name()
 
+    def read_header(self):
+        """Lee los campos del encabezado sin parsear el resto del documento
+            El parseo termina al cerrarse el elemento DESTINO, los errores de XML
+            posteriores aparecen con check_well_formed o al usar xmltree
+        """
+        for attr in self.header_fields.values():
+            setattr(self, attr, None)
+        path = []
+        for event, elem in cElementTree.iterparse(self.xml_source(), events=('start', 'end')):
+            if event == 'start':
+                path.append(elem.tag)
+                continue
+            field = '/'.join(path[1:])
+            if field in self.header_fields:
+                setattr(self, self.header_fields[field], elem.text or '')
+            path.pop()
+            if field == 'DESTINO':
+                break
+
+    def check_well_formed(self):
+        """Verifica que el documento completo sea XML bien formado
+            Lo recorre por bloques sin armar el arbol, por lo que la memoria usada
+            no depende del tamaño del mensaje. Levanta cElementTree.ParseError
+        """
+        parser = xml.parsers.expat.ParserCreate()
+        try:
+            for chunk in self.iter_chunks():
+                parser.Parse(chunk, False)
+            parser.Parse(b'', True)
+        except xml.parsers.expat.ExpatError as e:
+            error = cElementTree.ParseError(str(e))
+            error.code = e.code
+            error.position = (e.lineno, e.offset)
+            raise error
+
+    @property
+    def xmltree(self):
+        """Arbol completo del documento, se parsea la primera vez que se usa
+        """
+        if self._xmltree is None:
+            self._xmltree = cElementTree.parse(self.xml_source())
+        return self._xmltree
+
+    def xml_source(self):
+        """Origen del XML para el parser: archivo abierto o nombre de archivo
+        """
+        return BytesIO(self.xml)
+
+    @property
+    def size(self):
+        """Tamaño en bytes del XML del mensaje
+        """
+        return len(self.xml)
+
+    def iter_chunks(self, chunk_size=65536):
+        """Devuelve el XML del mensaje en bloques de bytes para escribirlo o enviarlo
+            El mensaje en memoria se devuelve en un solo bloque
+        """
+        yield self.xml
+
+    def iter_items(self, item_path=None, fields=None):
+        """Devuelve uno a uno los items del contenido del mensaje (ver iter_file_items)
+        """
+        return self.iter_file_items(self.xml_source(), item_path, fields)
+
+    @classmethod
+    def iter_file_items(cls, source, item_path=None, fields=None):
+        """Devuelve uno a uno los items de un mensaje sin armar el arbol completo
+            Cada item es un Element con sus subelementos (por ejemplo
+            item.findtext('ID_LIBRO/EAN')) que se vacia al pasar al siguiente, por
+            lo que la memoria usada no depende de la cantidad de items
+            :source: nombre del archivo o archivo abierto en modo binario
+            :item_path: path de los items dentro de la raiz, por defecto segun el
+                        tipo de mensaje: CONTENIDO/ITEM en CATALOGO,
+                        CONTENIDO/CAMBIOS/CAMBIO_DE_PRECIO en CAMBIOPRECIO y
+                        CONTENIDO/DETALLE/ITEM en el resto
+            :fields: dict path dentro de la raiz -> texto, se completa con el texto
+                     de esos elementos (por ejemplo 'ARCHIVO/IDENTIFICADOR') en la
+                     misma lectura. Los que no estan en el mensaje quedan como estaban
+        """
+        path = []
+        parents = []
+        for event, elem in cElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if not path:
+                    item_path = (item_path or cls.item_paths.get(elem.tag, cls.default_item_path)) \
+                                    .split('/')
+                path.append(elem.tag)
+                parents.append(elem)
+                continue
+            path.pop()
+            parents.pop()
+            if fields and '/'.join(path[1:] + [elem.tag]) in fields:
+                fields['/'.join(path[1:] + [elem.tag])] = elem.text
+            if path[1:] + [elem.tag] == item_path:
+                yield elem
+                elem.clear()
+                parents[-1].remove(elem)
+
     def gen_file_name(self):
         """Genera un nombre para el archivo que guardaria los datos del mensaje
         """
         return '_'.join([self.src_code, self.dst_code, self.sinli_type,
                          str(hash(self.xml))]) + '.xml'
 
+    def content_digest(self):
+        """Hash estable (sha1) del contenido del mensaje
+        """
+        digest = hashlib.sha1()
+        for chunk in self.iter_chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+class SinliargFile(SinliargMessage):
+    """Mensaje de sinliarg que se lee del archivo a medida que se usa
+        El XML no se carga en memoria para escribirlo o enviarlo por email (ver
+        iter_chunks), solo cuando se usa el atributo xml
+    """
+
+    def __init__(self, path, use_mmap=False):
+        """
+            :path: archivo que contiene el XML del mensaje
+            :use_mmap: leer el archivo mapeandolo en memoria en lugar de con read()
+        """
+        self.path = path
+        self.use_mmap = use_mmap
+        self._xmltree = None
+        self.read_header()
+        self.filename = os.path.split(path)[1]
+
+    @property
+    def xml(self):
+        with open(self.path, 'rb') as i:
+            return i.read()
+
+    def xml_source(self):
+        return self.path
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def iter_chunks(self, chunk_size=65536):
+        """Devuelve el contenido del archivo en bloques de a lo sumo chunk_size bytes
+        """
+        with open(self.path, 'rb') as i:
+            # no se puede mapear un archivo vacio
+            if self.use_mmap and os.fstat(i.fileno()).st_size:
+                data = mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for start in range(0, len(data), chunk_size):
+                        yield data[start:start + chunk_size]
+                finally:
+                    data.close()
+            else:
+                for chunk in iter(lambda: i.read(chunk_size), b''):
+                    yield chunk
+
 
 class MessageChannel(object):
     """Canal que permite enviar y recibir mensajes"""
+    # verificar que los mensajes leidos esten bien formados antes de enviarlos,
+    # se puede desactivar si se validan antes de dejarlos en el canal (validar.py)
+    check_well_formed = True
 
     def load_messages(self):
         """Devuelve una lista con los ids de los mensajes encontrados
@@ -66,26 +313,62 @@ class MessageChannel(object):
 
     def send_message(self, sinli_msg):
         """:sinli_msg: mensaje sinliarg a enviar
+            Devuelve None si el mensaje se envio. Un canal que agrupa mensajes en lotes
+            devuelve una lista de (mensaje, error) con los mensajes de los lotes que se
+            enviaron en esta llamada (error None si se enviaron bien)
         """
         raise NotImplementedError
 
+    def flush(self):
+        """Envia los lotes pendientes, devuelve una lista de (mensaje, error)
+        """
+        return []
+
     def close(self):
         """Libera los recursos usados para leer los mensajes
         """
         pass
 
+    def release_session(self):
+        """Libera las conexiones del thread actual para que las reuse otro thread
+            Se llama al terminar cada thread que envia mensajes
+        """
+        pass
+
+    def connection_counts(self):
+        """Cantidad de conexiones abiertas por el canal desde que se creo, por protocolo
+        """
+        return {}
+
+    def get_destination_key(self, sinli_msg):
+        """Destino del mensaje para cortar los envios despues de errores seguidos
+            (ver RetryScheduler), por defecto el codigo sinli de destino
+        """
+        return sinli_msg.dst_code
+
 
 class FilesystemChannel(MessageChannel):
     """Canal de intercambio de mensajes por sistema de archivos"""
+    # directorios donde mark_message mueve los mensajes procesados
+    archive_dirs = ('archived', 'failed')
 
-    def __init__(self, base_path, dir_re):
+    def __init__(self, base_path, dir_re, state_file=None, stream_size=None, use_mmap=False):
         """
             :base_path: directorio base donde se guardan los mensajes
             :dir_re: expresion regular usada para reconocer
                      los directorios que contienen mensajes
+            :state_file: archivo donde se guarda el contenido de los directorios
+                         para no volver a listar los que no cambiaron
+            :stream_size: los archivos de este tamaño o mas no se cargan en memoria,
+                          se leen del disco a medida que se envian (ver SinliargFile)
+            :use_mmap: leer los archivos grandes mapeandolos en memoria
         """
         self.base_path = os.path.abspath(base_path)
         self.dir_re = re.compile(dir_re)
+        self.state_file = state_file
+        self.stream_size = stream_size
+        self.use_mmap = use_mmap
+        self.dst_dirs = None
 
     def __str__(self):
         return 'FilesystemChannel(%s)' % self.base_path
@@ -94,18 +377,67 @@ class FilesystemChannel(MessageChannel):
         """Devuelve el mensaje msg_id
             :msg_id: el id del mensaje es el path al archivo con su contenido
         """
+        if self.stream_size is not None and os.path.getsize(msg_id) >= self.stream_size:
+            return SinliargFile(msg_id, use_mmap=self.use_mmap)
         with open(msg_id, "rb") as i:
             return SinliargMessage(i.read(), filename=os.path.split(msg_id)[1])
 
     def load_messages(self):
         """Devuelve una lista con los nombres de archivo de los mensajes
         """
-        for dirpath, dirname, filenames in os.walk(self.base_path):
+        for dirpath, filenames in self.scan_dirs():
             if self.dir_re.search(dirpath):
                 logging.debug("Directorio encontrado: %s" % dirpath)
                 for filename in filenames:
                     yield os.path.join(dirpath, filename)
 
+    def load_state(self):
+        """Lee el contenido de los directorios guardado en 'state_file'
+        """
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as i:
+                return json.load(i)
+        except ValueError:
+            logging.error('Archivo de estado invalido %s' % self.state_file)
+            return {}
+
+    def list_dir(self, path, state, new_state, now):
+        """Devuelve los subdirectorios y archivos de path
+            Si el mtime del directorio no cambio desde la ultima ejecucion usa el
+            contenido guardado en state, el contenido leido se agrega a new_state
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return [], []
+        entry = state.get(path)
+        if entry is None or entry[0] != mtime:
+            dirpath, dirnames, filenames = next(os.walk(path), (path, [], []))
+            entry = [mtime, dirnames, filenames]
+        # un directorio modificado hace muy poco puede cambiar sin que cambie su mtime
+        if now - mtime > 2:
+            new_state[path] = entry
+        return entry[1], entry[2]
+
+    def scan_dirs(self):
+        """Recorre base_path como os.walk salteando los directorios de archivados
+            Devuelve (directorio, archivos) por cada directorio
+        """
+        state = self.load_state()
+        new_state = {}
+        now = time.time()
+        pending = [self.base_path]
+        while pending:
+            dirpath = pending.pop()
+            dirnames, filenames = self.list_dir(dirpath, state, new_state, now)
+            yield dirpath, filenames
+            pending.extend(reversed([os.path.join(dirpath, x) for x in dirnames
+                                     if x not in self.archive_dirs]))
+        if self.state_file:
+            write_file_atomic(self.state_file, json.dumps(new_state))
+
     def mark_message(self, msg_id, error=False):
         """Marca un mensaje como procesado/leido
             Mueve el archivo con el mensaje a un directorio 'leidos'
@@ -116,38 +448,48 @@ class FilesystemChannel(MessageChannel):
             return
 
         base_dir, filename = os.path.split(msg_id)
-        dirname = "failed" if error else "archived"
+        dirname = self.archive_dirs[1] if error else self.archive_dirs[0]
         archived_path = os.path.join(base_dir, dirname)
         try:
             logging.info('Moviendo archivo de mensaje %s' % msg_id)
             shutil.move(msg_id, os.path.join(archived_path, filename))
         except IOError as e:                  # si no existia el directorio intenta crearlo
             if e.errno == errno.ENOENT:
-                try:
-                    logging.error('Creando directorio para mensajes archivados en %s'
-                                    % archived_path)
-                    os.makedirs(archived_path)
-                except OSError as e:          # si da error porque ya existe lo ignora
-                    if e.exception.errno != errno.EEXIST:
-                        raise
+                logging.error('Creando directorio para mensajes archivados en %s'
+                                % archived_path)
+                make_dirs(archived_path)
                 shutil.move(msg_id, os.path.join(archived_path, filename))
             else:
                 raise
 
+    def load_dst_dirs(self):
+        """Arma el indice nombre de directorio (ORIGEN_DESTINO) -> path
+            No recorre los directorios de mensajes archivados
+        """
+        self.dst_dirs = {}
+        for dirpath, dirnames, filenames in os.walk(self.base_path):
+            dirnames[:] = [x for x in dirnames if x not in self.archive_dirs]
+            self.dst_dirs.setdefault(os.path.basename(dirpath), dirpath)
+        return self.dst_dirs
+
+    def close(self):
+        """El indice de directorios se vuelve a armar en la proxima ejecucion
+        """
+        self.dst_dirs = None
+
     def send_message(self, message):
         """Guarda el mensaje en el sistema de archivos
             :message: mensaje de sinliarg
         """
         dst_dir = '_'.join([message.src_code, message.dst_code])
-        dst_path = None
-        for path, dirs, files in os.walk(self.base_path):
-            if dst_dir in path:
-                dst_path = path
-                break
+        if self.dst_dirs is None:
+            self.load_dst_dirs()
+        dst_path = self.dst_dirs.get(dst_dir)
 
         if dst_path is None:
             dst_path = os.path.join(self.base_path, dst_dir)
-            os.mkdir(dst_path)
+            make_dirs(dst_path)
+            self.dst_dirs[dst_dir] = dst_path
 
         file_path = os.path.join(dst_path, message.sinli_type, message.filename)
         try:
@@ -155,22 +497,123 @@ class FilesystemChannel(MessageChannel):
         except IOError as e:      # si no existia el directorio intenta crearlo
             logging.debug('Creando directorio %s' % os.path.join(dst_path, message.sinli_type))
             if e.errno == errno.ENOENT:
-                os.makedirs(os.path.join(dst_path, message.sinli_type))
+                make_dirs(os.path.join(dst_path, message.sinli_type))
                 dst_file = open(file_path, 'bw')
             else:
                 raise
 
         logging.info('Guardando archivo %s' % file_path)
-        dst_file.write(message.xml)
+        for chunk in message.iter_chunks():
+            dst_file.write(chunk)
         dst_file.close()
         return file_path
 
 
+class StreamedEmail(object):
+    """Email cuyos adjuntos se leen del disco y se codifican en base64 a medida
+        que se envian, la memoria usada no depende del tamaño de los adjuntos
+        El arbol MIME se arma con un marcador en lugar del contenido de cada adjunto
+        grande y se serializa sin ellos, al enviarlo se reemplazan los marcadores
+        por el contenido codificado
+    """
+    # bytes por linea de base64 (76 caracteres), los bloques son lineas completas
+    line_size = 57
+    chunk_size = 57 * 1024
+
+    def __init__(self, email_text, parts):
+        """
+            :email_text: email serializado con un marcador por cada adjunto grande
+            :parts: lista de (marcador, mensaje, compresion) de los adjuntos grandes
+        """
+        self.email_text = email_text
+        self.parts = parts
+
+    @classmethod
+    def attachment(cls, sinli_message, method=None):
+        """Crea el adjunto del mensaje sin su contenido
+            :method: None o 'gzip', se comprime a medida que se envia
+        """
+        if method == 'gzip':
+            attachment = MIMEBase('application', 'gzip')
+        else:
+            attachment = MIMEBase('text', 'xml', charset='utf-8')
+        attachment['Content-Transfer-Encoding'] = 'base64'
+        attachment.sinli_stream = (sinli_message, method)
+        attachment.set_payload('SINLIARG-ADJUNTO-%x' % id(attachment))
+        return attachment
+
+    @classmethod
+    def build(cls, email_message):
+        """Serializa el email, devuelve el texto si no tiene adjuntos grandes
+        """
+        parts = [(x.get_payload(),) + x.sinli_stream for x in email_message.get_payload()
+                 if getattr(x, 'sinli_stream', None) is not None]
+        if not parts:
+            return email_message.as_string()
+        return cls(email_message.as_string(), parts)
+
+    def __iter__(self):
+        """Devuelve el email en bloques de bytes listos para el comando DATA de
+            smtp: fin de linea CRLF y los puntos al inicio de una linea duplicados
+        """
+        email_text = self.email_text
+        for marker, sinli_message, method in self.parts:
+            head, email_text = email_text.split(marker + '\n', 1)
+            yield smtplib.quotedata(head).encode('ascii')
+            for chunk in self.encode(self.iter_data(sinli_message, method)):
+                yield chunk
+        # base64 nunca empieza una linea con un punto, solo se revisa el texto
+        email_text = smtplib.quotedata(email_text)
+        if not email_text.endswith('\r\n'):
+            email_text += '\r\n'
+        yield email_text.encode('ascii')
+
+    @staticmethod
+    def iter_data(sinli_message, method):
+        """Devuelve el contenido del adjunto en bloques, comprimido si corresponde
+        """
+        if method != 'gzip':
+            for chunk in sinli_message.iter_chunks():
+                yield chunk
+            return
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in sinli_message.iter_chunks():
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def encode(self, chunks):
+        """Codifica en base64 los bloques en lineas de 76 caracteres terminadas en CRLF
+        """
+        pending = b''
+        for chunk in chunks:
+            pending += chunk
+            if len(pending) >= self.chunk_size:
+                size = len(pending) - len(pending) % self.line_size
+                yield self.encode_lines(pending[:size])
+                pending = pending[size:]
+        if pending:
+            yield self.encode_lines(pending)
+
+    def encode_lines(self, data):
+        encoded = binascii.b2a_base64(data)[:-1]
+        line_length = self.line_size * 4 // 3
+        return b''.join(encoded[x:x + line_length] + b'\r\n'
+                        for x in range(0, len(encoded), line_length))
+
+
 class EmailChannel(MessageChannel):
     """Canal de intercambio de mensajes por email"""
     sinliMimeTypes = ['text/xml', 'application/xml']
+    # tipos de los adjuntos comprimidos -> metodo de compresion
+    compressedMimeTypes = {'application/gzip': 'gzip',
+                           'application/x-gzip': 'gzip',
+                           'application/zip': 'zip',
+                           'application/x-zip-compressed': 'zip'}
 
-    def __init__(self, smtp_settings, pop_settings, msg_from='', eaddress_file=None):
+    def __init__(self, smtp_settings, pop_settings, msg_from='', eaddress_file=None,
+                 compression=None, batch=None, error_path=None, max_attachment_size=None):
         """
             :smtp_settings: dict de configuracion del servidor smtp
                             {'host': '', 'port': '', 'user': '', 'pass': ''}
@@ -178,42 +621,325 @@ class EmailChannel(MessageChannel):
                             {'host': '', 'port': '', 'user': '', 'pass': ''}
             :msg_from: valor que identifica el origen de los emails enviados
             :eaddress_file: nombre del archivo con codigo sinli, direccion de email (csv)
+            :compression: dict codigo sinli -> 'gzip' o 'zip', a esos destinos el XML
+                          se envia comprimido. Al resto se envia sin comprimir
+            :batch: dict {'max_messages': n, 'max_bytes': n}, agrupa los mensajes
+                    seguidos de un mismo tipo para una misma direccion en un email con
+                    varios adjuntos, hasta n mensajes o n bytes de XML. Por defecto se
+                    envia un email por mensaje
+            :error_path: directorio donde se guardan los emails con mensajes erroneos
+            :max_attachment_size: tamaño maximo en bytes de un adjunto recibido
+                                  comprimido al descomprimirlo, por defecto 100MB.
+                                  Los mensajes mas grandes se rechazan como erroneos
         """
         self.smtp_settings = smtp_settings
         self.pop_settings = pop_settings
+        self.max_attachment_size = max_attachment_size or 100000000
         self.msg_from = msg_from
         self.eaddress_file = eaddress_file
+        self.compression = compression or {}
+        self.batch = batch or {}
+        self.error_path = error_path
+        self.batches = {}               # (direccion de destino, tipo) -> mensajes del lote
+        self.batch_lock = threading.Lock()
+        self.batch_send_locks = {}      # direccion de destino -> lock para enviar en orden
+        self.smtp_sessions = threading.local()
+        self.smtp_servers = []
+        self.smtp_idle = []             # conexiones abiertas que no usa ningun thread
+        self.smtp_lock = threading.Lock()
+        self.smtp_connections = 0
+        self.sent_messages = 0
+        self.pop_server = None
+        self.pop_connections = 0
+        self.pop_uids = {}
+        self.pending_deletes = []
+        self.messages = {}
+        self.messages_data = {}
+        self.email_parts = {}           # uid -> cantidad de mensajes del email
+        self.marked_parts = {}          # uid -> mensajes del email ya marcados
 
     def __str__(self):
         return 'EmailChannel(%s)' % self.msg_from
 
     def send_message(self, sinli_message):
         """Envia el mensaje al destinatario Sinliarg por email
+            Si se agrupan los mensajes en lotes devuelve (mensaje, error) de los
+            lotes que se completaron y enviaron, el resto se envia con flush()
             :sinli_message: mensaje Sinliarg a enviar
         """
-        # crear el email a enviar
+        if self.batch.get('max_messages', 1) > 1:
+            return self.add_to_batch(sinli_message)
+        self.send_email(*self.build_email(sinli_message))
+
+    def add_to_batch(self, sinli_message):
+        """Agrega el mensaje al lote de su direccion de destino y tipo de mensaje
+            Los tipos van en lotes separados para que un CATALOGO no viaje junto con
+            los pedidos. Un mensaje de otro tipo cierra el lote pendiente de la
+            direccion, que se envia antes para que un REMITO no se adelante a su
+            PEDIDO. Los lotes que alcanzan 'max_messages' o 'max_bytes' se envian
+        """
+        dest_addr = self.get_destination_address(sinli_message)
+        key = (dest_addr, sinli_message.sinli_type)
+        max_bytes = self.batch.get('max_bytes', 10000000)
+        with self.batch_send_lock(dest_addr):
+            with self.batch_lock:
+                ready = [(x, self.batches.pop(x)) for x in list(self.batches)
+                         if x[0] == dest_addr and x != key]
+                batch = self.batches.setdefault(key, [])
+                if batch and sum(x.size for x in batch) + sinli_message.size > max_bytes:
+                    ready.append((key, batch))
+                    batch = self.batches[key] = []
+                batch.append(sinli_message)
+                if len(batch) >= self.batch['max_messages'] \
+                        or sum(x.size for x in batch) >= max_bytes:
+                    ready.append((key, self.batches.pop(key)))
+            return [result for key, messages in ready
+                    for result in self.send_batch(dest_addr, messages)]
+
+    def flush(self):
+        """Envia los lotes pendientes
+        """
+        with self.batch_lock:
+            addresses = sorted(set(x[0] for x in self.batches))
+        results = []
+        for dest_addr in addresses:
+            with self.batch_send_lock(dest_addr):
+                with self.batch_lock:
+                    ready = [(x, self.batches.pop(x)) for x in list(self.batches)
+                             if x[0] == dest_addr]
+                for key, messages in ready:
+                    results.extend(self.send_batch(dest_addr, messages))
+        return results
+
+    def batch_send_lock(self, dest_addr):
+        """Lock para armar y enviar los lotes de una direccion
+            Los lotes de una direccion se envian de a uno y en el orden en que se
+            cerraron, aunque los mensajes lleguen desde varios threads
+        """
+        with self.batch_lock:
+            return self.batch_send_locks.setdefault(dest_addr, threading.Lock())
+
+    def send_batch(self, dest_addr, messages):
+        """Envia un lote de mensajes en un email
+            Devuelve (mensaje, error) por cada mensaje del lote
+        """
+        logging.info('Enviando lote de %d mensajes a %s' % (len(messages), dest_addr))
+        try:
+            if len(messages) == 1:
+                self.send_email(*self.build_email(messages[0]))
+            else:
+                self.send_email(dest_addr, self.build_batch_email(dest_addr, messages))
+        except Exception as e:
+            logging.error('Error enviando lote a %s\n%s' % (dest_addr, traceback.format_exc()))
+            return [(x, e) for x in messages]
+        return [(x, None) for x in messages]
+
+    def send_email(self, dest_addr, email_data):
+        """Envia un email por smtp
+        """
+        # enviar usando la conexion abierta, si el servidor la cerro reconectar
+        try:
+            self.deliver(self.get_smtp_server(), dest_addr, email_data)
+        except Exception as e:
+            if not self.can_resend(e):
+                raise
+            logging.info('Conexion con el servidor smtp perdida, reconectando')
+            self.close_smtp_server()
+            self.deliver(self.get_smtp_server(), dest_addr, email_data)
+        with self.smtp_lock:
+            self.sent_messages += 1
+
+    @staticmethod
+    def can_resend(error):
+        """Si el envio que fallo con error se puede reintentar con otra conexion
+            sin duplicar el email: se perdio la conexion o el servidor respondio 421
+            antes de terminar el comando DATA
+        """
+        if isinstance(error, SMTPDeliveryUnknown):
+            return False
+        if isinstance(error, smtplib.SMTPResponseException):
+            return error.smtp_code == 421
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return any(x[0] == 421 for x in error.recipients.values())
+        if isinstance(error, smtplib.SMTPException):
+            return isinstance(error, smtplib.SMTPServerDisconnected)
+        return isinstance(error, socket.error)
+
+    def deliver(self, smtp_server, dest_addr, email_data):
+        """Envia el email por la conexion smtp_server
+            :email_data: texto del email o StreamedEmail, que se escribe por partes
+                         en el comando DATA sin armar el email completo en memoria
+            Si se pierde la conexion despues de enviar el email completo levanta
+            SMTPDeliveryUnknown
+        """
+        if not isinstance(email_data, StreamedEmail):
+            email_data = StreamedEmail(email_data, [])
+        smtp_server.ehlo_or_helo_if_needed()
+        code, resp = smtp_server.mail(self.msg_from)
+        if code != 250:
+            self.reset_smtp_server(smtp_server, code)
+            raise smtplib.SMTPSenderRefused(code, resp, self.msg_from)
+        code, resp = smtp_server.rcpt(dest_addr)
+        if code not in (250, 251):
+            self.reset_smtp_server(smtp_server, code)
+            raise smtplib.SMTPRecipientsRefused({dest_addr: (code, resp)})
+        smtp_server.putcmd('data')
+        code, resp = smtp_server.getreply()
+        if code != 354:
+            self.reset_smtp_server(smtp_server, code)
+            raise smtplib.SMTPDataError(code, resp)
+        for chunk in email_data:
+            smtp_server.send(chunk)
+        try:
+            smtp_server.send(b'.\r\n')
+            code, resp = smtp_server.getreply()
+        except (smtplib.SMTPServerDisconnected, socket.error) as e:
+            raise SMTPDeliveryUnknown('Conexion perdida al terminar el envio a %s: %s'
+                                      % (dest_addr, e))
+        if code != 250:
+            self.reset_smtp_server(smtp_server, code)
+            raise smtplib.SMTPDataError(code, resp)
+
+    @staticmethod
+    def reset_smtp_server(smtp_server, code):
+        """Cancela el envio en curso despues de un error, igual que sendmail
+        """
+        if code == 421:
+            smtp_server.close()
+            return
+        try:
+            smtp_server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def build_email(self, sinli_message):
+        """Crea el email a enviar con el mensaje adjunto
+            Devuelve la direccion de destino y el texto del email
+        """
         dest_addr = self.get_destination_address(sinli_message)
         new_email = MIMEMultipart()
         new_email['From'] = self.msg_from
         new_email['To'] = dest_addr
         new_email['Subject'] = self.gen_email_subject(sinli_message)
-        new_email.attach(MIMEText(self.gen_email_body(sinli_message), 'xml', 'utf-8'))
-        xml_attach = MIMEText(sinli_message.xml, 'xml', 'utf-8')
-        xml_attach['Content-disposition'] = 'attachment; filename="%s"' \
-                                                % sinli_message.filename
-        new_email.attach(xml_attach)
-
-        # conectar con el servidor y hacer en envio
-        smtp_server = smtplib.SMTP(self.smtp_settings['host'],
-                                   port=self.smtp_settings.get('port', None),
-                                   timeout=self.smtp_settings.get("timeout", 30))
-        if self.smtp_settings.get("tls", False):
-            smtp_server.starttls()
-        if self.smtp_settings['user'] is not None:
-            smtp_server.login(self.smtp_settings['user'],
-                              self.smtp_settings['pass'])
-        smtp_server.sendmail(self.msg_from, dest_addr, new_email.as_string())
-        smtp_server.close()
+        new_email.attach(MIMEText(self.gen_email_body(sinli_message), 'plain', 'utf-8'))
+        new_email.attach(self.build_attachment(sinli_message))
+        return dest_addr, StreamedEmail.build(new_email)
+
+    def build_batch_email(self, dest_addr, messages):
+        """Crea un email con un adjunto por cada mensaje del lote
+        """
+        new_email = MIMEMultipart()
+        new_email['From'] = self.msg_from
+        new_email['To'] = dest_addr
+        new_email['Subject'] = self.gen_batch_subject(messages)
+        new_email.attach(MIMEText('\n'.join(self.gen_email_body(x) for x in messages),
+                                  'plain', 'utf-8'))
+        for message in messages:
+            new_email.attach(self.build_attachment(message))
+        return StreamedEmail.build(new_email)
+
+    def build_attachment(self, sinli_message):
+        """Crea el adjunto con el XML del mensaje, comprimido si asi esta
+            configurado para el destino
+        """
+        method = self.compression.get(sinli_message.dst_code, None)
+        filename = sinli_message.filename
+        if isinstance(sinli_message, SinliargFile) and method in (None, 'gzip'):
+            attachment = StreamedEmail.attachment(sinli_message, method)
+            filename += '.gz' if method else ''
+        elif method == 'gzip':
+            data = BytesIO()
+            with gzip.GzipFile(filename, 'wb', fileobj=data, mtime=0) as o:
+                o.write(sinli_message.xml)
+            attachment = MIMEApplication(data.getvalue(), 'gzip')
+            filename += '.gz'
+        elif method == 'zip':
+            data = BytesIO()
+            with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as o:
+                o.writestr(filename, sinli_message.xml)
+            attachment = MIMEApplication(data.getvalue(), 'zip')
+            filename = os.path.splitext(filename)[0] + '.zip'
+        elif method is None:
+            attachment = MIMEText(sinli_message.xml, 'xml', 'utf-8')
+        else:
+            raise ValueError('Compresion desconocida para %s: %s'
+                                % (sinli_message.dst_code, method))
+        attachment['Content-disposition'] = 'attachment; filename="%s"' % filename
+        return attachment
+
+    def get_smtp_server(self):
+        """Devuelve la conexion con el servidor smtp del thread actual
+            La conexion se reusa para todos los envios hasta que se cierra el canal.
+            Si el thread no tiene una toma una libre (ver release_session) y si no
+            hay ninguna abre otra
+        """
+        if getattr(self.smtp_sessions, 'server', None) is None:
+            with self.smtp_lock:
+                if self.smtp_idle:
+                    self.smtp_sessions.server = self.smtp_idle.pop()
+                    return self.smtp_sessions.server
+            logging.debug('Iniciando conexion con servidor smtp %s:%s'
+                            % (self.smtp_settings['host'], self.smtp_settings.get('port', None)))
+            smtp_server = smtplib.SMTP(self.smtp_settings['host'],
+                                       port=self.smtp_settings.get('port', None),
+                                       timeout=self.smtp_settings.get("timeout", 30))
+            if self.smtp_settings.get("tls", False):
+                smtp_server.starttls()
+            if self.smtp_settings['user'] is not None:
+                smtp_server.login(self.smtp_settings['user'],
+                                  self.smtp_settings['pass'])
+            self.smtp_sessions.server = smtp_server
+            with self.smtp_lock:
+                self.smtp_servers.append(smtp_server)
+                self.smtp_connections += 1
+        return self.smtp_sessions.server
+
+    def close_smtp_server(self, smtp_server=None):
+        """Cierra la conexion con el servidor smtp
+            :smtp_server: conexion a cerrar, por defecto la del thread actual
+        """
+        if smtp_server is None:
+            smtp_server = getattr(self.smtp_sessions, 'server', None)
+            self.smtp_sessions.server = None
+            if smtp_server is None:
+                return
+        with self.smtp_lock:
+            if smtp_server in self.smtp_servers:
+                self.smtp_servers.remove(smtp_server)
+            if smtp_server in self.smtp_idle:
+                self.smtp_idle.remove(smtp_server)
+        try:
+            smtp_server.quit()
+        except (smtplib.SMTPException, socket.error):
+            smtp_server.close()
+
+    def close(self):
+        """Cierra las conexiones abiertas por el canal
+            Los emails marcados como leidos se eliminan del servidor pop
+        """
+        self.commit_deletes()
+        if self.smtp_servers:
+            logging.info('Conexiones smtp abiertas: %d, mensajes enviados: %d'
+                            % (self.smtp_connections, self.sent_messages))
+        for smtp_server in list(self.smtp_servers):
+            self.close_smtp_server(smtp_server)
+        self.smtp_sessions = threading.local()
+        self.smtp_idle = []
+
+    def release_session(self):
+        """Deja la conexion smtp del thread actual libre para el proximo thread
+            Los threads de cada ciclo del daemon reusan las conexiones del anterior
+            en lugar de abrir otras
+        """
+        smtp_server = getattr(self.smtp_sessions, 'server', None)
+        self.smtp_sessions.server = None
+        if smtp_server is not None:
+            with self.smtp_lock:
+                if smtp_server in self.smtp_servers:
+                    self.smtp_idle.append(smtp_server)
+
+    def connection_counts(self):
+        return {'smtp': self.smtp_connections, 'pop': self.pop_connections}
 
     def load_sinli_codes(self):
         """Lee las direcciones de email para cada codigo sinli de un archivo csv
@@ -230,12 +956,29 @@ class EmailChannel(MessageChannel):
             self.load_sinli_codes()
         return self.sinli_emails[message.dst_code]
 
+    def get_destination_key(self, message):
+        """Dominio de la direccion de destino, los socios con el mismo servidor de
+            email comparten el corte de envios
+        """
+        try:
+            return self.get_destination_address(message).rsplit('@', 1)[-1].lower()
+        except KeyError:
+            return message.dst_code
+
     def gen_email_subject(self, message):
         """Genera una linea para asunto del email a enviar con el mensaje
         """
         return 'SINLIARG: Tipo: %s, De: %s, Para: %s' \
                 % (message.sinli_type, message.src_code, message.dst_code)
 
+    def gen_batch_subject(self, messages):
+        """Genera el asunto del email de un lote de mensajes
+        """
+        def join(attr):
+            return ','.join(sorted(set(getattr(x, attr) for x in messages)))
+        return 'SINLIARG: Tipo: %s, De: %s, Para: %s, Mensajes: %d' \
+                % (join('sinli_type'), join('src_code'), join('dst_code'), len(messages))
+
     def gen_email_body(self, message):
         """Genera el texto para el cuerpo del email a enviar con el mensaje
         """
@@ -254,161 +997,2085 @@ class EmailChannel(MessageChannel):
         pop_server.pass_(self.pop_settings['pass'])
         return pop_server
 
+    def is_sinliarg_headers(self, email):
+        """Determina por los encabezados si un email puede contener un mensaje Sinliarg
+        """
+        return 'sinliarg' in email.get('subject', '').lower()
+
     def is_sinliarg(self, email):
         """Determina si un email contiene un mensaje Sinliarg
         """
-        return bool('sinliarg' in email.get('subject', '').lower()
-                    and len([x for x in email.walk()
-                            if x.get_content_type() in self.sinliMimeTypes]) == 1)
+        return bool(self.is_sinliarg_headers(email) and self.get_sinliarg_parts(email))
 
-    def load_messages(self):
-        """Busca los mensajes en el servidor pop
+    def get_sinliarg_parts(self, email):
+        """Devuelve las partes del email con XML, comprimido o no
+            Si hay adjuntos se ignoran las partes sin nombre de archivo (cuerpo del email)
         """
-        pop_server = self.get_pop_server()
-        email_parser = emailParser()
-        self.messages = {}
+        parts = [x for x in email.walk()
+                 if x.get_content_type() in self.sinliMimeTypes
+                    or x.get_content_type() in self.compressedMimeTypes]
+        return [x for x in parts if x.get_filename()] or parts
+
+    def message_ids(self, email_uid, email):
+        """Devuelve los ids de los mensajes de un email
+            Un email con un solo mensaje se identifica por su uid, los mensajes de un
+            email con varios adjuntos por 'uid nro_de_adjunto' (los uid no tienen espacios)
+        """
+        parts = len(self.get_sinliarg_parts(email))
+        self.email_parts[email_uid] = parts
+        if parts == 1:
+            return [email_uid]
+        return ['%s %d' % (email_uid, x) for x in range(parts)]
+
+    @staticmethod
+    def split_msg_id(msg_id):
+        """Devuelve el uid del email y el nro de adjunto (None si es el unico)
+        """
+        if ' ' in msg_id:
+            email_uid, part = msg_id.rsplit(' ', 1)
+            return email_uid, int(part)
+        return msg_id, None
+
+    def read_attachment(self, email_part):
+        """Devuelve el XML y el nombre de archivo de un adjunto, descomprimiendolo
+            si es un adjunto gzip o zip
+            Si descomprimido supera max_attachment_size levanta AttachmentTooLarge
+        """
+        data = email_part.get_payload(decode=True)
+        filename = email_part.get_filename()
+        method = self.compressedMimeTypes.get(email_part.get_content_type(), None)
+        if method == 'gzip':
+            with gzip.GzipFile(fileobj=BytesIO(data)) as i:
+                data = read_limited(i, self.max_attachment_size)
+            if filename and filename.lower().endswith('.gz'):
+                filename = filename[:-3]
+        elif method == 'zip':
+            with zipfile.ZipFile(BytesIO(data)) as i:
+                names = [x for x in i.namelist() if x.lower().endswith('.xml')] \
+                            or i.namelist()
+                filename = os.path.basename(names[0])
+                # el tamaño del encabezado puede ser falso, igual se lee con limite
+                if i.getinfo(names[0]).file_size > self.max_attachment_size:
+                    raise AttachmentTooLarge('El adjunto %s descomprimido tiene %d bytes'
+                                             % (filename, i.getinfo(names[0]).file_size))
+                with i.open(names[0]) as member:
+                    data = read_limited(member, self.max_attachment_size)
+        return data, filename
+
+    def load_seen_uids(self):
+        """Lee del archivo 'seen_file' los uid de emails ya clasificados como no sinliarg
+        """
+        seen_file = self.pop_settings.get('seen_file', None)
+        if not seen_file or not os.path.isfile(seen_file):
+            return set()
+        with open(seen_file) as i:
+            return set(line.strip() for line in i if line.strip())
+
+    def save_seen_uids(self, seen_uids):
+        """Guarda en el archivo 'seen_file' los uid de emails no sinliarg
+        """
+        seen_file = self.pop_settings.get('seen_file', None)
+        if seen_file:
+            write_file_atomic(seen_file, ''.join('%s\n' % x for x in sorted(seen_uids)))
+
+    def read_email_headers(self, email_nro):
+        """Lee solo los encabezados de un email (TOP n 0)
+            Si el servidor no soporta TOP devuelve None
+        """
+        try:
+            header_lines = self.get_pop_session().top(email_nro, 0)[1]
+        except poplib.error_proto:
+            return None
+        return emailParser().parse(BytesIO(b'\n'.join(header_lines)), headersonly=True)
 
-        for email_ids in pop_server.uidl()[1]:
+    def get_pop_session(self):
+        """Devuelve la conexion con el servidor pop compartida por todo el proceso
+            La conexion se reusa hasta que se cierra el canal
+        """
+        if self.pop_server is None:
+            self.pop_server = self.get_pop_server()
+            self.pop_connections += 1
+            self.pop_uids = {}
+        return self.pop_server
+
+    def discard_pop_session(self):
+        """Cierra la conexion pop despues de un error
+            Intenta quit para liberar el bloqueo del buzon y si falla cierra el
+            socket, en los dos casos el servidor lo libera antes de la proxima sesion
+        """
+        pop_server, self.pop_server = self.pop_server, None
+        self.pop_uids = {}
+        if pop_server is None:
+            return
+        try:
+            pop_server.quit()
+        except (poplib.error_proto, socket.error):
+            pop_server.close()
+
+    def load_pop_uids(self):
+        """Lee los uid de los emails del servidor pop
+            Devuelve la lista de (nro, uid) y guarda el mapa uid -> nro de la sesion
+        """
+        emails = []
+        for email_ids in self.get_pop_session().uidl()[1]:
             email_ids = email_ids.decode("utf-8")
             email_nro, email_uid = email_ids.split(' ')
-            try:
-                email_data = b'\n'.join(pop_server.retr(email_nro)[1])
-            except Exception:
-                logging.error('Error leyendo email uid: %s\n%s' % (email_uid, traceback.format_exc()))
+            emails.append((email_nro, email_uid))
+        self.pop_uids = dict((uid, nro) for nro, uid in emails)
+        return emails
+
+    def get_spool_file(self, msg_id):
+        """Devuelve el archivo donde se guarda el email msg_id en el directorio 'spool_dir'
+        """
+        return os.path.join(self.pop_settings['spool_dir'], '%s.eml'
+                            % binascii.hexlify(msg_id.encode('utf-8')).decode('ascii'))
+
+    def retrieve_emails(self):
+        """Descarga los emails sinliarg del servidor pop
+            Devuelve (uid, datos, email) por cada email sinliarg encontrado
+        """
+        pop_server = self.get_pop_session()
+        email_parser = emailParser()
+        spool_dir = self.pop_settings.get('spool_dir', None)
+        seen_uids = self.load_seen_uids()
+        mailbox_uids = set()
+
+        for email_nro, email_uid in self.load_pop_uids():
+            mailbox_uids.add(email_uid)
+            if email_uid in seen_uids:
                 continue
+            if spool_dir and os.path.isfile(self.get_spool_file(email_uid)):
+                # descargado en una ejecucion anterior
+                with open(self.get_spool_file(email_uid), 'rb') as i:
+                    email_data = i.read()
+            else:
+                headers = self.read_email_headers(email_nro)
+                if headers is not None and not self.is_sinliarg_headers(headers):
+                    logging.info('Ignorando email asunto: %s' % headers.get('subject', None))
+                    seen_uids.add(email_uid)
+                    continue
+                try:
+                    email_data = b'\n'.join(pop_server.retr(email_nro)[1])
+                except Exception:
+                    logging.error('Error leyendo email uid: %s\n%s' % (email_uid, traceback.format_exc()))
+                    continue
             email = email_parser.parse(BytesIO(email_data))
             logging.info('Leyendo email asunto: %s' % email.get('subject', None))
             if self.is_sinliarg(email):
                 logging.debug('  email sinliarg reconocido')
-                self.messages[email_uid] = email
+                yield email_uid, email_data, email
+            else:
+                seen_uids.add(email_uid)
+
+        # solo se recuerdan los emails que siguen en el servidor
+        self.save_seen_uids(seen_uids & mailbox_uids)
+        if spool_dir:
+            spool_files = set(self.get_spool_file(x) for x in mailbox_uids)
+            for filename in os.listdir(spool_dir):
+                spool_file = os.path.join(spool_dir, filename)
+                if spool_file.endswith('.eml') and spool_file not in spool_files:
+                    os.remove(spool_file)
+
+    def load_messages(self):
+        """Busca los mensajes en el servidor pop
+            Si esta configurado 'spool_dir' los emails se guardan en disco a medida
+            que se descargan y los ids se devuelven de a uno
+        """
+        self.messages = {}
+        self.messages_data = {}
+        self.email_parts = {}
+        self.marked_parts = {}
+        if self.pop_settings.get('spool_dir', None):
+            return self.spool_messages()
 
-        pop_server.quit()
-        return self.messages.keys()
+        msg_ids = []
+        for email_uid, email_data, email in self.retrieve_emails():
+            self.messages[email_uid] = email
+            self.messages_data[email_uid] = email_data
+            msg_ids.extend(self.message_ids(email_uid, email))
+        return msg_ids
+
+    def spool_messages(self):
+        """Guarda cada email sinliarg en el directorio 'spool_dir' y devuelve su uid
+        """
+        if not os.path.isdir(self.pop_settings['spool_dir']):
+            os.makedirs(self.pop_settings['spool_dir'])
+        for email_uid, email_data, email in self.retrieve_emails():
+            spool_file = self.get_spool_file(email_uid)
+            if not os.path.isfile(spool_file):
+                write_file_atomic(spool_file, email_data)
+            msg_ids = self.message_ids(email_uid, email)
+            del email_data, email
+            for msg_id in msg_ids:
+                yield msg_id
+
+    def read_email_data(self, msg_id):
+        """Devuelve el contenido del email msg_id tal como se descargo
+        """
+        if msg_id in self.messages_data:
+            return self.messages_data[msg_id]
+        if self.pop_settings.get('spool_dir', None) and os.path.isfile(self.get_spool_file(msg_id)):
+            with open(self.get_spool_file(msg_id), 'rb') as i:
+                return i.read()
+        return b'\n'.join(self.get_pop_session().retr(self.pop_uids[msg_id])[1])
+
+    def read_email(self, msg_id):
+        """Devuelve el email msg_id ya leido, desde memoria o desde el spool
+        """
+        if msg_id in self.messages:
+            return self.messages[msg_id]
+        if self.pop_settings.get('spool_dir', None) and os.path.isfile(self.get_spool_file(msg_id)):
+            with open(self.get_spool_file(msg_id), 'rb') as i:
+                return emailParser().parse(i)
+        raise Exception('El mensaje id:%s no fue leido' % msg_id)
 
     def get_message(self, msg_id):
         """Devuelve el mensaje msg_id
-            :msg_id: el id del mensaje es el path al archivo con su contenido
+            :msg_id: uid del email o 'uid nro_de_adjunto'
         """
-        if msg_id not in self.messages:
-            raise Exception('El mensaje id:%s no fue leido' % msg_id)
+        email_uid, part = self.split_msg_id(msg_id)
+        email_part = self.get_sinliarg_parts(self.read_email(email_uid))[part or 0]
+        return self.read_sinliarg_part(email_part)
 
-        email_part = [x for x in self.messages[msg_id].walk()
-                      if x.get_content_type() in self.sinliMimeTypes][0]
-
-        message_data = email_part.get_payload(decode=True)
+    def read_sinliarg_part(self, email_part):
+        """Devuelve el mensaje Sinliarg de una parte del email
+        """
+        message_data, filename = self.read_attachment(email_part)
         if not message_data.startswith(b'<?'):       # para leer mensajes con registro SINLI
             message_data = message_data[message_data.find(b'<?'):]
 
-        return SinliargMessage(message_data, filename=email_part.get_filename())
+        return SinliargMessage(message_data, filename=filename)
 
     def mark_message(self, msg_id, error=False):
         """Marca un mensaje como procesado/leido
-            Elimina el email del servidor pop
-            :msg_id: uid del email
-        """
-        global settings
-        deleted = False
-        pop_server = self.get_pop_server()
-        base_dir = settings["base_path"]
-        error_path = os.path.join(base_dir, "not_well_formed_emails")
-        for email_ids in pop_server.uidl()[1]:
-            email_ids = email_ids.decode("utf-8")
-            email_nro, email_uid = email_ids.split(' ')
-            if email_uid == msg_id:
-                if error:
-                    logging.info('Guardando mail erróneo uid: %s' % msg_id)
-                    if not os.path.isdir(error_path):
-                        os.makedirs(error_path)
-                    filename = os.path.join(error_path, "%s.msg" % msg_id)
-                    open(filename, "wb").write(b'\n'.join(pop_server.retr(email_nro)[1]))
-                logging.info('Eliminando email uid: %s del servidor POP' % msg_id)
-                pop_server.dele(email_nro)
-                deleted = True
-                break
-        pop_server.quit()
-        if not deleted:
+            El email se elimina del servidor pop al cerrar el canal, si tiene
+            varios mensajes cuando se marcaron todos
+            :msg_id: uid del email o 'uid nro_de_adjunto'
+        """
+        msg_id, part = self.split_msg_id(msg_id)
+        if not self.pop_uids:
+            self.load_pop_uids()
+        if msg_id not in self.pop_uids:
             logging.error('No se encontró el mensaje uid: %s' % msg_id)
-        return deleted
+            return False
 
+        if error:
+            self.save_error_email(msg_id)
+        if not self.mark_part(msg_id, part):
+            return True
+        logging.info('Email uid: %s marcado para eliminar del servidor POP' % msg_id)
+        self.pending_deletes.append(msg_id)
+        return True
 
-def pipeChannels(src_channel, dst_channel):
-    """Enviar los mensajes de un canal a otro
-        :src_channel: canal de origen de los mensajes
-        :dst_channel: canal de destino de los mensajes
-    """
-    logging.info('Envio de mensajes %s->%s iniciado' % (src_channel, dst_channel))
-    for msg_id in src_channel.load_messages():
-        logging.info('Procesando mensaje id: %s' % msg_id)
-        try:
-            sinli_message = src_channel.get_message(msg_id)
-            logging.debug('...leido correctamente')
-        except cElementTree.ParseError:
-            logging.error('Error error de parseo leyendo el mensaje %s.\n%s', msg_id, traceback.format_exc())
-            src_channel.mark_message(msg_id, True)
-            continue
-        except Exception:
-            logging.error('Error obteniendo datos del mensaje\n%s' % traceback.format_exc())
-            continue
+    def save_error_email(self, email_uid):
+        """Guarda el email erroneo en el directorio 'error_path'
+        """
+        if self.error_path is None:
+            raise ValueError('No se indico el directorio para los emails erroneos (error_path)')
+        logging.info('Guardando mail erróneo uid: %s' % email_uid)
+        make_dirs(self.error_path)
+        email_data = self.read_email_data(email_uid)
+        with open(os.path.join(self.error_path, "%s.msg" % email_uid), "wb") as o:
+            o.write(email_data)
+
+    def mark_part(self, email_uid, part):
+        """Registra el mensaje part del email como marcado
+            Devuelve True cuando ya se marcaron todos los mensajes del email
+        """
+        if part is None:
+            return True
+        marked = self.marked_parts.setdefault(email_uid, set())
+        marked.add(part)
+        if len(marked) < self.email_parts.get(email_uid, 0):
+            logging.info('Mensaje %d del email uid: %s marcado' % (part, email_uid))
+            return False
+        del self.marked_parts[email_uid]
+        return True
 
+    def commit_deletes(self):
+        """Elimina del servidor pop los emails marcados y cierra la sesion
+            Si la sesion se perdio, abre una nueva y vuelve a buscar los uid
+        """
+        if self.pop_server is None and not self.pending_deletes:
+            return
         try:
-            logging.info('Enviando mensaje id: %s' % msg_id)
-            dst_channel.send_message(sinli_message)
-            logging.debug('...enviado correctamente')
-        except Exception:
-            logging.error('Error enviando mensaje\n%s' % traceback.format_exc())
-        else:
-            src_channel.mark_message(msg_id)
-    src_channel.close()
-    logging.info('Envio de mensajes %s->%s finalizado' % (src_channel, dst_channel))
+            pop_server = self.get_pop_session()
+            if self.pending_deletes and not self.pop_uids:
+                self.load_pop_uids()
+            for msg_id in self.pending_deletes:
+                logging.info('Eliminando email uid: %s del servidor POP' % msg_id)
+                pop_server.dele(self.pop_uids[msg_id])
+            pop_server.quit()
+        except (poplib.error_proto, socket.error):
+            logging.error('Error eliminando emails, reintentando con una nueva conexion\n%s'
+                            % traceback.format_exc())
+            self.discard_pop_session()
+            pop_server = self.get_pop_session()
+            self.load_pop_uids()
+            for msg_id in self.pending_deletes:
+                if msg_id in self.pop_uids:
+                    pop_server.dele(self.pop_uids[msg_id])
+            pop_server.quit()
+        if self.pop_settings.get('spool_dir', None):
+            for msg_id in self.pending_deletes:
+                if os.path.isfile(self.get_spool_file(msg_id)):
+                    os.remove(self.get_spool_file(msg_id))
+        self.pop_server = None
+        self.pop_uids = {}
+        self.pending_deletes = []
 
 
-def __main__(argv=None):
-    """Lee archivos desde un directorio
-        Por cada archivo envia un email de sinli
-        Despues de enviar el email mueve el archivo a otro directorio
+class ImapChannel(EmailChannel):
+    """Canal de intercambio de mensajes por email que lee los emails por IMAP
+        Los emails se buscan en el servidor por asunto y solo se descargan las
+        partes con XML. Los emails procesados se marcan con un flag o se mueven
+        a otra carpeta, no se eliminan. Los mensajes se envian por smtp como en
+        EmailChannel
     """
-    global settings
+    idle_tag = b'SINLI1'
 
-    arg_parser = argparse.ArgumentParser(description='Enviar mensajes sinliarg entre distintos canales')
-    arg_parser.add_argument('-i', '--input', required=True,
-                            choices=('files', 'emails'),
-                            help='Canal de entrada (files|email)')
-    arg_parser.add_argument('-o', '--output', required=True,
-                            choices=('files', 'emails'),
-                            help='Canal de salida (files|email)')
-    arg_parser.add_argument('-s', '--settings', default='settings.json',
-                            help='Archivo de configuración')
-    args = arg_parser.parse_args(argv)
+    def __init__(self, smtp_settings, imap_settings, msg_from='', eaddress_file=None,
+                 compression=None, batch=None, error_path=None, max_attachment_size=None):
+        """
+            :smtp_settings: dict de configuracion del servidor smtp
+                            {'host': '', 'port': '', 'user': '', 'pass': ''}
+            :imap_settings: dict de configuracion del servidor imap
+                            {'host': '', 'port': '', 'user': '', 'pass': '',
+                             'ssl': False, 'tls': False, 'mailbox': 'INBOX',
+                             'search_subject': 'SINLIARG',
+                             'processed_flag': '$SinliargProcesado',
+                             'processed_mailbox': None, 'error_mailbox': None}
+                            Si no se indica 'processed_mailbox' los emails procesados
+                            se marcan con 'processed_flag' y quedan en la carpeta.
+                            Si el servidor no acepta flags propios usar '\\Seen'
+            (el resto de los parametros como en EmailChannel)
+        """
+        EmailChannel.__init__(self, smtp_settings, {}, msg_from=msg_from,
+                              eaddress_file=eaddress_file, compression=compression,
+                              batch=batch, error_path=error_path,
+                              max_attachment_size=max_attachment_size)
+        self.imap_settings = imap_settings
+        self.imap_server = None
+        self.imap_connections = 0
+        self.imap_lock = threading.RLock()
+        self.capabilities = set()
+        self.imap_parts = {}            # uid -> secciones de las partes con XML
+        self.error_uids = set()         # emails con algun mensaje erroneo
+        self.pending_expunge = False
 
-    try:
-        with open(args.settings) as i:
-            settings = json.load(i)
-    except Exception:
-        print('Error abriendo archivo de configuracion: %s\n\n' % args.settings)
-        raise
+    def __str__(self):
+        return 'ImapChannel(%s)' % self.msg_from
 
-    # configurar el log
-    log_format = '%(asctime)s|%(levelname)s|%(message)s'
-    log_level = getattr(logging, settings.get('log_level', 'DEBUG'), logging.DEBUG)
-    if 'log_file' in settings:
-        logging.basicConfig(filename=settings['log_file'], level=log_level,
-                            format=log_format)
-    else:
-        logging.basicConfig(level=log_level, format=log_format)
+    def connection_counts(self):
+        return dict(EmailChannel.connection_counts(self), imap=self.imap_connections)
+
+    @property
+    def processed_flag(self):
+        return self.imap_settings.get('processed_flag', '$SinliargProcesado')
+
+    def get_imap_server(self):
+        """Inicia una conexión con el servidor imap y selecciona la carpeta
+        """
+        logging.debug('Iniciando conexion con servidor imap %s:%s'
+                        % (self.imap_settings['host'], self.imap_settings.get('port', None)))
+        if self.imap_settings.get('ssl', False):
+            imap_server = imaplib.IMAP4_SSL(self.imap_settings['host'],
+                                            self.imap_settings.get('port', None) or 993)
+        else:
+            imap_server = imaplib.IMAP4(self.imap_settings['host'],
+                                        self.imap_settings.get('port', None) or 143)
+            if self.imap_settings.get('tls', False):
+                imap_server.starttls()
+        imap_server.login(self.imap_settings['user'], self.imap_settings['pass'])
+        self.check_response(imap_server.select(self.imap_settings.get('mailbox', 'INBOX')))
+        self.capabilities = set(x.upper() for x in imap_server.capabilities)
+        return imap_server
+
+    def get_imap_session(self):
+        """Devuelve la conexion con el servidor imap, se reusa hasta que se cierra el canal
+        """
+        if self.imap_server is None:
+            self.imap_server = self.get_imap_server()
+            self.imap_connections += 1
+        return self.imap_server
+
+    @staticmethod
+    def check_response(response):
+        """Devuelve los datos de una respuesta de imaplib, si no es OK lanza imaplib.IMAP4.error
+        """
+        result, data = response
+        if result != 'OK':
+            raise imaplib.IMAP4.error('Respuesta imap %s: %s' % (result, data))
+        return data
+
+    def uid_command(self, command, *args):
+        with self.imap_lock:
+            return self.check_response(self.get_imap_session().uid(command, *args))
+
+    @staticmethod
+    def parse_response(data):
+        """Convierte los datos de una respuesta de imaplib en una lista de valores
+            Las listas entre parentesis se devuelven como listas, los strings y
+            literales como bytes, los numeros como int y NIL como None
+        """
+        raw = b''
+        for item in data:
+            if isinstance(item, tuple):
+                # imaplib separa los literales {n}, se vuelven a unir con su CRLF
+                raw += item[0] + b'\r\n' + item[1] + b' '
+            elif item is not None:
+                raw += item + b' '
+        stack = [[]]
+        pos = 0
+        while pos < len(raw):
+            char = raw[pos:pos + 1]
+            if char in (b' ', b'\r', b'\n'):
+                pos += 1
+            elif char == b'(':
+                stack.append([])
+                pos += 1
+            elif char == b')':
+                value = stack.pop()
+                stack[-1].append(value)
+                pos += 1
+            elif char == b'"':
+                end = pos + 1
+                value = b''
+                while raw[end:end + 1] != b'"':
+                    if raw[end:end + 1] == b'\\':
+                        end += 1
+                    value += raw[end:end + 1]
+                    end += 1
+                stack[-1].append(value)
+                pos = end + 1
+            elif char == b'{':
+                end = raw.index(b'}', pos)
+                size = int(raw[pos + 1:end])
+                pos = end + 3       # } y CRLF
+                stack[-1].append(raw[pos:pos + size])
+                pos += size
+            else:
+                end = pos
+                while end < len(raw) and raw[end:end + 1] not in (b' ', b'(', b')', b'\r', b'\n'):
+                    if raw[end:end + 1] == b'[':
+                        end = raw.index(b']', end)
+                    end += 1
+                value = raw[pos:end]
+                if value.upper() == b'NIL':
+                    value = None
+                elif value.isdigit():
+                    value = int(value)
+                stack[-1].append(value)
+                pos = end
+        return stack[0]
+
+    def parse_fetch(self, data):
+        """Devuelve uid -> {ITEM: valor} de una respuesta de FETCH
+        """
+        values = self.parse_response(data)
+        emails = {}
+        for items in values[1::2]:
+            items = dict((items[x].upper(), items[x + 1]) for x in range(0, len(items) - 1, 2))
+            if b'UID' in items:
+                emails[str(items[b'UID'])] = items
+        return emails
+
+    @staticmethod
+    def text(value):
+        return value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+
+    def find_parts(self, body, section=''):
+        """Devuelve (seccion, tipo mime, nombre de archivo) de las partes de un BODYSTRUCTURE
+        """
+        if isinstance(body[0], list):
+            # las partes van antes del subtipo, despues siguen los parametros del multipart
+            parts = []
+            for nro, sub_body in enumerate(itertools.takewhile(
+                                                lambda x: isinstance(x, list), body)):
+                parts.extend(self.find_parts(sub_body, '%s%d' % (section and section + '.',
+                                                                 nro + 1)))
+            return parts
+        mime_type = ('%s/%s' % (self.text(body[0]), self.text(body[1]))).lower()
+        params = body[2] if isinstance(body[2], list) else []
+        params = dict((self.text(params[x]).lower(), self.text(params[x + 1]))
+                      for x in range(0, len(params) - 1, 2))
+        filename = params.get('name', None)
+        # la disposicion esta despues de md5, que va despues de los campos de cada tipo
+        disposition = body[9 if mime_type.startswith('text/') else 8:][:1]
+        if disposition and isinstance(disposition[0], list) and len(disposition[0]) > 1 \
+                and isinstance(disposition[0][1], list):
+            disposition = disposition[0][1]
+            disposition = dict((self.text(disposition[x]).lower(), self.text(disposition[x + 1]))
+                               for x in range(0, len(disposition) - 1, 2))
+            filename = disposition.get('filename', filename)
+        return [(section, mime_type, filename)]
+
+    def get_sinliarg_sections(self, body):
+        """Devuelve las secciones de las partes con XML, comprimido o no
+            Si hay adjuntos se ignoran las partes sin nombre de archivo (cuerpo del email)
+        """
+        parts = [x for x in self.find_parts(body)
+                 if x[1] in self.sinliMimeTypes or x[1] in self.compressedMimeTypes]
+        return [x[0] for x in parts if x[2]] or [x[0] for x in parts]
+
+    def search_criteria(self):
+        """Criterios de SEARCH de los emails sinliarg no procesados
+        """
+        flag = self.processed_flag
+        if flag.startswith('\\'):
+            not_processed = ['UN' + flag[1:].upper()]
+        else:
+            not_processed = ['UNKEYWORD', flag]
+        return ['UNDELETED'] + not_processed \
+                + ['SUBJECT', '"%s"' % self.imap_settings.get('search_subject', 'SINLIARG')]
+
+    def load_messages(self):
+        """Busca en el servidor imap los emails sinliarg no procesados
+            Solo se descarga la estructura de cada email, las partes con XML se
+            descargan en get_message
+        """
+        self.imap_parts = {}
+        self.email_parts = {}
+        self.marked_parts = {}
+        self.error_uids = set()
+        uids = self.uid_command('SEARCH', *self.search_criteria())[0].split()
+        uids = [x.decode('ascii') for x in uids]
+        logging.info('Emails sinliarg encontrados en el servidor imap: %d' % len(uids))
+
+        msg_ids = []
+        for start in range(0, len(uids), 200):
+            chunk = uids[start:start + 200]
+            emails = self.parse_fetch(self.uid_command('FETCH', ','.join(chunk),
+                                                       '(UID BODYSTRUCTURE)'))
+            for email_uid in chunk:
+                body = emails.get(email_uid, {}).get(b'BODYSTRUCTURE', None)
+                sections = self.get_sinliarg_sections(body) if body else []
+                if not sections:
+                    logging.info('Ignorando email uid: %s sin adjuntos sinliarg' % email_uid)
+                    self.store_processed(email_uid)
+                    continue
+                self.imap_parts[email_uid] = sections
+                self.email_parts[email_uid] = len(sections)
+                if len(sections) == 1:
+                    msg_ids.append(email_uid)
+                else:
+                    msg_ids.extend('%s %d' % (email_uid, x) for x in range(len(sections)))
+        return msg_ids
+
+    def fetch_part(self, email_uid, section):
+        """Descarga una parte del email con sus encabezados MIME, sin marcarlo como leido
+            Devuelve la parte como email.message
+        """
+        if section:
+            items = ['BODY[%s.MIME]' % section, 'BODY[%s]' % section]
+        else:
+            items = ['BODY[HEADER]', 'BODY[TEXT]']
+        fetched = self.parse_fetch(self.uid_command(
+                        'FETCH', email_uid,
+                        '(UID %s)' % ' '.join(x.replace('BODY', 'BODY.PEEK') for x in items)))
+        if email_uid not in fetched:
+            raise Exception('No se encontró el mensaje uid: %s' % email_uid)
+        data = b''.join(fetched[email_uid].get(x.encode('ascii'), None) or b'' for x in items)
+        return emailParser().parse(BytesIO(data))
+
+    def get_message(self, msg_id):
+        """Devuelve el mensaje msg_id descargando solo su parte del email
+            :msg_id: uid del email o 'uid nro_de_adjunto'
+        """
+        email_uid, part = self.split_msg_id(msg_id)
+        if email_uid not in self.imap_parts:
+            raise Exception('El mensaje id:%s no fue leido' % msg_id)
+        return self.read_sinliarg_part(
+                    self.fetch_part(email_uid, self.imap_parts[email_uid][part or 0]))
+
+    def read_email_data(self, msg_id):
+        """Descarga el email completo
+        """
+        fetched = self.parse_fetch(self.uid_command('FETCH', msg_id, '(UID BODY.PEEK[])'))
+        return fetched[msg_id][b'BODY[]']
+
+    def store_processed(self, email_uid):
+        self.uid_command('STORE', email_uid, '+FLAGS.SILENT', '(%s)' % self.processed_flag)
+
+    def move_email(self, email_uid, mailbox):
+        """Mueve el email a otra carpeta, con MOVE o si el servidor no lo soporta
+            copiandolo y marcandolo para eliminar al cerrar el canal
+        """
+        if 'MOVE' in self.capabilities and 'MOVE' in imaplib.Commands:
+            self.uid_command('MOVE', email_uid, mailbox)
+        else:
+            self.uid_command('COPY', email_uid, mailbox)
+            self.uid_command('STORE', email_uid, '+FLAGS.SILENT', '(\\Deleted)')
+            self.pending_expunge = True
+
+    def mark_message(self, msg_id, error=False):
+        """Marca un mensaje como procesado/leido
+            El email se marca con 'processed_flag' y se mueve a 'processed_mailbox'
+            (o a 'error_mailbox' si algun mensaje tuvo error) cuando se marcaron
+            todos sus mensajes
+            :msg_id: uid del email o 'uid nro_de_adjunto'
+        """
+        email_uid, part = self.split_msg_id(msg_id)
+        if email_uid not in self.imap_parts:
+            logging.error('No se encontró el mensaje uid: %s' % email_uid)
+            return False
+
+        if error and email_uid not in self.error_uids:
+            self.save_error_email(email_uid)
+            self.error_uids.add(email_uid)
+        if not self.mark_part(email_uid, part):
+            return True
+        self.store_processed(email_uid)
+        mailbox = self.imap_settings.get('processed_mailbox', None)
+        if email_uid in self.error_uids:
+            mailbox = self.imap_settings.get('error_mailbox', None) or mailbox
+        if mailbox:
+            logging.info('Moviendo email uid: %s a la carpeta %s' % (email_uid, mailbox))
+            self.move_email(email_uid, mailbox)
+        else:
+            logging.info('Email uid: %s marcado como procesado' % email_uid)
+        return True
+
+    def commit_deletes(self):
+        """Elimina los emails copiados a otra carpeta y cierra la sesion imap
+        """
+        if self.imap_server is None:
+            return
+        try:
+            with self.imap_lock:
+                if self.pending_expunge:
+                    self.imap_server.expunge()
+                self.imap_server.logout()
+        finally:
+            self.imap_server = None
+            self.pending_expunge = False
+
+    def idle(self, timeout, stop_event=None):
+        """Espera hasta timeout segundos a que lleguen emails nuevos usando IDLE
+            Devuelve True si llegaron emails. Si el servidor no soporta IDLE solo
+            espera y devuelve False. La conexion debe ser exclusiva de la espera
+            :stop_event: threading.Event que interrumpe la espera
+        """
+        imap_server = self.get_imap_session()
+        if 'IDLE' not in self.capabilities:
+            if stop_event is not None:
+                stop_event.wait(timeout)
+            else:
+                time.sleep(timeout)
+            return False
+
+        imap_server.send(self.idle_tag + b' IDLE\r\n')
+        line = imap_server.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error('El servidor rechazo IDLE: %r' % line)
+        new_emails = False
+        end_time = time.time() + timeout
+        try:
+            while not new_emails:
+                remaining = end_time - time.time()
+                if remaining <= 0 or (stop_event is not None and stop_event.is_set()):
+                    break
+                pending = getattr(imap_server.sock, 'pending', lambda: 0)()
+                if not pending and not select.select([imap_server.sock], [], [],
+                                                     min(remaining, 1))[0]:
+                    continue
+                line = imap_server.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort('Conexion imap cerrada durante IDLE')
+                new_emails = line.rstrip().upper().endswith((b'EXISTS', b'RECENT'))
+        finally:
+            imap_server.send(b'DONE\r\n')
+            while True:
+                line = imap_server.readline()
+                if not line or line.startswith(self.idle_tag + b' '):
+                    break
+        return new_emails
+
+
+class DuplicateIndex(object):
+    """Indice persistente (sqlite) de mensajes ya enviados
+        Un mensaje es duplicado si ya se envio otro del mismo origen con el mismo
+        ARCHIVO/IDENTIFICADOR o con el mismo contenido, o si otro igual se esta
+        enviando (ver reserve)
+    """
+    # tipo de clave -> consultas con (origen, valor)
+    select_queries = {
+        'identifier': 'SELECT 1 FROM identifiers WHERE src_code = ? AND identifier = ?',
+        'digest': 'SELECT 1 FROM contents WHERE src_code = ? AND digest = ?'}
+    insert_queries = {
+        'identifier': 'INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?)',
+        'digest': 'INSERT OR REPLACE INTO contents VALUES (?, ?, ?)'}
+
+    def __init__(self, filename):
+        """
+            :filename: archivo de la base sqlite
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS identifiers ('
+                        'src_code TEXT, identifier TEXT, created REAL, '
+                        'PRIMARY KEY (src_code, identifier))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS contents ('
+                        'src_code TEXT, digest TEXT, created REAL, '
+                        'PRIMARY KEY (src_code, digest))')
+        # la tabla anterior guardaba el contenido sin el origen, no se puede convertir
+        self.db.execute('DROP TABLE IF EXISTS digests')
+        self.db.execute('CREATE INDEX IF NOT EXISTS identifiers_created ON identifiers (created)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS contents_created ON contents (created)')
+        self.db.commit()
+        self.reserved = {}              # id(mensaje) -> claves de los mensajes en envio
+        self.reserved_keys = set()
+
+    @staticmethod
+    def message_keys(message):
+        """Claves con las que se reconoce el mensaje: identificador y contenido,
+            las dos por origen
+        """
+        keys = [('digest', message.src_code, message.content_digest())]
+        if message.identifier:
+            keys.insert(0, ('identifier', message.src_code, message.identifier))
+        return keys
+
+    def is_known(self, keys):
+        """Si alguna de las claves esta registrada o reservada, con el lock tomado
+        """
+        if self.reserved_keys.intersection(keys):
+            return True
+        return any(self.db.execute(self.select_queries[key[0]], key[1:]).fetchone()
+                   for key in keys)
+
+    def reserve(self, message):
+        """Reserva el mensaje mientras se envia, devuelve False si es duplicado
+            Otro mensaje igual que llega antes de que termine el envio (por ejemplo
+            en el mismo lote) es duplicado. La reserva se confirma con add o se
+            libera con release si el envio falla
+        """
+        keys = self.message_keys(message)
+        with self.lock:
+            if self.is_known(keys):
+                return False
+            self.reserved[id(message)] = keys
+            self.reserved_keys.update(keys)
+        return True
+
+    def release(self, message):
+        """Libera la reserva de un mensaje que no se envio
+        """
+        with self.lock:
+            self.reserved_keys.difference_update(self.reserved.pop(id(message), []))
+
+    def add(self, message):
+        """Registra el mensaje como enviado
+        """
+        with self.lock:
+            keys = self.reserved.pop(id(message), None)
+        if keys is None:
+            keys = self.message_keys(message)
+        now = time.time()
+        with self.lock:
+            self.reserved_keys.difference_update(keys)
+            for key in keys:
+                self.db.execute(self.insert_queries[key[0]], key[1:] + (now,))
+            self.db.commit()
+
+    def prune(self, max_age_days):
+        """Elimina las entradas con mas de max_age_days dias, devuelve cuantas elimino
+        """
+        limit = time.time() - max_age_days * 86400
+        with self.lock:
+            deleted = self.db.execute('DELETE FROM identifiers WHERE created < ?', (limit,)).rowcount
+            deleted += self.db.execute('DELETE FROM contents WHERE created < ?', (limit,)).rowcount
+            self.db.commit()
+        return deleted
+
+    def close(self):
+        self.db.close()
+
+
+def build_dedup_index(settings):
+    """Crea el indice de duplicados si esta configurado 'dedup_file'
+        y elimina las entradas de mas de 'dedup_max_age_days' dias
+    """
+    if not settings.get('dedup_file', None):
+        return None
+    dedup = DuplicateIndex(settings['dedup_file'])
+    if settings.get('dedup_max_age_days', None):
+        logging.info('Entradas de duplicados eliminadas: %d'
+                        % dedup.prune(settings['dedup_max_age_days']))
+    return dedup
+
+
+class RunJournal(object):
+    """Registro en disco del estado de los mensajes en pipeChannels
+        Cada linea es un json [canal, id del mensaje, estado, hora] y solo se agregan
+        lineas al final. Los estados son 'read', 'sent' y 'marked'. Al abrirlo se
+        reproduce el registro: un mensaje 'sent' que no llego a 'marked' se envio
+        antes de una interrupcion y en la proxima ejecucion solo se marca, uno 'read'
+        se vuelve a enviar. Un mensaje pasa a 'marked' recien cuando el canal de
+        origen confirmo la marca al cerrarse (ver commit_marks). El archivo se compacta
+        reescribiendolo solo con los mensajes sin marcar
+    """
+
+    def __init__(self, filename, sync_every=100, sync_interval=1.0, compact_lines=10000,
+                 max_age_days=30):
+        """
+            :filename: archivo del registro
+            :sync_every: cantidad maxima de lineas escritas sin fsync
+            :sync_interval: segundos maximos sin fsync
+            :compact_lines: se compacta cuando el archivo tiene mas lineas que esto
+                            y que el doble de los mensajes sin marcar
+            :max_age_days: al compactar se descartan los mensajes sin marcar mas
+                           viejos, que el canal de origen ya no devuelve
+        """
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_lines = compact_lines
+        self.max_age_days = max_age_days
+        self.lock = threading.RLock()
+        self.entries = {}       # (canal, id del mensaje) -> (estado, hora)
+        self.pending_marks = {}  # canal -> ids marcados que el canal todavia no confirmo
+        self.lines = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.file = None
+        self.replay()
+        self.compact()
+        if self.entries:
+            logging.info('Registro de ejecucion %s: %d mensajes sin terminar'
+                            % (filename, len(self.entries)))
+
+    def replay(self):
+        """Lee el registro y deja en entries el ultimo estado de cada mensaje sin marcar
+        """
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as i:
+            for line in i:
+                try:
+                    channel, msg_id, state, created = json.loads(line.decode('utf-8'))
+                except (ValueError, TypeError):
+                    # la ultima linea puede estar incompleta si se corto la escritura
+                    logging.warning('Linea invalida en el registro %s: %r' % (self.filename, line))
+                    continue
+                self.lines += 1
+                if state == 'marked':
+                    self.entries.pop((channel, msg_id), None)
+                else:
+                    self.entries[(channel, msg_id)] = (state, created)
+
+    @staticmethod
+    def format_entry(channel, msg_id, state, created):
+        return (json.dumps([channel, msg_id, state, created]) + '\n').encode('utf-8')
+
+    def compact(self):
+        """Reescribe el registro solo con los mensajes sin marcar
+        """
+        limit = time.time() - self.max_age_days * 86400
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+            self.entries = dict((key, value) for key, value in self.entries.items()
+                                if value[1] >= limit)
+            write_file_atomic(self.filename, b''.join(self.format_entry(key[0], key[1], *value)
+                                                      for key, value in self.entries.items()))
+            self.lines = len(self.entries)
+            self.file = open(self.filename, 'ab')
+
+    def state(self, channel, msg_id):
+        """Ultimo estado del mensaje msg_id del canal, None si no esta o ya se marco
+        """
+        with self.lock:
+            return self.entries.get((str(channel), msg_id), (None,))[0]
+
+    def record(self, channel, msg_id, state):
+        """Agrega el nuevo estado del mensaje al registro
+            Se hace fsync cada sync_every lineas o sync_interval segundos
+        """
+        key = (str(channel), msg_id)
+        created = round(time.time(), 3)
+        with self.lock:
+            if state == 'marked':
+                self.entries.pop(key, None)
+            else:
+                self.entries[key] = (state, created)
+            self.file.write(self.format_entry(key[0], msg_id, state, created))
+            self.lines += 1
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every \
+                    or time.time() - self.last_sync >= self.sync_interval:
+                self.sync()
+
+    def mark(self, channel, msg_id):
+        """Registra que el mensaje se marco en el canal, sin escribirlo todavia
+            El canal pop elimina los emails recien al cerrar la sesion: si se
+            interrumpe antes el mensaje tiene que seguir 'sent'
+        """
+        with self.lock:
+            self.pending_marks.setdefault(str(channel), []).append(msg_id)
+
+    def commit_marks(self, channel):
+        """Registra como 'marked' los mensajes marcados en el canal, despues de cerrarlo
+        """
+        with self.lock:
+            for msg_id in self.pending_marks.pop(str(channel), []):
+                self.record(channel, msg_id, 'marked')
+
+    def sync(self):
+        """Escribe en disco las lineas pendientes y compacta si hace falta
+        """
+        with self.lock:
+            if self.unsynced:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+            self.last_sync = time.time()
+            if self.lines > max(self.compact_lines, 2 * len(self.entries)):
+                self.compact()
+
+    def close(self):
+        """Compacta el registro y lo cierra
+        """
+        with self.lock:
+            self.sync()
+            if self.lines > len(self.entries):
+                self.compact()
+            self.file.close()
+            self.file = None
+
+
+def build_journal(settings):
+    """Crea el registro de ejecucion si esta configurado 'journal_file'
+    """
+    if not settings.get('journal_file', None):
+        return None
+    return RunJournal(settings['journal_file'])
+
+
+class RetryScheduler(object):
+    """Reintentos de los envios con errores, persistentes (sqlite)
+        Un mensaje que no se pudo enviar se pospone con espera exponencial: despues
+        del intento n no se vuelve a intentar hasta pasados base_delay * 2^(n-1)
+        segundos (como maximo max_delay). Despues de breaker_failures errores
+        seguidos a un mismo destino (ver MessageChannel.get_destination_key) se
+        cortan los envios a ese destino durante breaker_delay segundos, los mensajes
+        se posponen sin conectarse. Pasado ese tiempo se prueba con un mensaje: si
+        se envia se vuelve a enviar normalmente, si falla se corta de nuevo
+    """
+
+    def __init__(self, filename, base_delay=60, max_delay=21600, breaker_failures=5,
+                 breaker_delay=900):
+        """
+            :filename: archivo de la base sqlite
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_delay = breaker_delay
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS retries ('
+                        'channel TEXT, msg_id TEXT, attempts INTEGER, next_time REAL, '
+                        'error TEXT, PRIMARY KEY (channel, msg_id))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS breakers ('
+                        'destination TEXT PRIMARY KEY, failures INTEGER, open_until REAL)')
+        self.db.commit()
+        # se mantienen en memoria para no consultar la base por cada mensaje
+        self.retries = dict(((x[0], x[1]), (x[2], x[3])) for x in
+                            self.db.execute('SELECT channel, msg_id, attempts, next_time '
+                                            'FROM retries'))
+        self.breakers = dict((x[0], (x[1], x[2])) for x in
+                             self.db.execute('SELECT destination, failures, open_until '
+                                             'FROM breakers'))
+
+    @staticmethod
+    def key(channel, msg_id):
+        return (str(channel), str(msg_id))
+
+    def is_deferred(self, channel, msg_id):
+        """Determina si todavia no se debe reintentar el envio del mensaje
+        """
+        with self.lock:
+            return self.retries.get(self.key(channel, msg_id), (0, 0))[1] > time.time()
+
+    def is_open(self, destination):
+        """Determina si estan cortados los envios al destino
+        """
+        with self.lock:
+            return self.breakers.get(destination, (0, 0))[1] > time.time()
+
+    def failure(self, channel, msg_id, destination, error=None):
+        """Registra un error de envio del mensaje al destino
+        """
+        key = self.key(channel, msg_id)
+        now = time.time()
+        with self.lock:
+            attempts = self.retries.get(key, (0, 0))[0] + 1
+            next_time = now + min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+            self.retries[key] = (attempts, next_time)
+            self.db.execute('INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?)',
+                            key + (attempts, next_time, str(error)))
+            failures = self.breakers.get(destination, (0, 0))[0] + 1
+            open_until = now + self.breaker_delay if failures >= self.breaker_failures else 0
+            if open_until:
+                logging.warning('%d errores seguidos enviando a %s, envios cortados por %ds'
+                                % (failures, destination, self.breaker_delay))
+            self.breakers[destination] = (failures, open_until)
+            self.db.execute('INSERT OR REPLACE INTO breakers VALUES (?, ?, ?)',
+                            (destination, failures, open_until))
+            self.db.commit()
+        logging.info('Mensaje id: %s, intento %d fallido, proximo intento en %ds'
+                        % (msg_id, attempts, next_time - now))
+
+    def success(self, channel, msg_id, destination):
+        """Registra el envio del mensaje, el destino vuelve a estar disponible
+        """
+        key = self.key(channel, msg_id)
+        with self.lock:
+            if key not in self.retries and destination not in self.breakers:
+                return
+            if self.retries.pop(key, None) is not None:
+                self.db.execute('DELETE FROM retries WHERE channel = ? AND msg_id = ?', key)
+            if self.breakers.pop(destination, None) is not None:
+                self.db.execute('DELETE FROM breakers WHERE destination = ?', (destination,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def build_retry_scheduler(settings):
+    """Crea el planificador de reintentos si esta configurado 'retry_file'
+        Los tiempos se configuran en 'retry_settings'
+    """
+    if not settings.get('retry_file', None):
+        return None
+    return RetryScheduler(settings['retry_file'], **settings.get('retry_settings', {}))
+
+
+class PipeStats(object):
+    """Estadisticas de una ejecucion de pipeChannels
+        Cuenta los mensajes por estado, tipo y socio (origen, destino), la latencia
+        de cada etapa en un histograma, los bytes leidos y enviados y las conexiones
+        abiertas por los canales
+    """
+    stages = ('read', 'send', 'mark')
+    # limites superiores en segundos de los buckets de los histogramas de latencia
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.end_time = None
+        self.counters = {'read': 0, 'sent': 0, 'failed': 0, 'duplicated': 0, 'recovered': 0,
+                         'deferred': 0, 'bytes_read': 0, 'bytes_sent': 0}
+        # (tipo, origen, destino) -> contadores por estado
+        self.messages = {}
+        self.connections = {}
+        self.latency = dict((x, {'count': 0, 'total': 0.0, 'max': 0.0,
+                                 'buckets': [0] * (len(self.latency_buckets) + 1)})
+                            for x in self.stages)
+
+    def count(self, name, message=None):
+        """Incrementa el contador name, en total y para el tipo y socio del mensaje
+            Los mensajes leidos y enviados suman su tamaño a bytes_read y bytes_sent
+            :message: mensaje sinliarg, None si no se pudo leer
+        """
+        key = tuple(self.label(getattr(message, x, None))
+                    for x in ('sinli_type', 'src_code', 'dst_code'))
+        # un mensaje leido del disco no se carga en memoria para saber su tamaño
+        size = getattr(message, 'size', None)
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            partner = self.messages.setdefault(key, {})
+            partner[name] = partner.get(name, 0) + 1
+            if name in ('read', 'sent') and isinstance(size, numbers.Integral):
+                self.counters['bytes_' + name] += size
+
+    @staticmethod
+    def label(value):
+        return value if isinstance(value, text_types) else ''
+
+    def record(self, stage, seconds):
+        """Registra el tiempo que llevo una etapa del procesamiento de un mensaje
+        """
+        with self.lock:
+            latency = self.latency[stage]
+            latency['count'] += 1
+            latency['total'] += seconds
+            latency['max'] = max(latency['max'], seconds)
+            latency['buckets'][bisect.bisect_left(self.latency_buckets, seconds)] += 1
+
+    def timed(self, stage, func, *args, **kwargs):
+        """Ejecuta func registrando el tiempo en la etapa stage
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(stage, time.time() - start)
+
+    def add_connections(self, before, after):
+        """Suma las conexiones abiertas entre dos mediciones de connection_counts
+        """
+        with self.lock:
+            for protocol, count in after.items():
+                self.connections[protocol] = self.connections.get(protocol, 0) \
+                                                + count - before.get(protocol, 0)
+
+    def merge(self, other):
+        """Suma las estadisticas de otra ejecucion
+        """
+        with self.lock:
+            for name, count in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + count
+            for key, counters in other.messages.items():
+                partner = self.messages.setdefault(key, {})
+                for name, count in counters.items():
+                    partner[name] = partner.get(name, 0) + count
+            for protocol, count in other.connections.items():
+                self.connections[protocol] = self.connections.get(protocol, 0) + count
+            for stage, other_latency in other.latency.items():
+                latency = self.latency[stage]
+                latency['count'] += other_latency['count']
+                latency['total'] += other_latency['total']
+                latency['max'] = max(latency['max'], other_latency['max'])
+                latency['buckets'] = [x + y for x, y in zip(latency['buckets'],
+                                                            other_latency['buckets'])]
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def throughput(self):
+        """Mensajes enviados por segundo
+        """
+        elapsed = self.elapsed()
+        return self.counters['sent'] / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        """Resumen en texto de la ejecucion
+        """
+        lines = ['leidos: %(read)d, enviados: %(sent)d, fallidos: %(failed)d, '
+                 'duplicados: %(duplicated)d, pospuestos: %(deferred)d' % self.counters,
+                 'tiempo: %.2fs, %.2f mensajes/s' % (self.elapsed(), self.throughput())]
+        for stage in self.stages:
+            latency = self.latency[stage]
+            if latency['count']:
+                lines.append('%s: promedio %.3fs, maximo %.3fs'
+                             % (stage, latency['total'] / latency['count'], latency['max']))
+        return '; '.join(lines)
+
+    def as_dict(self):
+        """Estadisticas en un dict que se puede serializar como json
+        """
+        bounds = [repr(x) for x in self.latency_buckets] + ['+Inf']
+        with self.lock:
+            latency = dict((stage, {'count': values['count'],
+                                    'total': round(values['total'], 6),
+                                    'max': round(values['max'], 6),
+                                    'buckets': dict(zip(bounds, values['buckets']))})
+                           for stage, values in self.latency.items())
+            return {'start': self.start_time,
+                    'elapsed': round(self.elapsed(), 6),
+                    'throughput': round(self.throughput(), 3),
+                    'counters': dict(self.counters),
+                    'connections': dict(self.connections),
+                    'latency': latency,
+                    'messages': [dict(counters, type=key[0], src=key[1], dst=key[2])
+                                 for key, counters in sorted(self.messages.items())]}
+
+
+class Metrics(object):
+    """Metricas acumuladas de las ejecuciones de pipeChannels del proceso
+        Se exponen en formato de texto de Prometheus, en un archivo o por http
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    families = (('sinliarg_messages_total', 'counter',
+                 'Mensajes procesados por estado, tipo y socio'),
+                ('sinliarg_bytes_total', 'counter',
+                 'Bytes de los mensajes leidos y enviados'),
+                ('sinliarg_connections_total', 'counter',
+                 'Conexiones abiertas por protocolo'),
+                ('sinliarg_stage_duration_seconds', 'histogram',
+                 'Duracion de la lectura, el envio y el marcado de cada mensaje'),
+                ('sinliarg_runs_total', 'counter',
+                 'Ejecuciones de cada envio'),
+                ('sinliarg_last_run_timestamp_seconds', 'gauge',
+                 'Fin de la ultima ejecucion de cada envio'))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directions = {}        # envio -> PipeStats acumulado
+        self.runs = {}              # envio -> (cantidad de ejecuciones, fin de la ultima)
+
+    def add(self, direction, stats):
+        """Suma las estadisticas de una ejecucion
+            :direction: nombre del envio, por ejemplo 'files->emails'
+        """
+        with self.lock:
+            self.directions.setdefault(direction, PipeStats()).merge(stats)
+            runs = self.runs.get(direction, (0, None))[0]
+            self.runs[direction] = (runs + 1, stats.end_time or time.time())
+
+    @staticmethod
+    def format_labels(labels):
+        return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\')
+                                                       .replace('"', '\\"')
+                                                       .replace('\n', '\\n'))
+                                 for name, value in labels)
+
+    def samples(self, direction, stats):
+        """Devuelve (metrica, sufijo, etiquetas, valor) de las estadisticas de un envio
+        """
+        base = [('direction', direction)]
+        for (sinli_type, src_code, dst_code), counters in sorted(stats.messages.items()):
+            for status, count in sorted(counters.items()):
+                yield ('sinliarg_messages_total', '',
+                       base + [('status', status), ('type', sinli_type),
+                               ('src', src_code), ('dst', dst_code)], count)
+        for kind in ('read', 'sent'):
+            yield ('sinliarg_bytes_total', '', base + [('kind', kind)],
+                   stats.counters['bytes_' + kind])
+        for protocol, count in sorted(stats.connections.items()):
+            yield ('sinliarg_connections_total', '', base + [('protocol', protocol)], count)
+        for stage in stats.stages:
+            latency = stats.latency[stage]
+            labels = base + [('stage', stage)]
+            cumulative = 0
+            for bound, count in zip([repr(x) for x in stats.latency_buckets] + ['+Inf'],
+                                    latency['buckets']):
+                cumulative += count
+                yield ('sinliarg_stage_duration_seconds', '_bucket',
+                       labels + [('le', bound)], cumulative)
+            yield ('sinliarg_stage_duration_seconds', '_sum', labels, latency['total'])
+            yield ('sinliarg_stage_duration_seconds', '_count', labels, latency['count'])
+        runs, last_run = self.runs[direction]
+        yield ('sinliarg_runs_total', '', base, runs)
+        yield ('sinliarg_last_run_timestamp_seconds', '', base, last_run)
+
+    def prometheus(self):
+        """Devuelve las metricas en formato de texto de Prometheus
+        """
+        by_family = dict((x[0], []) for x in self.families)
+        with self.lock:
+            for direction, stats in sorted(self.directions.items()):
+                for name, suffix, labels, value in self.samples(direction, stats):
+                    by_family[name].append('%s%s%s %s' % (name, suffix,
+                                                          self.format_labels(labels), value))
+        lines = []
+        for name, metric_type, description in self.families:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            lines.extend(by_family[name])
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, filename):
+        """Escribe las metricas en filename (para el textfile collector de node_exporter)
+        """
+        write_file_atomic(filename, self.prometheus())
+
+    def start_http_server(self, port, host='127.0.0.1'):
+        """Sirve las metricas en http://host:port/metrics desde un thread
+            Devuelve el servidor, se detiene con shutdown()
+        """
+        server = HTTPServer((host, port), MetricsHandler)
+        server.metrics = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info('Metricas disponibles en http://%s:%d/metrics' % server.server_address[:2])
+        return server
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Responde GET /metrics con las metricas del servidor"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', Metrics.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('Metricas http: ' + format % args)
+
+
+def connection_counts(*channels):
+    """Suma las conexiones abiertas por los canales hasta el momento, por protocolo
+    """
+    counts = {}
+    for channel in channels:
+        if isinstance(channel, MessageChannel):
+            for protocol, count in channel.connection_counts().items():
+                counts[protocol] = counts.get(protocol, 0) + count
+    return counts
+
+
+def read_message(src_channel, msg_id, stats, journal=None, retry=None):
+    """Lee un mensaje del canal de origen
+        Devuelve None si no se pudo leer, si todavia no se debe reintentar su envio
+        o si ya se envio en una ejecucion interrumpida, en ese caso solo se marca
+        :journal: RunJournal donde se registra el estado del mensaje
+        :retry: RetryScheduler con los reintentos pendientes
+    """
+    logging.info('Procesando mensaje id: %s' % msg_id)
+    if retry is not None and retry.is_deferred(src_channel, msg_id):
+        logging.info('Mensaje id: %s pospuesto hasta el proximo reintento' % msg_id)
+        stats.count('deferred')
+        return None
+    if journal is not None and journal.state(src_channel, msg_id) == 'sent':
+        logging.info('Mensaje id: %s enviado en una ejecucion interrumpida, se marca' % msg_id)
+        stats.count('recovered')
+        mark_message(src_channel, msg_id, stats, journal=journal)
+        return None
+    try:
+        sinli_message = stats.timed('read', src_channel.get_message, msg_id)
+        # el encabezado se lee sin parsear el resto, antes de enviarlo se verifica
+        # que el documento completo este bien formado
+        if src_channel.check_well_formed:
+            sinli_message.check_well_formed()
+        logging.debug('...leido correctamente')
+    except (cElementTree.ParseError, AttachmentTooLarge):
+        logging.error('Error error de parseo leyendo el mensaje %s.\n%s', msg_id, traceback.format_exc())
+        stats.count('failed')
+        stats.timed('mark', src_channel.mark_message, msg_id, True)
+        return None
+    except Exception:
+        logging.error('Error obteniendo datos del mensaje\n%s' % traceback.format_exc())
+        stats.count('failed')
+        return None
+    stats.count('read', sinli_message)
+    if journal is not None:
+        journal.record(src_channel, msg_id, 'read')
+    return sinli_message
+
+
+def pipe_message(src_channel, dst_channel, msg_id, sinli_message, stats, src_lock=None,
+                 dedup=None, pending=None, journal=None, retry=None):
+    """Envia un mensaje al canal de destino y lo marca como leido en el de origen
+        :src_lock: lock para serializar el uso del canal de origen entre threads
+        :dedup: DuplicateIndex, los mensajes duplicados se marcan sin enviarlos
+        :pending: dict donde se guardan los ids de los mensajes que el canal de destino
+                  agrego a un lote, se marcan cuando se envia el lote
+        :journal: RunJournal donde se registran los mensajes enviados y marcados
+        :retry: RetryScheduler, los mensajes a destinos con errores seguidos se posponen
+                sin intentar enviarlos
+    """
+    # el mensaje queda reservado hasta que se envie su lote, un duplicado en el
+    # mismo lote o en otro thread no se vuelve a enviar
+    if dedup is not None and not dedup.reserve(sinli_message):
+        logging.info('Mensaje id: %s duplicado, no se envia' % msg_id)
+        stats.count('duplicated', sinli_message)
+        mark_message(src_channel, msg_id, stats, src_lock, journal)
+        return
+    if retry is not None and retry.is_open(dst_channel.get_destination_key(sinli_message)):
+        logging.info('Envios a %s suspendidos por errores, mensaje id: %s pospuesto'
+                        % (dst_channel.get_destination_key(sinli_message), msg_id))
+        stats.count('deferred', sinli_message)
+        if dedup is not None:
+            dedup.release(sinli_message)
+        return
+    pending = {} if pending is None else pending
+    # se registra antes de enviar, otro thread puede completar y enviar el lote
+    pending[id(sinli_message)] = msg_id
+    try:
+        logging.info('Enviando mensaje id: %s' % msg_id)
+        results = stats.timed('send', dst_channel.send_message, sinli_message)
+    except Exception as e:
+        pending.pop(id(sinli_message), None)
+        logging.error('Error enviando mensaje\n%s' % traceback.format_exc())
+        stats.count('failed', sinli_message)
+        if dedup is not None:
+            dedup.release(sinli_message)
+        if retry is not None:
+            retry.failure(src_channel, msg_id, dst_channel.get_destination_key(sinli_message), e)
+        return
+    if not isinstance(results, list):
+        results = [(sinli_message, None)]
+    finish_messages(src_channel, results, pending, stats, src_lock, dedup, journal, retry,
+                    dst_channel)
+
+
+def finish_messages(src_channel, results, pending, stats, src_lock=None, dedup=None,
+                    journal=None, retry=None, dst_channel=None):
+    """Marca como leidos los mensajes enviados
+        :results: lista de (mensaje, error) devuelta por el canal de destino
+        :pending: dict id(mensaje) -> id del mensaje en el canal de origen
+        :retry: RetryScheduler donde se registran los errores y los envios exitosos,
+                necesita el canal de destino dst_channel
+    """
+    sent = []
+    for sinli_message, error in results:
+        msg_id = pending.pop(id(sinli_message))
+        if error is not None:
+            logging.error('Error enviando mensaje id: %s: %s' % (msg_id, error))
+            stats.count('failed', sinli_message)
+            if dedup is not None:
+                dedup.release(sinli_message)
+            if retry is not None:
+                retry.failure(src_channel, msg_id,
+                              dst_channel.get_destination_key(sinli_message), error)
+            continue
+        logging.debug('...enviado correctamente')
+        stats.count('sent', sinli_message)
+        if retry is not None:
+            retry.success(src_channel, msg_id, dst_channel.get_destination_key(sinli_message))
+        if dedup is not None:
+            dedup.add(sinli_message)
+        if journal is not None:
+            journal.record(src_channel, msg_id, 'sent')
+        sent.append(msg_id)
+    # los envios quedan en disco antes de marcarlos, con un solo fsync por lote
+    if journal is not None and sent:
+        journal.sync()
+    for msg_id in sent:
+        mark_message(src_channel, msg_id, stats, src_lock, journal)
+
+
+def mark_message(src_channel, msg_id, stats, src_lock=None, journal=None):
+    """Marca el mensaje como procesado en el canal de origen
+    """
+    if src_lock is None:
+        stats.timed('mark', src_channel.mark_message, msg_id)
+    else:
+        with src_lock:
+            stats.timed('mark', src_channel.mark_message, msg_id)
+    if journal is not None:
+        journal.mark(src_channel, msg_id)
+
+
+def pipeChannels(src_channel, dst_channel, workers=1, close_dst=True, dedup=None,
+                 journal=None, retry=None):
+    """Enviar los mensajes de un canal a otro
+        :src_channel: canal de origen de los mensajes
+        :dst_channel: canal de destino de los mensajes
+        :workers: cantidad de threads que envian mensajes en paralelo
+                  Los mensajes entre el mismo origen y destino se envian siempre
+                  en orden y por el mismo thread
+        :close_dst: cerrar el canal de destino al terminar, en modo daemon
+                    se deja abierto para reusar las conexiones
+        :dedup: DuplicateIndex para no reenviar mensajes duplicados
+        :journal: RunJournal para no reenviar los mensajes de una ejecucion interrumpida
+        :retry: RetryScheduler para posponer los reintentos de los envios con errores
+    """
+    logging.info('Envio de mensajes %s->%s iniciado' % (src_channel, dst_channel))
+    stats = PipeStats()
+    connections = connection_counts(src_channel, dst_channel)
+    pending = {}
+    if workers > 1:
+        pipe_concurrent(src_channel, dst_channel, workers, stats, dedup, pending, journal,
+                        retry)
+    else:
+        for msg_id in src_channel.load_messages():
+            sinli_message = read_message(src_channel, msg_id, stats, journal, retry)
+            if sinli_message is not None:
+                pipe_message(src_channel, dst_channel, msg_id, sinli_message, stats,
+                             dedup=dedup, pending=pending, journal=journal, retry=retry)
+    results = stats.timed('send', dst_channel.flush) if pending else []
+    if isinstance(results, list):
+        finish_messages(src_channel, results, pending, stats, dedup=dedup, journal=journal,
+                        retry=retry, dst_channel=dst_channel)
+    if journal is not None:
+        journal.sync()
+    src_channel.close()
+    if journal is not None:
+        # las marcas quedan confirmadas al cerrar el canal de origen
+        journal.commit_marks(src_channel)
+        journal.sync()
+    if close_dst:
+        dst_channel.close()
+    else:
+        # la conexion queda para el thread que envie en el proximo ciclo
+        dst_channel.release_session()
+    stats.add_connections(connections, connection_counts(src_channel, dst_channel))
+    stats.finish()
+    logging.info('Envio de mensajes %s->%s finalizado. %s'
+                    % (src_channel, dst_channel, stats.summary()))
+    return stats
+
+
+def pipe_concurrent(src_channel, dst_channel, workers, stats, dedup=None, pending=None,
+                    journal=None, retry=None):
+    """Envia los mensajes usando un pool de threads
+        Los mensajes se leen en el thread principal y se reparten entre los threads
+        segun el par (origen, destino), cada thread los envia en el orden en que se leyeron
+    """
+    src_lock = threading.Lock()
+    queues = [queue.Queue(maxsize=100) for x in range(workers)]
+
+    def worker(msg_queue):
+        try:
+            while True:
+                item = msg_queue.get()
+                if item is None:
+                    break
+                try:
+                    pipe_message(src_channel, dst_channel, item[0], item[1], stats, src_lock,
+                                 dedup, pending, journal, retry)
+                except Exception:
+                    logging.error('Error procesando mensaje id: %s\n%s'
+                                    % (item[0], traceback.format_exc()))
+        finally:
+            # el thread termina, sus conexiones las reusan los threads del proximo ciclo
+            dst_channel.release_session()
+
+    threads = [threading.Thread(target=worker, args=(x,)) for x in queues]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        msg_ids = iter(src_channel.load_messages())
+        while True:
+            with src_lock:
+                msg_id = next(msg_ids, None)
+                if msg_id is None:
+                    break
+                sinli_message = read_message(src_channel, msg_id, stats, journal, retry)
+            if sinli_message is not None:
+                partner = (sinli_message.src_code, sinli_message.dst_code)
+                queues[hash(partner) % workers].put((msg_id, sinli_message))
+    finally:
+        for msg_queue in queues:
+            msg_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+class FilesystemWatcher(object):
+    """Espera cambios en los directorios de mensajes
+        En linux usa inotify, en otros sistemas o si inotify no esta disponible
+        solo espera el tiempo indicado (polling)
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    event_struct = struct.Struct('iIII')
+
+    def __init__(self, base_path, dir_re, archive_dirs=FilesystemChannel.archive_dirs):
+        """
+            :base_path: directorio base de los mensajes
+            :dir_re: expresion regular de los directorios con mensajes a enviar
+            :archive_dirs: directorios que no se vigilan
+        """
+        self.base_path = os.path.abspath(base_path)
+        self.dir_re = re.compile(dir_re)
+        self.archive_dirs = archive_dirs
+        self.watches = {}
+        self.inotify_fd = None
+        try:
+            self.init_inotify()
+        except (OSError, AttributeError):
+            logging.info('inotify no disponible, se buscan cambios por polling\n%s'
+                            % traceback.format_exc())
+            self.close()
+
+    def init_inotify(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify solo esta disponible en linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = self.libc.inotify_init1(os.O_NONBLOCK | 0o2000000)     # IN_CLOEXEC
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.inotify_fd = fd
+        self.add_watches(self.base_path)
+
+    def add_watches(self, path):
+        """Vigila path y sus subdirectorios, salvo los de archivados
+        """
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [x for x in dirnames if x not in self.archive_dirs]
+            wd = self.libc.inotify_add_watch(self.inotify_fd, dirpath.encode('utf-8'), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch %s' % dirpath)
+            self.watches[wd] = dirpath
+
+    @property
+    def polling(self):
+        return self.inotify_fd is None
+
+    def read_events(self):
+        """Lee los eventos pendientes, devuelve True si hubo cambios en
+            algun directorio de mensajes a enviar
+        """
+        changed = False
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event_struct.unpack_from(data, offset)
+                offset += self.event_struct.size
+                name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += length
+                if wd not in self.watches or name in self.archive_dirs:
+                    continue
+                path = os.path.join(self.watches[wd], name)
+                if mask & self.IN_ISDIR:
+                    self.add_watches(path)
+                elif mask & self.IN_CREATE:
+                    continue        # se espera a que se termine de escribir
+                else:
+                    path = self.watches[wd]
+                if self.dir_re.search(path):
+                    changed = True
+
+    def wait(self, timeout, stop_event=None):
+        """Espera hasta timeout segundos a que haya cambios
+            Devuelve True si hubo cambios (nunca en modo polling)
+            :stop_event: threading.Event que interrumpe la espera
+        """
+        end_time = time.time() + timeout
+        while True:
+            remaining = end_time - time.time()
+            if remaining <= 0 or (stop_event is not None and stop_event.is_set()):
+                return False
+            if self.polling:
+                if stop_event is not None:
+                    stop_event.wait(min(remaining, 1))
+                else:
+                    time.sleep(min(remaining, 1))
+                continue
+            readable = select.select([self.inotify_fd], [], [], min(remaining, 1))[0]
+            if readable and self.read_events():
+                # esperar a que se terminen de copiar los archivos de una misma tanda
+                time.sleep(0.5)
+                self.read_events()
+                return True
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+        self.inotify_fd = None
+        self.watches = {}
+
+
+def run_daemon(settings, workers=1):
+    """Ejecuta continuamente el envio de archivos por email y de emails a archivos
+        Los archivos nuevos se envian apenas se detectan (inotify) o cada
+        'poll_interval' segundos, los emails se leen cada 'inbound_interval' segundos.
+        La conexion smtp se mantiene abierta entre ciclos
+        Las metricas acumuladas se escriben en 'metrics_file' despues de cada envio
+        y se sirven en http://127.0.0.1:'metrics_port'/metrics
+        Si los emails se leen por imap y el servidor soporta IDLE, los emails
+        nuevos se leen apenas llegan
+    """
+    daemon_settings = settings.get('daemon', {})
+    inbound_interval = daemon_settings.get('inbound_interval', 60)
+    outbound_interval = daemon_settings.get('outbound_interval', 300)
+    files_input = build_channel('files', settings)
+    emails_output = build_channel('emails', settings)
+    emails_input = build_channel('emails', settings)
+    files_output = build_channel('files', settings)
+    dedup = build_dedup_index(settings)
+    journal = build_journal(settings)
+    retry = build_retry_scheduler(settings)
+    watcher = FilesystemWatcher(settings['base_path'], settings['dir_re'])
+    if watcher.polling:
+        outbound_interval = daemon_settings.get('poll_interval', 10)
+    metrics = Metrics()
+    metrics_server = None
+    if daemon_settings.get('metrics_port', None):
+        metrics_server = metrics.start_http_server(daemon_settings['metrics_port'],
+                                                   daemon_settings.get('metrics_host',
+                                                                       '127.0.0.1'))
+
+    def run(direction, src_channel, dst_channel, **kwargs):
+        metrics.add(direction, pipeChannels(src_channel, dst_channel, workers,
+                                            dedup=dedup, journal=journal, retry=retry,
+                                            **kwargs))
+        if daemon_settings.get('metrics_file', None):
+            metrics.write_file(daemon_settings['metrics_file'])
+
+    stop_event = threading.Event()
+    # interrumpe la espera del ciclo principal por una señal o por emails nuevos
+    wake_event = threading.Event()
+    inbound_event = threading.Event()
+
+    def stop(signum, frame):
+        logging.info('Señal %s recibida, terminando' % signum)
+        stop_event.set()
+        wake_event.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    idle_thread = None
+    if isinstance(emails_input, ImapChannel) and emails_input.imap_settings.get('idle', True):
+        idle_thread = threading.Thread(target=wait_imap_emails,
+                                       args=(build_channel('emails', settings),
+                                             daemon_settings.get('idle_timeout', 600),
+                                             stop_event, inbound_event, wake_event))
+        idle_thread.daemon = True
+        idle_thread.start()
+
+    logging.info('Daemon iniciado')
+    next_outbound = next_inbound = 0
+    while not stop_event.is_set():
+        if time.time() >= next_outbound:
+            try:
+                run('files->emails', files_input, emails_output, close_dst=False)
+            except Exception:
+                logging.error('Error enviando archivos\n%s' % traceback.format_exc())
+                close_quietly(files_input)
+            next_outbound = time.time() + outbound_interval
+        if time.time() >= next_inbound:
+            try:
+                run('emails->files', emails_input, files_output)
+            except Exception:
+                logging.error('Error recibiendo emails\n%s' % traceback.format_exc())
+                close_quietly(emails_input)
+            next_inbound = time.time() + inbound_interval
+        timeout = min(next_outbound, next_inbound) - time.time()
+        if watcher.wait(timeout, wake_event):
+            next_outbound = 0
+        if inbound_event.is_set():
+            inbound_event.clear()
+            wake_event.clear()
+            next_inbound = 0
+
+    emails_output.close()
+    watcher.close()
+    if idle_thread is not None:
+        idle_thread.join()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    if dedup is not None:
+        dedup.close()
+    if journal is not None:
+        journal.close()
+    if retry is not None:
+        retry.close()
+    logging.info('Daemon finalizado')
+
+
+def wait_imap_emails(imap_channel, timeout, stop_event, inbound_event, wake_event):
+    """Espera con IDLE los emails nuevos en el servidor imap hasta que se active stop_event
+        Cuando llegan emails activa inbound_event y wake_event
+        :imap_channel: canal con una conexion usada solo para la espera
+        :timeout: segundos de cada IDLE, los servidores cierran las conexiones
+                  inactivas despues de 30 minutos
+    """
+    while not stop_event.is_set():
+        try:
+            if imap_channel.idle(timeout, stop_event):
+                logging.info('Emails nuevos en el servidor imap')
+                inbound_event.set()
+                wake_event.set()
+        except Exception:
+            logging.error('Error esperando emails por imap\n%s' % traceback.format_exc())
+            imap_channel.imap_server = None
+            stop_event.wait(30)
+    close_quietly(imap_channel)
+
+
+def close_quietly(channel):
+    """Cierra el canal despues de un error, sin propagar nuevos errores
+    """
+    try:
+        channel.close()
+    except Exception:
+        logging.error('Error cerrando el canal %s\n%s' % (channel, traceback.format_exc()))
+
+
+def tenant_settings(settings):
+    """Devuelve la configuracion de cada identidad sinli de 'tenants'
+        Cada identidad hereda la configuracion general y reemplaza lo que define
+    """
+    base = dict((key, value) for key, value in settings.items() if key != 'tenants')
+    return [dict(base, **tenant) for tenant in settings.get('tenants', [])]
+
+
+class Tenant(object):
+    """Identidad sinli con sus canales, indices y registros"""
+
+    def __init__(self, settings):
+        """
+            :settings: configuracion de la identidad (ver tenant_settings)
+        """
+        self.settings = settings
+        self.name = settings.get('name', None) or settings['sinli_code']
+        self.channels = {}          # (entrada, salida) -> canales
+        self.dedup = build_dedup_index(settings)
+        self.journal = build_journal(settings)
+        self.retry = build_retry_scheduler(settings)
+
+    def run(self, direction, close_dst=True):
+        """Envia los mensajes de la identidad en una direccion
+            :direction: (canal de entrada, canal de salida), por ejemplo ('files', 'emails')
+            :close_dst: cerrar el canal de salida de emails al terminar, si no la
+                        conexion smtp se reusa en la proxima ejecucion
+        """
+        if direction not in self.channels:
+            self.channels[direction] = (build_channel(direction[0], self.settings),
+                                        build_channel(direction[1], self.settings))
+        src_channel, dst_channel = self.channels[direction]
+        close_dst = close_dst or direction[1] != 'emails'
+        try:
+            return pipeChannels(src_channel, dst_channel, close_dst=close_dst, dedup=self.dedup,
+                                journal=self.journal, retry=self.retry)
+        except Exception:
+            close_quietly(src_channel)
+            dst_channel.release_session()
+            raise
+
+    def close(self):
+        for src_channel, dst_channel in self.channels.values():
+            close_quietly(dst_channel)
+        for index in (self.dedup, self.journal, self.retry):
+            if index is not None:
+                index.close()
+
+
+class TenantRunner(object):
+    """Envia en un proceso los mensajes de varias identidades sinli ('tenants')
+        Cada identidad tiene sus canales, su libreta de direcciones y sus archivos de
+        estado. Los envios de todas las identidades comparten 'workers' threads: cada
+        envio (identidad, direccion) ocupa uno mientras dura
+    """
+    directions = (('files', 'emails'), ('emails', 'files'))
+
+    def __init__(self, settings, workers=1, directions=None):
+        """
+            :settings: configuracion general con la lista 'tenants'
+            :directions: envios a ejecutar por identidad, por defecto en ambas direcciones
+        """
+        self.workers = workers
+        self.directions = directions or self.directions
+        self.tenants = [Tenant(x) for x in tenant_settings(settings)]
+        names = [x.name for x in self.tenants]
+        if len(set(names)) != len(names):
+            raise ValueError('Identidades repetidas en tenants: %s' % ', '.join(names))
+
+    def run_once(self, close_dst=True):
+        """Ejecuta una vez los envios de todas las identidades
+            Devuelve {identidad: {'entrada->salida': PipeStats}}, sin los envios con error
+        """
+        tasks = queue.Queue()
+        for tenant in self.tenants:
+            for direction in self.directions:
+                tasks.put((tenant, direction))
+        results = dict((x.name, {}) for x in self.tenants)
+
+        def worker():
+            while True:
+                try:
+                    tenant, direction = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[tenant.name]['%s->%s' % direction] = tenant.run(direction, close_dst)
+                except Exception:
+                    logging.error('Error en el envio %s->%s de %s\n%s'
+                                    % (direction + (tenant.name, traceback.format_exc())))
+
+        threads = [threading.Thread(target=worker) for x in range(min(self.workers, tasks.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @staticmethod
+    def summary(results):
+        """Resumen json por identidad y direccion, con los contadores totales de cada
+            identidad en 'total'
+        """
+        summary = {}
+        for name, directions in results.items():
+            total = PipeStats()
+            for stats in directions.values():
+                total.merge(stats)
+            summary[name] = dict(((direction, stats.as_dict())
+                                  for direction, stats in directions.items()),
+                                 total=total.counters)
+        return summary
+
+    def close(self):
+        for tenant in self.tenants:
+            tenant.close()
+
+
+def run_tenants_daemon(settings, workers=1, directions=None):
+    """Ejecuta continuamente los envios de todas las identidades de 'tenants'
+        cada 'poll_interval' segundos. Las metricas se escriben en 'metrics_file'
+        con la identidad en el nombre del envio, por ejemplo 'L0002349 files->emails'
+    """
+    daemon_settings = settings.get('daemon', {})
+    runner = TenantRunner(settings, workers, directions)
+    metrics = Metrics()
+    stop_event = threading.Event()
+
+    def stop(signum, frame):
+        logging.info('Señal %s recibida, terminando' % signum)
+        stop_event.set()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    logging.info('Daemon iniciado para %d identidades' % len(runner.tenants))
+    while not stop_event.is_set():
+        for name, directions in sorted(runner.run_once(close_dst=False).items()):
+            for direction, stats in sorted(directions.items()):
+                metrics.add('%s %s' % (name, direction), stats)
+        if daemon_settings.get('metrics_file', None):
+            metrics.write_file(daemon_settings['metrics_file'])
+        stop_event.wait(daemon_settings.get('poll_interval', 10))
+    runner.close()
+    logging.info('Daemon finalizado')
+
+
+def build_channel(name, settings):
+    """Crea el canal name ('files' o 'emails') segun la configuracion
+        Los emails se leen por pop o por imap segun 'email_protocol'. Con
+        'check_well_formed' en false no se verifica el XML completo de los
+        mensajes leidos antes de enviarlos
+    """
+    if name == 'files':
+        channel = FilesystemChannel(settings['base_path'], settings['dir_re'],
+                                    state_file=settings.get('fs_state_file', None),
+                                    stream_size=settings.get('fs_stream_size', None),
+                                    use_mmap=settings.get('fs_use_mmap', False))
+    elif settings.get('email_protocol', 'pop') == 'imap':
+        channel = ImapChannel(smtp_settings=settings['smtp_settings'],
+                              imap_settings=settings['imap_settings'],
+                              msg_from=settings['sinli_email'],
+                              eaddress_file=settings['eaddress_file'],
+                              compression=settings.get('compression', None),
+                              batch=settings.get('email_batch', None),
+                              error_path=os.path.join(settings['base_path'],
+                                                      'not_well_formed_emails'),
+                              max_attachment_size=settings.get('max_attachment_size', None))
+    else:
+        channel = EmailChannel(smtp_settings=settings['smtp_settings'],
+                               pop_settings=settings['pop_settings'],
+                               msg_from=settings['sinli_email'],
+                               eaddress_file=settings['eaddress_file'],
+                               compression=settings.get('compression', None),
+                               batch=settings.get('email_batch', None),
+                               error_path=os.path.join(settings['base_path'],
+                                                       'not_well_formed_emails'),
+                               max_attachment_size=settings.get('max_attachment_size', None))
+    channel.check_well_formed = settings.get('check_well_formed', True)
+    return channel
+
+
+def load_settings(filename):
+    """Lee el archivo de configuracion y lo deja en la variable global settings
+    """
+    global settings
+
+    try:
+        with open(filename) as i:
+            settings = json.load(i)
+    except Exception:
+        print('Error abriendo archivo de configuracion: %s\n\n' % filename)
+        raise
+    return settings
+
+
+def configure_logging(settings):
+    """Configura el log segun 'log_file' y 'log_level'
+    """
+    log_format = '%(asctime)s|%(levelname)s|%(message)s'
+    log_level = getattr(logging, settings.get('log_level', 'DEBUG'), logging.DEBUG)
+    if 'log_file' in settings:
+        logging.basicConfig(filename=settings['log_file'], level=log_level,
+                            format=log_format)
+    else:
+        logging.basicConfig(level=log_level, format=log_format)
+
+
+def write_summary(summary, summary_file):
+    """Escribe el resumen json de la ejecucion en summary_file, '-' para stdout
+        Sin archivo se escribe en el log
+    """
+    if summary_file == '-':
+        print(json.dumps(summary, indent=2, sort_keys=True))
+    elif summary_file:
+        write_file_atomic(summary_file, json.dumps(summary, sort_keys=True))
+    else:
+        logging.info('Resumen: %s' % json.dumps(summary, sort_keys=True))
+
+
+def __main__(argv=None):
+    """Lee archivos desde un directorio
+        Por cada archivo envia un email de sinli
+        Despues de enviar el email mueve el archivo a otro directorio
+    """
+    global settings
+
+    arg_parser = argparse.ArgumentParser(description='Enviar mensajes sinliarg entre distintos canales')
+    arg_parser.add_argument('-i', '--input',
+                            choices=('files', 'emails'),
+                            help='Canal de entrada (files|email)')
+    arg_parser.add_argument('-o', '--output',
+                            choices=('files', 'emails'),
+                            help='Canal de salida (files|email)')
+    arg_parser.add_argument('-s', '--settings', default='settings.json',
+                            help='Archivo de configuración')
+    arg_parser.add_argument('-w', '--workers', type=int, default=None,
+                            help='Cantidad de threads de envio (por defecto "workers" de la configuración o 1)')
+    arg_parser.add_argument('-d', '--daemon', action='store_true',
+                            help='Enviar y recibir mensajes continuamente en ambas direcciones')
+    arg_parser.add_argument('--summary', default=None,
+                            help='Archivo donde se escribe el resumen json de la ejecucion, '
+                                 '- para stdout (por defecto "summary_file" de la configuración)')
+    args = arg_parser.parse_args(argv)
+    settings = load_settings(args.settings)
+    # con varias identidades sin -i, -o se envia en ambas direcciones
+    if not args.daemon and not (args.input and args.output) and not settings.get('tenants'):
+        arg_parser.error('Se deben indicar los canales de entrada y salida (-i, -o) o --daemon')
+
+    configure_logging(settings)
+    workers = args.workers or settings.get('workers', 1)
+    summary_file = args.summary or settings.get('summary_file', None)
+
+    if settings.get('tenants'):
+        directions = [(args.input, args.output)] if args.input and args.output else None
+        if args.daemon:
+            run_tenants_daemon(settings, workers, directions)
+            return 0
+        runner = TenantRunner(settings, workers, directions)
+        summary = {'tenants': runner.summary(runner.run_once())}
+        runner.close()
+        write_summary(summary, summary_file)
+        return 0
+
+    if args.daemon:
+        run_daemon(settings, workers)
+        return 0
 
     # intercambiar mensajes
-    channels_map = {'files': lambda:
-                        FilesystemChannel(settings['base_path'], settings['dir_re']),
-                    'emails': lambda:
-                        EmailChannel(smtp_settings=settings['smtp_settings'],
-                                    pop_settings=settings['pop_settings'],
-                                    msg_from=settings['sinli_email'],
-                                    eaddress_file=settings['eaddress_file'])}
-
-    input_channel = channels_map[args.input]()
-    output_channel = channels_map[args.output]()
-    pipeChannels(input_channel, output_channel)
+    input_channel = build_channel(args.input, settings)
+    output_channel = build_channel(args.output, settings)
+    dedup = build_dedup_index(settings)
+    journal = build_journal(settings)
+    retry = build_retry_scheduler(settings)
+    stats = pipeChannels(input_channel, output_channel, workers=workers, dedup=dedup,
+                         journal=journal, retry=retry)
+    for index in (dedup, journal, retry):
+        if index is not None:
+            index.close()
 
+    summary = dict(stats.as_dict(), direction='%s->%s' % (args.input, args.output))
+    write_summary(summary, summary_file)
     return 0
 
 
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+"""Indice sqlite de los mensajes archivados y recibidos
+
+    indice.py -s settings.json actualizar
+    indice.py -s settings.json buscar --tipo REMITO --ean 9789505634606
+    indice.py -s settings.json buscar --tipo FACTURA --origen E0000001 --desde 2024-05-01 --hasta 2024-06-01
+
+actualizar recorre 'base_path' y agrega al indice los archivos nuevos o
+modificados desde la ultima ejecucion, los archivos que ya no existen se
+quitan. No se indexan los mensajes pendientes de envio (directorios que
+coinciden con 'dir_re') ni los que fallaron. El indice se guarda en
+'message_index_file' o en el archivo indicado con --db.
+
+De cada mensaje se guardan los campos del encabezado, la fecha del documento
+(CONTENIDO/FECHA o si no tiene ARCHIVO/FECHA) y el numero de documento, y de
+cada item el EAN, ISBN, codigo de articulo y cantidad.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import xml.etree.ElementTree as ElementTree
+
+try:
+    from utils import ftp2email
+except ImportError:  # ejecutado como script desde utils
+    import ftp2email
+
+
+class MessageIndex(object):
+    """Indice de mensajes y sus items en una base sqlite"""
+    # campos del mensaje: path dentro del XML -> columna
+    message_fields = dict(ftp2email.SinliargMessage.header_fields,
+                          **{'ARCHIVO/FECHA': 'file_date',
+                             'CONTENIDO/FECHA': 'document_date',
+                             'CONTENIDO/NUMERO_DOCUMENTO': 'document_number'})
+    # campos de los items: path dentro del item -> columna
+    item_fields = {'EAN': 'ean', 'ID_LIBRO/EAN': 'ean',
+                   'ISBN_13': 'isbn_13', 'ID_LIBRO/ISBN_13': 'isbn_13',
+                   'ISBN_10': 'isbn_10', 'ID_LIBRO/ISBN_10': 'isbn_10',
+                   'COD_ARTICULO': 'cod_articulo', 'ID_LIBRO/COD_ARTICULO': 'cod_articulo',
+                   'CANTIDAD': 'quantity'}
+    item_columns = ('ean', 'isbn_13', 'isbn_10', 'cod_articulo', 'quantity')
+    batch_size = 500        # archivos por transaccion
+
+    def __init__(self, filename):
+        """
+            :filename: archivo de la base sqlite
+        """
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages ('
+                        'id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER, '
+                        'sinli_type TEXT, src_code TEXT, dst_code TEXT, date TEXT, '
+                        'identifier TEXT, document_number TEXT, description TEXT, '
+                        'error TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items ('
+                        'message_id INTEGER REFERENCES messages (id) ON DELETE CASCADE, '
+                        'ean TEXT, isbn_13 TEXT, isbn_10 TEXT, cod_articulo TEXT, '
+                        'quantity INTEGER)')
+        for name, columns in (('messages_type', 'messages (sinli_type, date)'),
+                              ('messages_src', 'messages (src_code, date)'),
+                              ('messages_dst', 'messages (dst_code, date)'),
+                              ('messages_date', 'messages (date)'),
+                              ('messages_identifier', 'messages (identifier)'),
+                              ('messages_document', 'messages (document_number)'),
+                              ('items_message', 'items (message_id)'),
+                              ('items_ean', 'items (ean)'),
+                              ('items_isbn_13', 'items (isbn_13)'),
+                              ('items_isbn_10', 'items (isbn_10)'),
+                              ('items_cod_articulo', 'items (cod_articulo)')):
+            self.db.execute('CREATE INDEX IF NOT EXISTS %s ON %s' % (name, columns))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def read_file(self, path):
+        """Lee de un archivo los campos del mensaje y de sus items en una sola pasada
+            Devuelve (dict de campos, lista de tuplas de items)
+        """
+        fields = dict((x, None) for x in self.message_fields.values())
+        items = []
+        item_path = None
+        elem_path = []
+        parents = []
+        for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                if not elem_path:
+                    item_path = ftp2email.SinliargMessage.item_paths.get(
+                                    elem.tag, ftp2email.SinliargMessage.default_item_path)
+                elem_path.append(elem.tag)
+                parents.append(elem)
+                continue
+            field = '/'.join(elem_path[1:])
+            elem_path.pop()
+            parents.pop()
+            if field in self.message_fields:
+                fields[self.message_fields[field]] = (elem.text or '').strip()
+            elif field == item_path:
+                item = dict((column, None) for column in self.item_columns)
+                for item_field, column in self.item_fields.items():
+                    value = elem.findtext(item_field)
+                    if value is not None and item[column] is None:
+                        item[column] = value.strip()
+                if item['quantity'] is not None:
+                    try:
+                        item['quantity'] = int(item['quantity'])
+                    except ValueError:
+                        item['quantity'] = None
+                items.append(tuple(item[x] for x in self.item_columns))
+                parents[-1].remove(elem)
+        fields['date'] = fields.pop('document_date') or fields.pop('file_date')
+        fields.pop('file_date', None)
+        return fields, items
+
+    def add_file(self, path, mtime, size):
+        """Indexa un archivo, si no es un mensaje valido se registra el error
+        """
+        self.db.execute('DELETE FROM messages WHERE path = ?', (path,))
+        try:
+            fields, items = self.read_file(path)
+            error = None
+        except (ElementTree.ParseError, IOError, OSError) as e:
+            fields, items = {}, []
+            error = str(e)
+            logging.error('Error indexando %s: %s' % (path, error))
+        message_id = self.db.execute(
+                        'INSERT INTO messages (path, mtime, size, sinli_type, src_code, '
+                        'dst_code, date, identifier, document_number, description, error) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, mtime, size, fields.get('sinli_type'), fields.get('src_code'),
+                         fields.get('dst_code'), fields.get('date'), fields.get('identifier'),
+                         fields.get('document_number'), fields.get('description'),
+                         error)).lastrowid
+        self.db.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                            ((message_id,) + x for x in items))
+        return error is None
+
+    def find_files(self, base_path, dir_re=None):
+        """Devuelve (path, mtime, tamaño) de los archivos de mensajes a indexar
+            Se saltean los directorios de mensajes fallidos y, si se indica dir_re,
+            los mensajes pendientes de envio
+        """
+        failed = ftp2email.FilesystemChannel.archive_dirs[1]
+        dir_re = re.compile(dir_re) if dir_re else None
+        for dirpath, dirnames, filenames in os.walk(os.path.abspath(base_path)):
+            dirnames[:] = sorted(x for x in dirnames if x != failed)
+            if dir_re is not None and dir_re.search(dirpath):
+                continue
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def update(self, base_path, dir_re=None):
+        """Indexa los archivos nuevos o modificados y quita los que ya no existen
+            Devuelve la cantidad de archivos indexados, sin cambios, con errores y quitados
+        """
+        known = dict((path, (mtime, size)) for path, mtime, size
+                     in self.db.execute('SELECT path, mtime, size FROM messages'))
+        counters = {'indexed': 0, 'unchanged': 0, 'errors': 0, 'removed': 0}
+        pending = 0
+        for path, mtime, size in self.find_files(base_path, dir_re):
+            if known.pop(path, None) == (mtime, size):
+                counters['unchanged'] += 1
+                continue
+            counters['indexed' if self.add_file(path, mtime, size) else 'errors'] += 1
+            pending += 1
+            if pending >= self.batch_size:
+                self.db.commit()
+                pending = 0
+        base_path = os.path.join(os.path.abspath(base_path), '')
+        removed = [(x,) for x in known if x.startswith(base_path)]
+        self.db.executemany('DELETE FROM messages WHERE path = ?', removed)
+        counters['removed'] = len(removed)
+        self.db.commit()
+        return counters
+
+    def search(self, sinli_type=None, src_code=None, dst_code=None, date_from=None,
+               date_to=None, identifier=None, document_number=None, ean=None, isbn=None,
+               cod_articulo=None, limit=None):
+        """Busca mensajes, devuelve un dict por mensaje ordenados por fecha
+            :date_from, date_to: fechas ISO (2024-05-01), date_to no incluida
+            :ean, isbn, cod_articulo: mensajes con algun item con ese codigo
+                                      (isbn busca en ISBN_13 e ISBN_10)
+        """
+        conditions = []
+        params = []
+        for column, value in (('sinli_type', sinli_type), ('src_code', src_code),
+                              ('dst_code', dst_code), ('identifier', identifier),
+                              ('document_number', document_number)):
+            if value is not None:
+                conditions.append('m.%s = ?' % column)
+                params.append(value)
+        if date_from is not None:
+            conditions.append('m.date >= ?')
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append('m.date < ?')
+            params.append(date_to)
+        item_conditions = []
+        if ean is not None:
+            item_conditions.append('i.ean = ?')
+            params.append(ean)
+        if isbn is not None:
+            item_conditions.append('(i.isbn_13 = ? OR i.isbn_10 = ?)')
+            params.extend([isbn, isbn])
+        if cod_articulo is not None:
+            item_conditions.append('i.cod_articulo = ?')
+            params.append(cod_articulo)
+        if item_conditions:
+            conditions.append('m.id IN (SELECT i.message_id FROM items i WHERE %s)'
+                              % ' AND '.join(item_conditions))
+        conditions.append('m.error IS NULL')
+        query = ('SELECT m.path, m.sinli_type, m.src_code, m.dst_code, m.date, m.identifier, '
+                 'm.document_number, m.description FROM messages m WHERE %s '
+                 'ORDER BY m.date, m.path' % ' AND '.join(conditions))
+        if limit:
+            query += ' LIMIT %d' % limit
+        columns = ('path', 'sinli_type', 'src_code', 'dst_code', 'date', 'identifier',
+                   'document_number', 'description')
+        return [dict(zip(columns, row)) for row in self.db.execute(query, params)]
+
+    def items(self, path):
+        """Devuelve los items indexados del mensaje guardado en path
+        """
+        return [dict(zip(self.item_columns, row)) for row in self.db.execute(
+                    'SELECT i.ean, i.isbn_13, i.isbn_10, i.cod_articulo, i.quantity '
+                    'FROM items i JOIN messages m ON m.id = i.message_id WHERE m.path = ?',
+                    (path,))]
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Indice de mensajes sinliarg archivados')
+    arg_parser.add_argument('-s', '--settings', default='settings.json',
+                            help='Archivo de configuración')
+    arg_parser.add_argument('--db', default=None,
+                            help='Archivo del indice (por defecto "message_index_file" '
+                                 'de la configuración)')
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('actualizar', help='Indexar los archivos nuevos')
+    search_parser = commands.add_parser('buscar', help='Buscar mensajes')
+    for option, help_text in (('--tipo', 'Tipo de mensaje'), ('--origen', 'Codigo sinli de origen'),
+                              ('--destino', 'Codigo sinli de destino'),
+                              ('--desde', 'Fecha desde (2024-05-01)'),
+                              ('--hasta', 'Fecha hasta, no incluida'),
+                              ('--identificador', 'ARCHIVO/IDENTIFICADOR'),
+                              ('--numero', 'NUMERO_DOCUMENTO'), ('--ean', 'EAN de algun item'),
+                              ('--isbn', 'ISBN_13 o ISBN_10 de algun item'),
+                              ('--articulo', 'COD_ARTICULO de algun item')):
+        search_parser.add_argument(option, default=None, help=help_text)
+    search_parser.add_argument('--limite', type=int, default=None,
+                               help='Cantidad maxima de mensajes')
+    search_parser.add_argument('--json', action='store_true',
+                               help='Una linea json por mensaje')
+    args = arg_parser.parse_args(argv)
+
+    settings = {}
+    if os.path.isfile(args.settings):
+        settings = ftp2email.load_settings(args.settings)
+    db_file = args.db or settings.get('message_index_file', None)
+    if not db_file:
+        arg_parser.error('Se debe indicar el archivo del indice (--db o "message_index_file")')
+    if args.command == 'actualizar' and not settings.get('base_path', None):
+        arg_parser.error('Para actualizar el indice se debe indicar "base_path" en la '
+                         'configuración (%s)' % args.settings)
+    index = MessageIndex(db_file)
+    try:
+        if args.command == 'actualizar':
+            logging.basicConfig(level=logging.INFO, format='%(levelname)s|%(message)s')
+            start = time.time()
+            counters = index.update(settings['base_path'], settings.get('dir_re', None))
+            print('%(indexed)d indexados, %(unchanged)d sin cambios, %(errors)d con errores, '
+                  '%(removed)d quitados' % counters
+                  + ' (%.2fs)' % (time.time() - start), file=sys.stderr)
+            return 0
+
+        messages = index.search(sinli_type=args.tipo, src_code=args.origen,
+                                dst_code=args.destino, date_from=args.desde,
+                                date_to=args.hasta, identifier=args.identificador,
+                                document_number=args.numero, ean=args.ean, isbn=args.isbn,
+                                cod_articulo=args.articulo, limit=args.limite)
+        for message in messages:
+            if args.json:
+                print(json.dumps(message, sort_keys=True))
+            else:
+                print('\t'.join(message[x] or '' for x in
+                                ('date', 'sinli_type', 'src_code', 'dst_code',
+                                 'document_number', 'identifier', 'path')))
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
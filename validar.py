@@ -1,14 +1,182 @@
 #!/usr/bin/python
-from lxml import etree
+# vim: set fileencoding=utf-8 :
+"""Valida mensajes sinliarg contra la gramatica RELAX-NG
+
+    validar.py sinliarg.rng mensaje.xml
+    validar.py -j 4 --cache .validar_cache --report reporte.jsonl sinliarg.rng ejemplos/ recibidos/
+
+Los directorios se recorren buscando archivos .xml. La gramatica se compila una
+sola vez por proceso. Con --cache se saltean los archivos cuyo contenido ya fue
+validado correctamente con la misma gramatica.
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
 import sys
+import time
+
+from lxml import etree
+
+relaxng = None      # gramatica compilada del proceso
+
+
+def init_worker(grammar_file):
+    """Compila la gramatica en el proceso
+    """
+    global relaxng
+    relaxng = etree.RelaxNG(file=grammar_file)
+
+
+def file_digest(path):
+    """Devuelve el sha256 del contenido del archivo
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as i:
+        for chunk in iter(lambda: i.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def validate_file(args):
+    """Valida un archivo, devuelve un dict con el resultado
+        :args: (path, digest del contenido)
+    """
+    path, digest = args
+    start = time.time()
+    result = {'path': path, 'digest': digest, 'root': None, 'valid': False, 'errors': [],
+              'cached': False}
+    try:
+        doc = etree.parse(path)
+        result['root'] = doc.getroot().tag
+        result['valid'] = relaxng.validate(doc)
+        result['errors'] = [str(x) for x in relaxng.error_log]
+    except (etree.XMLSyntaxError, IOError) as e:
+        result['errors'] = [str(e)]
+    result['time'] = round(time.time() - start, 6)
+    return result
+
+
+def find_files(paths):
+    """Devuelve los archivos indicados y los .xml dentro de los directorios indicados
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.xml'):
+                    yield os.path.join(dirpath, filename)
+
+
+def load_cache(cache_file, grammar_digest):
+    """Lee los digest de archivos validos, si cambio la gramatica el cache se descarta
+    """
+    if not cache_file or not os.path.isfile(cache_file):
+        return {}
+    with open(cache_file) as i:
+        cache = json.load(i)
+    if cache.get('grammar') != grammar_digest:
+        return {}
+    return cache.get('valid', {})
+
+
+def save_cache(cache_file, grammar_digest, valid):
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as o:
+        json.dump({'grammar': grammar_digest, 'valid': valid}, o)
+    try:
+        os.replace(tmp_file, cache_file)
+    except AttributeError:  # python2
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(tmp_file, cache_file)
+
+
+def validate(grammar_file, paths, jobs=1, cache_file=None):
+    """Valida los archivos, devuelve un resultado por archivo en el orden en que terminan
+    """
+    grammar_digest = file_digest(grammar_file)
+    valid = load_cache(cache_file, grammar_digest)
+    pending = []
+    for path in find_files(paths):
+        try:
+            digest = file_digest(path)
+        except IOError as e:
+            yield {'path': path, 'digest': None, 'root': None, 'valid': False,
+                   'errors': [str(e)], 'time': 0, 'cached': False}
+            continue
+        if digest in valid:
+            yield {'path': path, 'digest': digest, 'root': valid[digest], 'valid': True,
+                   'errors': [], 'time': 0, 'cached': True}
+        else:
+            pending.append((path, digest))
+
+    pool = None
+    try:
+        if jobs == 1 or len(pending) < 2:
+            init_worker(grammar_file)
+            results = (validate_file(x) for x in pending)
+        else:
+            pool = multiprocessing.Pool(processes=jobs, initializer=init_worker,
+                                        initargs=(grammar_file,))
+            results = pool.imap_unordered(validate_file, pending, chunksize=8)
+            pool.close()
+        for result in results:
+            if result['valid']:
+                valid[result['digest']] = result['root']
+            yield result
+    finally:
+        # si se deja de iterar antes de terminar no quedan procesos corriendo
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache_file:
+            save_cache(cache_file, grammar_digest, valid)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description='Validar mensajes sinliarg')
+    arg_parser.add_argument('grammar', help='Gramática RELAX-NG (sinliarg.rng)')
+    arg_parser.add_argument('paths', nargs='+', help='Archivos o directorios a validar')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                            help='Cantidad de procesos')
+    arg_parser.add_argument('--cache', default=None,
+                            help='Archivo con los digest de los mensajes ya validados')
+    arg_parser.add_argument('--report', default=None,
+                            help='Archivo donde se escribe el reporte (una linea json por mensaje, - para stdout)')
+    args = arg_parser.parse_args(argv)
+
+    report = None
+    if args.report == '-':
+        report = sys.stdout
+    elif args.report:
+        report = open(args.report, 'w')
+
+    total = failed = 0
+    results = validate(args.grammar, args.paths, args.jobs, args.cache)
+    try:
+        for result in results:
+            total += 1
+            if not result['valid']:
+                failed += 1
+                print('%s: %s' % (result['path'], '\n'.join(result['errors'])), file=sys.stderr)
+            if report is not None:
+                report.write(json.dumps(result) + '\n')
+    finally:
+        results.close()
+        if report not in (None, sys.stdout):
+            report.close()
 
-grammar_file = sys.argv[1]
-xml_file = sys.argv[2]
+    if total > 1:
+        print('%d mensajes validados, %d con errores' % (total, failed), file=sys.stderr)
+    return 1 if failed else 0
 
-relaxng = etree.RelaxNG(file=grammar_file)
-result = relaxng.validate(etree.parse(xml_file))
 
-if not result:
-    print >> sys.stderr, relaxng.error_log
-    sys.exit(1)
-sys.exit(0)
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,4 @@
 #!/bin/bash
 
 trang sinliarg.rnc sinliarg.rng
-for x in ejemplos/*; do
-	./validar.py sinliarg.rng $x;
-done
+./validar.py sinliarg.rng ejemplos/